@@ -0,0 +1,61 @@
+"""Connext transaction, transfer and price data.
+
+Public classes are imported on first attribute access, so `import api` is
+cheap and heavy dependencies (web3, pandas) only load when a module that
+needs them is used, e.g. `api.ConnextAPI` doesn't import web3 until a
+contract is built. Check the budget with `python -m benchmarks.import_time`.
+"""
+import importlib
+from typing import Any, List
+
+_EXPORTS = {
+    "ActivityStats": "api.activity",
+    "AnalyticsRunner": "api.analytics",
+    "LPAnalytics": "api.analytics",
+    "LPEventLayout": "api.analytics",
+    "Chain": "api.constant",
+    "DiamondContract": "api.constant",
+    "ConfirmationDepth": "api.constant",
+    "EventTopic": "api.constant",
+    "ConnextAPI": "api.connext",
+    "ConnextLPTransferAPI": "api.connext",
+    "ScanAPI": "api.scan",
+    "ScanTxn": "api.scan",
+    "TxnStore": "api.store",
+    "Token": "api.token",
+    "ERC20Token": "api.contract",
+    "ConnextDiamond": "api.contract",
+    "BatchStateReader": "api.contract",
+    "Executor": "api.executor",
+    "FlowCube": "api.flows",
+    "LogScanner": "api.log_scanner",
+    "ProviderPool": "api.providers",
+    "LPSupplyIndex": "api.lp_supply",
+    "LPSupplySeries": "api.lp_supply",
+    "DedupIndex": "api.dedup",
+    "ResponseArchive": "api.archive",
+    "ArchiveReplay": "api.replay",
+    "CircuitBreaker": "api.retry",
+    "RetryPolicy": "api.retry",
+    "Watch": "api.watchlist",
+    "Watchlist": "api.watchlist",
+    "PriceFetcher": "api.price",
+    "PriceStore": "api.price",
+    "WETHPriceFetcher": "api.price",
+    "CampaignReport": "api.report",
+}
+
+__all__ = list(_EXPORTS.keys())
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__} has no attribute {name}")
+    value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    # cache on the package, later lookups don't go through `__getattr__`
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(list(globals().keys()) + __all__)
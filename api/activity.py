@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import math
+import os
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from api.constant import Chain
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+BucketKey = Tuple[Chain, int]
+
+NULL_ADDRESSES = ["", "0x0", "0x" + "0" * 40]
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch of distinct string keys in `2 ** precision` one-byte registers.
+
+    The standard error of `len()` is about `1.04 / sqrt(2 ** precision)`, 1.6%
+    at the default precision of 12 with 4KB per sketch. Keys are hashed with
+    `pandas.util.hash_array`, whose hash key is fixed, so sketches saved by
+    different runs can be merged.
+    """
+
+    def __init__(self, precision: int = 12) -> None:
+        """
+        :param precision: bits of the hash picking a register, 4 to 18
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision must be in [4, 18], got {precision}")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @staticmethod
+    def _bit_length(values: np.ndarray) -> np.ndarray:
+        # exact for uint64, `np.log2` rounds values close to powers of 2
+        n_bits = np.zeros(len(values), dtype=np.uint8)
+        values = values.copy()
+        for shift in [32, 16, 8, 4, 2, 1]:
+            mask = values >= np.uint64(1 << shift)
+            n_bits[mask] += shift
+            values[mask] >>= np.uint64(shift)
+        return n_bits + (values > 0)
+
+    def update(self, keys: Union[List[str], np.ndarray]) -> None:
+        """Add keys, vectorized over the array"""
+        from pandas.util import hash_array
+
+        if len(keys) == 0:
+            return
+        hashes = hash_array(np.asarray(keys, dtype=object))
+        n_rest = 64 - self.precision
+        idx = (hashes >> np.uint64(n_rest)).astype(np.int64)
+        rest = hashes & np.uint64((1 << n_rest) - 1)
+        # position of the first 1-bit in the remaining bits, n_rest + 1 if all are 0
+        rank = (n_rest + 1 - HyperLogLog._bit_length(rest)).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        """Union with another sketch of the same precision"""
+        if other.precision != self.precision:
+            raise ValueError(f"Can't merge HyperLogLog of precision {other.precision} into {self.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def __len__(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1., -self.registers.astype(np.int64)))
+        n_zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and n_zeros > 0:
+            # linear counting for small cardinalities
+            estimate = m * math.log(m / n_zeros)
+        return int(round(estimate))
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(f"{self.precision}\n".encode())
+            fp.write(self.registers.tobytes())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "HyperLogLog":
+        with open(path, "rb") as fp:
+            sketch = HyperLogLog(int(fp.readline().decode().strip()))
+            sketch.registers = np.frombuffer(fp.read(), dtype=np.uint8).copy()
+        return sketch
+
+
+class ActivityStats(object):
+    """
+    Unique wallets, new vs returning wallets and activity per chain and time bucket
+    of an event table, e.g. the LP transactions of `api.analytics`, with a
+    `chain` column, a `user` column and datetimes as index.
+
+    Events are fed with `update`, in chronological chunks so long histories
+    don't have to be loaded at once: a wallet is new in the first bucket it
+    appears in. Buckets are computed with integer division of unix times.
+    Distinct wallets and transactions are counted with sets, or with
+    `HyperLogLog` sketches when `approximate` so memory only depends on the
+    number of buckets.
+    """
+
+    FREQS = {"hour": 3600, "day": 86400}
+
+    def __init__(
+        self,
+        freq: str = "day",
+        approximate: bool = False,
+        precision: int = 12,
+        user_column: str = "user",
+        tx_column: str = "tx_hash") -> None:
+        """
+        :param freq: `hour` or `day`
+        :param approximate: count distinct wallets and transactions with HyperLogLog sketches
+        :param precision: precision of the sketches, see `HyperLogLog`
+        :param user_column: column of the wallet address
+        :param tx_column: column of the transaction hash, events of a transaction are counted once
+        """
+        if freq not in ActivityStats.FREQS:
+            raise ValueError(f"Unknown freq {freq}, only {'|'.join(ActivityStats.FREQS.keys())}")
+        self.freq = freq
+        self.approximate = approximate
+        self.precision = precision
+        self.user_column = user_column
+        self.tx_column = tx_column
+        self.events: Dict[BucketKey, int] = {}
+        self.new_wallets: Dict[BucketKey, int] = {}
+        self.wallets: Dict[BucketKey, Union[set, HyperLogLog]] = {}
+        self.txs: Dict[BucketKey, Union[set, HyperLogLog]] = {}
+        # wallets seen so far per chain
+        self.seen: Dict[Chain, Union[set, HyperLogLog]] = {}
+
+    def _counter(self) -> Union[set, HyperLogLog]:
+        return HyperLogLog(self.precision) if self.approximate else set()
+
+    @staticmethod
+    def to_unixtime(times: Union[pd.Index, pd.Series, np.ndarray]) -> np.ndarray:
+        """Unix seconds of datetimes (naive UTC, as in the cached transactions) or unix times"""
+        values = np.asarray(times)
+        if np.issubdtype(values.dtype, np.datetime64):
+            return values.astype("datetime64[s]").astype(np.int64)
+        return values.astype(np.int64)
+
+    @staticmethod
+    def bucket(times: Union[pd.Index, pd.Series, np.ndarray], freq: str = "day") -> np.ndarray:
+        """Unix time of the start of the hour/day of each time"""
+        seconds = ActivityStats.FREQS[freq]
+        return ActivityStats.to_unixtime(times) // seconds * seconds
+
+    def update(self, events: pd.DataFrame) -> None:
+        """Add a chunk of events, chunks must not go back in time"""
+        import pandas as pd
+
+        if len(events) == 0:
+            return
+        df = pd.DataFrame({
+            "chain": events["chain"].to_numpy(),
+            "bucket": ActivityStats.bucket(events.index, self.freq),
+            "user": events[self.user_column].str.lower().to_numpy(),
+            "tx": events[self.tx_column].to_numpy() if self.tx_column in events else np.arange(len(events)),
+        })
+        df = df[~df["user"].isin(NULL_ADDRESSES)].sort_values(["chain", "bucket"], kind="stable")
+        if len(df) == 0:
+            return
+
+        chains = df["chain"].to_numpy()
+        buckets = df["bucket"].to_numpy()
+        users = df["user"].to_numpy()
+        txs = df["tx"].to_numpy()
+        # boundaries of (chain, bucket) groups in the sorted chunk
+        starts = np.flatnonzero(np.r_[True, (chains[1:] != chains[:-1]) | (buckets[1:] != buckets[:-1])])
+        ends = np.r_[starts[1:], len(df)]
+        for start, end in zip(starts, ends):
+            key = (chains[start], int(buckets[start]))
+            wallets = pd.unique(users[start:end])
+            if key not in self.wallets:
+                self.wallets[key], self.txs[key] = self._counter(), self._counter()
+                self.events[key], self.new_wallets[key] = 0, 0
+            self.wallets[key].update(wallets)
+            self.txs[key].update(pd.unique(txs[start:end]))
+            self.events[key] += end - start
+
+            seen = self.seen.setdefault(key[0], self._counter())
+            n_seen = len(seen)
+            seen.update(wallets)
+            # sketch estimates aren't monotonic for tiny increments
+            self.new_wallets[key] += max(0, len(seen) - n_seen)
+
+    def to_frame(self, chain: Optional[Chain] = None) -> pd.DataFrame:
+        """Per chain and bucket: `events`, distinct `txs`, distinct `wallets`, `new_wallets`
+        and `returning_wallets` (active wallets seen in an earlier bucket)"""
+        import pandas as pd
+
+        rows = []
+        for key in sorted(self.wallets.keys()):
+            if chain is not None and key[0] != chain:
+                continue
+            n_wallets = len(self.wallets[key])
+            new_wallets = min(self.new_wallets[key], n_wallets)
+            rows.append({
+                "chain": key[0],
+                "time": key[1],
+                "events": self.events[key],
+                "txs": len(self.txs[key]),
+                "wallets": n_wallets,
+                "new_wallets": new_wallets,
+                "returning_wallets": n_wallets - new_wallets,
+            })
+        df = pd.DataFrame(
+            rows, columns=["chain", "time", "events", "txs", "wallets", "new_wallets", "returning_wallets"])
+        df["time"] = pd.to_datetime(df["time"], unit="s")
+        return df
+
+    def totals(self) -> pd.DataFrame:
+        """Per chain: events, distinct wallets over all buckets and active buckets"""
+        import pandas as pd
+
+        rows = []
+        for chain, seen in self.seen.items():
+            keys = [key for key in self.wallets.keys() if key[0] == chain]
+            rows.append({
+                "chain": chain,
+                "events": sum(self.events[key] for key in keys),
+                "wallets": len(seen),
+                "active_buckets": len(keys),
+            })
+        return pd.DataFrame(rows, columns=["chain", "events", "wallets", "active_buckets"]).set_index("chain")
+
+    @staticmethod
+    def select(
+        events: pd.DataFrame,
+        chain: Optional[Chain] = None,
+        start: Optional[Union[str, datetime]] = None,
+        end: Optional[Union[str, datetime]] = None) -> pd.DataFrame:
+        """Events of a chain in `[start, end)`, `start`/`end` as `YYYY-MM-DD` or datetimes
+
+        The index must be sorted, the time range is a binary search.
+        """
+        import pandas as pd
+
+        times = events.index.values
+        lo = 0 if start is None else np.searchsorted(times, np.datetime64(pd.Timestamp(start)), side="left")
+        hi = len(events) if end is None else np.searchsorted(times, np.datetime64(pd.Timestamp(end)), side="left")
+        events = events.iloc[lo:hi]
+        if chain is not None:
+            events = events[events["chain"].to_numpy() == chain]
+        return events
+
+    @staticmethod
+    def unique_wallets(events: pd.DataFrame, user_column: str = "user") -> Dict[Chain, List[str]]:
+        """Distinct wallets of each chain, most active first"""
+        df = events[~events[user_column].isin(NULL_ADDRESSES)]
+        counts = df.groupby(["chain", user_column], sort=False).size().sort_values(ascending=False, kind="stable")
+        wallets = {}
+        for chain, user in counts.index:
+            wallets.setdefault(chain, []).append(user)
+        return wallets
@@ -0,0 +1,466 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from api.constant import Chain, EventTopic
+from api.executor import Executor
+from api.profiling import stage
+from api.token import Token
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from api.contract import ERC20Token
+    from api.scan import ScanTxn
+
+LP_ACTIONS = ["mint", "burn", "transfer_in", "transfer_out"]
+NULL_ADDRESS = "0x" + "0" * 40
+
+# (chain, token, first wallet run, end wallet run) of a partition of `LPEventLayout`
+Partition = Tuple[Chain, str, int, int]
+
+
+def resolve_address(address: str) -> str:
+    """Address padded to 40 hex digits, e.g. `0x0` to the null address"""
+    return "0x" + address.replace("0x", "").rjust(40, "0")
+
+
+class LPAnalytics(object):
+    """
+    LP events of the Diamond and LP transfer caches, and per-wallet holdings and
+    scores computed from them, one `(chain, token)` at a time. See
+    `AnalyticsRunner` to compute every `(chain, token)` in parallel.
+
+    The event table has one row per LP token movement of a wallet: `chain`,
+    `tx_hash`, `sender`, `receiver`, `token` (LP token symbol), `amount`,
+    `action` (one of `LP_ACTIONS`), `fn_name`, `user`, `balance_change`, and
+    UTC datetimes as index.
+    """
+
+    @staticmethod
+    def get_lp_txs(
+        data: Dict[Chain, List[ScanTxn]],
+        transfers: Dict[Chain, List[ScanTxn]],
+        chains: Optional[List[Chain]] = None,
+        filter_function: Optional[List[str]] = None,
+        blacklist_token: Optional[List[str]] = None) -> pd.DataFrame:
+        """Mints and burns of add/remove liquidity txs, and LP token transfers between wallets
+
+        :param data: Diamond txs by chain, e.g. `ConnextAPI.load_cache()`
+        :param transfers: LP transfer txs by chain, e.g. `ConnextLPTransferAPI.load_cache()`
+        :param chains: chains with stable swap pools
+        :param filter_function: Diamond functions minting or burning LP tokens
+        :param blacklist_token: deprecated LP tokens to skip in the Diamond txs
+        """
+        import pandas as pd
+
+        if chains is None:
+            chains = [Chain.POLYGON, Chain.ARBITRUM_ONE, Chain.BNB_CHAIN, Chain.GNOSIS, Chain.OPTIMISM]
+        if filter_function is None:
+            filter_function = ["addSwapLiquidity", "removeSwapLiquidity"]
+        blacklist_token = {address.lower() for address in blacklist_token or []}
+
+        rows = []
+        for chain in chains:
+            lp_tokens = {Token.get_lp(chain, token).address.lower() for token in [Token.USDC, Token.WETH]}
+            for tx in data.get(chain, []):
+                fn_name = tx.functionName.split("(")[0] if tx.functionName else ""
+                if fn_name not in filter_function:
+                    continue
+                for sender, receiver, token, amount in LPAnalytics._iter_transfers(chain, tx):
+                    if token.address.lower() in blacklist_token:
+                        continue
+                    if sender == NULL_ADDRESS:
+                        action, user = "mint", receiver
+                    elif receiver == NULL_ADDRESS:
+                        action, user = "burn", sender
+                    else:
+                        # transfers between wallets are counted from the LP transfer txs
+                        continue
+                    rows.append((chain, tx.hash, sender, receiver, token.symbol, amount, action, fn_name, user, tx.timeStamp))
+
+            # transfer rows of one transaction share its receipt, count its logs once
+            seen = set()
+            for tx in transfers.get(chain, []):
+                if tx.logs is None or tx.hash in seen:
+                    continue
+                seen.add(tx.hash)
+                for sender, receiver, token, amount in LPAnalytics._iter_transfers(chain, tx):
+                    if token.address.lower() not in lp_tokens:
+                        continue
+                    rows.append((chain, tx.hash, sender, receiver, token.symbol, amount, "transfer_out", "Transfer", sender, tx.timeStamp))
+                    rows.append((chain, tx.hash, sender, receiver, token.symbol, amount, "transfer_in", "Transfer", receiver, tx.timeStamp))
+
+        lp_txs = pd.DataFrame(rows, columns=[
+            "chain", "tx_hash", "sender", "receiver", "token", "amount", "action", "fn_name", "user", "timestamp"])
+        sign = np.where(lp_txs["action"].isin(["mint", "transfer_in"]), 1., -1.)
+        lp_txs["balance_change"] = lp_txs["amount"] * sign
+        lp_txs["time"] = pd.to_datetime(lp_txs["timestamp"], unit="s")
+        return lp_txs.drop("timestamp", axis=1).set_index("time").sort_index(kind="stable")
+
+    @staticmethod
+    def _iter_transfers(chain: Chain, tx: ScanTxn) -> Iterator[Tuple[str, str, ERC20Token, float]]:
+        """`(sender, receiver, token, amount)` of the ERC20 Transfer logs of registered tokens"""
+        for log in tx.logs or []:
+            topics = log["topics"]
+            if len(topics) != 3 or topics[0] != EventTopic.TRANSFER:
+                continue
+            token = Token.address_lookup(log["address"], chain)
+            if token is None:
+                continue
+            amount = int(log["data"], 16) / 10 ** token.decimal
+            yield resolve_address(hex(int(topics[1], 16))), resolve_address(hex(int(topics[2], 16))), token, amount
+
+    @staticmethod
+    def join_price(lp_txs: pd.DataFrame, hourly_price: Union[pd.Series, pd.DataFrame]) -> pd.DataFrame:
+        """Price LP amounts, USDC LP at 1 and WETH LP at the price of the hour
+
+        Adds `price`, `lp_value` and `lp_value_change` (value of `balance_change`).
+
+        :param lp_txs: event table of `get_lp_txs`
+        :param hourly_price: WETH price indexed by hour, e.g. `PriceStore.hourly("WETH")`
+        """
+        import pandas as pd
+
+        if isinstance(hourly_price, pd.DataFrame):
+            hourly_price = hourly_price["price"]
+        lp_txs = lp_txs.copy()
+        weth_price = hourly_price.reindex(lp_txs.index.floor("h")).to_numpy()
+        lp_txs["price"] = np.where(
+            lp_txs["token"] == Token.CUSDCLP, 1., np.where(lp_txs["token"] == Token.CWETHLP, weth_price, np.nan))
+        lp_txs["lp_value"] = lp_txs["price"] * lp_txs["amount"]
+        lp_txs["lp_value_change"] = lp_txs["price"] * lp_txs["balance_change"]
+        return lp_txs
+
+    @staticmethod
+    def _filter(lp_txs: pd.DataFrame, chain: Chain, token: Optional[str] = None) -> pd.DataFrame:
+        mask = (lp_txs["chain"] == chain) & lp_txs["action"].isin(LP_ACTIONS)
+        if token is not None:
+            mask &= lp_txs["token"] == token
+        return lp_txs[mask]
+
+    @staticmethod
+    def get_top_holders(lp_txs: pd.DataFrame, chain: Chain, token: Optional[str] = None, column: str = "balance_change") -> pd.Series:
+        """Net LP balance (or `lp_value_change`) of each wallet on a chain, largest first
+
+        :param token: LP token symbol, all LP tokens (e.g. to rank by value) if None
+        """
+        df = LPAnalytics._filter(lp_txs, chain, token)
+        return df.groupby("user")[column].sum().sort_values(ascending=False)
+
+    @staticmethod
+    def get_scores(
+        lp_txs: pd.DataFrame,
+        chain: Chain,
+        token: str,
+        start_date: Union[str, datetime] = "2023-02-15",
+        end_date: Optional[Union[str, datetime]] = None,
+        timeframe: str = "1min") -> pd.Series:
+        """Time-weighted average LP balance of each wallet over `[start_date, end_date)`, positive scores only
+
+        See `AnalyticsRunner.twap_scores`.
+        """
+        import pandas as pd
+
+        with stage("score"):
+            df = LPAnalytics._filter(lp_txs, chain, token)
+            users, codes = np.unique(df["user"].to_numpy(), return_inverse=True)
+            times = df.index.values.astype("datetime64[s]").astype(np.int64)
+            order = np.lexsort((times, codes))
+            codes = codes[order]
+            balance = AnalyticsRunner.running_balance(
+                df["balance_change"].to_numpy()[order], np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]))
+            start, end, step = AnalyticsRunner.time_grid(start_date, end_date, timeframe)
+            user_codes, scores = AnalyticsRunner.twap_scores(times[order], codes, balance, start, end, step)
+        result = pd.Series(scores, index=pd.Index(users[user_codes], name="wallet"), name="score")
+        return result[result > 0].sort_values(ascending=False)
+
+
+class LPEventLayout(object):
+    """
+    LP events persisted as memory-mapped numpy columns, sorted by
+    `(chain, token, wallet, time)`.
+
+    The rows of a wallet in a `(chain, token)` are a contiguous run, located by
+    `wallet_offsets`, and `balance` holds the running balance of the run, so a
+    wallet's balance curve is a zero-copy slice instead of a `cumsum` over a
+    filtered DataFrame. Processes opening the same layout share its pages
+    through the OS page cache instead of each holding a copy.
+
+    Files in `path`:
+    - `time`, `wallet`, `balance_change`, `lp_value_change`, `balance`: one row per event
+    - `wallet_offsets`: first row of each run, and the number of rows last
+    - `run_wallet`: wallet code of each run
+    - `wallets`: addresses, sorted, indexed by wallet code
+    - `meta.json`: runs of each `(chain, token)`
+    """
+
+    COLUMNS = ["time", "wallet", "balance_change", "lp_value_change", "balance"]
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: directory written by `LPEventLayout.build`
+        """
+        self.path = path
+        with open(f"{path}/meta.json", "r") as fp:
+            meta = json.load(fp)
+        self.partitions: List[Partition] = [tuple(partition) for partition in meta["partitions"]]
+        for name in LPEventLayout.COLUMNS + ["wallet_offsets", "run_wallet", "wallets"]:
+            setattr(self, name, np.load(f"{path}/{name}.npy", mmap_mode="r"))
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @staticmethod
+    def build(lp_txs: pd.DataFrame, path: str) -> "LPEventLayout":
+        """Write the LP events (`LP_ACTIONS` rows) of an event table at `path`, replacing any layout there
+
+        :param lp_txs: event table of `LPAnalytics.get_lp_txs`, priced with `join_price` for values
+        """
+        import pandas as pd
+
+        df = lp_txs[lp_txs["action"].isin(LP_ACTIONS)]
+        # hash-based codes, sorting strings is the bottleneck on large tables
+        chain_codes, chains = pd.factorize(df["chain"])
+        token_codes, tokens = pd.factorize(df["token"])
+        user_codes, users = pd.factorize(df["user"])
+        # re-code wallets in address order so lookups are a binary search
+        sorter = np.argsort(np.asarray(users, dtype=str))
+        rank = np.empty(len(sorter), dtype=np.int32)
+        rank[sorter] = np.arange(len(sorter), dtype=np.int32)
+        wallet_codes = rank[user_codes]
+        partition_codes = chain_codes.astype(np.int64) * max(len(tokens), 1) + token_codes
+        times = df.index.values.astype("datetime64[s]").astype(np.int64)
+        order = np.lexsort((times, wallet_codes, partition_codes))
+
+        wallet_codes, partition_codes = wallet_codes[order], partition_codes[order]
+        new_partition = np.r_[True, partition_codes[1:] != partition_codes[:-1]] if len(order) else np.zeros(0, dtype=bool)
+        new_run = new_partition | np.r_[True, wallet_codes[1:] != wallet_codes[:-1]][:len(order)]
+        run_starts = np.flatnonzero(new_run)
+        balance_change = df["balance_change"].to_numpy(dtype=np.float64)[order]
+        value_change = df["lp_value_change"].to_numpy(dtype=np.float64) if "lp_value_change" in df else np.full(len(df), np.nan)
+        columns = {
+            "time": times[order],
+            "wallet": wallet_codes,
+            "balance_change": balance_change,
+            "lp_value_change": value_change[order],
+            "balance": AnalyticsRunner.running_balance(balance_change, run_starts),
+            "wallet_offsets": np.r_[run_starts, len(order)].astype(np.int64),
+            "run_wallet": wallet_codes[run_starts],
+            "wallets": np.asarray(users, dtype=str)[sorter],
+        }
+
+        # runs where each partition starts
+        partition_runs = np.flatnonzero(new_partition[run_starts])
+        partitions = [
+            (chains[chain_codes[order[run_starts[lo]]]], tokens[token_codes[order[run_starts[lo]]]], int(lo), int(hi))
+            for lo, hi in zip(partition_runs, np.r_[partition_runs[1:], len(run_starts)])
+        ]
+
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, values in columns.items():
+            np.save(f"{tmp_path}/{name}.npy", values)
+        with open(f"{tmp_path}/meta.json", "w") as fp:
+            json.dump({"n_rows": len(order), "partitions": partitions}, fp, indent=4)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        logging.info(f"Wrote {len(order)} LP events of {len(run_starts)} wallet runs at {path}")
+        return LPEventLayout(path)
+
+    def partition(self, chain: Chain, token: str) -> Optional[Partition]:
+        for partition in self.partitions:
+            if partition[0] == chain and partition[1] == token:
+                return partition
+        return None
+
+    def rows(self, chain: Chain, token: str, wallet: str) -> Tuple[int, int]:
+        """`[start, end)` rows of a wallet's events in a `(chain, token)`, empty if it has none"""
+        partition = self.partition(chain, token)
+        code = np.searchsorted(self.wallets, wallet.lower())
+        if partition is None or code >= len(self.wallets) or self.wallets[code] != wallet.lower():
+            return 0, 0
+        _, _, run_lo, run_hi = partition
+        run = run_lo + np.searchsorted(self.run_wallet[run_lo:run_hi], code)
+        if run >= run_hi or self.run_wallet[run] != code:
+            return 0, 0
+        return int(self.wallet_offsets[run]), int(self.wallet_offsets[run + 1])
+
+    def balance_curve(self, chain: Chain, token: str, wallet: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Unix times and running LP balance of a wallet, read-only views of the layout"""
+        lo, hi = self.rows(chain, token, wallet)
+        return self.time[lo:hi], self.balance[lo:hi]
+
+    def balance_at(self, chain: Chain, token: str, wallet: str, unixtime: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        """LP balance of a wallet as of unix time `unixtime`, 0 before its first event"""
+        times, balance = self.balance_curve(chain, token, wallet)
+        result = np.r_[0., balance][np.searchsorted(times, unixtime, side="right")]
+        return float(result) if np.ndim(result) == 0 else result
+
+    def balance_series(self, chain: Chain, token: str, wallet: str) -> pd.Series:
+        """Running LP balance of a wallet as a Series indexed by datetime, copied out of the layout"""
+        import pandas as pd
+
+        times, balance = self.balance_curve(chain, token, wallet)
+        return pd.Series(np.array(balance), index=pd.to_datetime(np.array(times), unit="s"), name=wallet.lower())
+
+
+class AnalyticsRunner(object):
+    """
+    Holdings and scores of every `(chain, token)` of LP events, partitions
+    computed in parallel.
+
+    Events are read from an `LPEventLayout`, built in a temporary directory
+    when an event table is passed. Workers memory-map the layout and compute
+    the rows of their partition, so no DataFrame is pickled to a worker and
+    only per-wallet results are sent back, as arrays. Wallet codes are mapped
+    back to addresses and results merged in the parent.
+    """
+
+    def __init__(
+        self,
+        executor: str = Executor.PROCESS,
+        num_workers: Optional[int] = None,
+        tmp_dir: Optional[str] = None) -> None:
+        """
+        :param executor: `process`, or `thread` for small tables
+        :param num_workers: concurrent partitions, defaults to the number of CPUs
+        :param tmp_dir: directory of temporary layouts, defaults to the system temp dir
+        """
+        self.executor = Executor(executor, num_workers or os.cpu_count() or 1)
+        self.tmp_dir = tmp_dir
+
+    @staticmethod
+    def time_grid(
+        start_date: Union[str, datetime],
+        end_date: Optional[Union[str, datetime]],
+        timeframe: str) -> Tuple[int, int, int]:
+        """Unix `(start, end, step)` of a scoring window, `end_date` defaults to now"""
+        import pandas as pd
+
+        start = int(pd.Timestamp(start_date).timestamp())
+        end = int(pd.Timestamp(end_date if end_date is not None else datetime.utcnow()).timestamp())
+        step = int(pd.to_timedelta(timeframe).total_seconds())
+        if step <= 0 or end <= start:
+            raise ValueError(f"Empty scoring window [{start_date}, {end_date}) with timeframe {timeframe}")
+        return start, end, step
+
+    @staticmethod
+    def running_balance(changes: np.ndarray, group_starts: np.ndarray) -> np.ndarray:
+        """Cumulative sum of `changes` restarting at each of `group_starts`"""
+        if len(changes) == 0:
+            return np.zeros(0)
+        cumsum = np.cumsum(changes)
+        offset = (cumsum - changes)[group_starts]
+        return cumsum - np.repeat(offset, np.diff(np.r_[group_starts, len(changes)]))
+
+    @staticmethod
+    def twap_scores(
+        times: np.ndarray,
+        users: np.ndarray,
+        balance: np.ndarray,
+        start: int,
+        end: int,
+        step: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Mean over `[start, end)` of each wallet's balance at the end of every `step` seconds
+
+        Same as resampling the cumulative balance with `last` and forward-filling,
+        without materializing the grid: each balance counts for the steps until
+        the wallet's next change. Balances before `start` are carried in.
+
+        :param times: unix times, sorted within each wallet
+        :param users: wallet codes, rows of a wallet contiguous
+        :param balance: running balance of the wallet after each row
+        :return: wallet codes and their scores
+        """
+        n_steps = -(-(end - start) // step)
+        keep = times < start + n_steps * step
+        times, users, balance = times[keep], users[keep], balance[keep]
+        if len(times) == 0:
+            return np.zeros(0, dtype=users.dtype), np.zeros(0)
+        step_idx = np.clip((times - start) // step, 0, None)
+        # last change of each wallet in each step
+        is_last = np.r_[(users[1:] != users[:-1]) | (step_idx[1:] != step_idx[:-1]), True]
+        users, step_idx, balance = users[is_last], step_idx[is_last], balance[is_last]
+        next_idx = np.r_[step_idx[1:], n_steps]
+        next_idx[np.r_[users[1:] != users[:-1], True]] = n_steps
+
+        weighted = balance * (next_idx - step_idx)
+        boundaries = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+        return users[boundaries], np.add.reduceat(weighted, boundaries) / n_steps
+
+    @staticmethod
+    def _run_partition(task: Tuple[str, Partition, Tuple[int, int, int]]) -> Dict[str, np.ndarray]:
+        path, (_, _, run_lo, run_hi), (start, end, step) = task
+        layout = LPEventLayout(path)
+        offsets = np.array(layout.wallet_offsets[run_lo:run_hi + 1])
+        lo, hi = offsets[0], offsets[-1]
+        user_codes, scores = AnalyticsRunner.twap_scores(
+            layout.time[lo:hi], layout.wallet[lo:hi], layout.balance[lo:hi], start, end, step)
+        return {
+            "user": np.array(layout.run_wallet[run_lo:run_hi]),
+            # balance after the last event of each run
+            "balance": np.array(layout.balance[offsets[1:] - 1]),
+            "value": np.add.reduceat(layout.lp_value_change[lo:hi], offsets[:-1] - lo),
+            "score_user": user_codes,
+            "score": scores,
+        }
+
+    def run(
+        self,
+        lp_txs: Union[pd.DataFrame, LPEventLayout],
+        start_date: Union[str, datetime] = "2023-02-15",
+        end_date: Optional[Union[str, datetime]] = None,
+        timeframe: str = "1min") -> Dict[str, pd.DataFrame]:
+        """Holdings and scores of every `(chain, token)`
+
+        :param lp_txs: event table of `LPAnalytics.get_lp_txs` (priced with `join_price` for values),
+            or a persisted `LPEventLayout` of it
+        :param start_date: start of the scoring window
+        :param end_date: end of the scoring window, now if None
+        :param timeframe: scoring step, e.g. `1min` or `1h`
+        :return: `holders` (`chain`, `token`, `wallet`, `balance`, `value`) and
+            `scores` (`chain`, `token`, `wallet`, `score`, positive only), largest first
+        """
+        grid = AnalyticsRunner.time_grid(start_date, end_date, timeframe)
+        if isinstance(lp_txs, LPEventLayout):
+            return self._run(lp_txs, grid)
+        with tempfile.TemporaryDirectory(prefix="lp_analytics_", dir=self.tmp_dir) as tmp_dir:
+            return self._run(LPEventLayout.build(lp_txs, f"{tmp_dir}/layout"), grid)
+
+    def _run(self, layout: LPEventLayout, grid: Tuple[int, int, int]) -> Dict[str, pd.DataFrame]:
+        import pandas as pd
+
+        logging.info(f"Computing {len(layout.partitions)} (chain, token) partitions of {len(layout)} LP events with {self.executor}")
+        offsets = layout.wallet_offsets
+        # largest partitions first so a big one doesn't start last
+        tasks = sorted(layout.partitions, key=lambda partition: offsets[partition[2]] - offsets[partition[3]])
+        with stage("score"):
+            results = self.executor.map(AnalyticsRunner._run_partition, [(layout.path, task, grid) for task in tasks])
+
+        holders, scores = [], []
+        for (chain, token, _, _), result in zip(tasks, results):
+            holders.append(pd.DataFrame({
+                "chain": chain, "token": token, "wallet": layout.wallets[result["user"]],
+                "balance": result["balance"], "value": result["value"]}))
+            scores.append(pd.DataFrame({
+                "chain": chain, "token": token, "wallet": layout.wallets[result["score_user"]], "score": result["score"]}))
+
+        holder_columns = ["chain", "token", "wallet", "balance", "value"]
+        score_columns = ["chain", "token", "wallet", "score"]
+        holders = pd.concat(holders, ignore_index=True) if holders else pd.DataFrame(columns=holder_columns)
+        scores = pd.concat(scores, ignore_index=True) if scores else pd.DataFrame(columns=score_columns)
+        scores = scores[scores["score"] > 0]
+        return {
+            "holders": holders.sort_values(["chain", "token", "balance"], ascending=[True, True, False], ignore_index=True),
+            "scores": scores.sort_values(["chain", "token", "score"], ascending=[True, True, False], ignore_index=True),
+        }
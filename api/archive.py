@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, Union
+
+from api.constant import Chain
+
+
+class ResponseArchive(object):
+    """
+    Append-only archive of raw explorer, subgraph and RPC responses.
+
+    Each response is stored once, zstd-compressed and content-addressed by
+    the sha256 of its JSON at `{archive_dir}/objects/{digest[:2]}/{digest}.zst`.
+    Fetches are appended to `{archive_dir}/index/{service}/{chain}.jsonl`
+    with their endpoint, action, parameters (without API key) and block range,
+    so responses can be replayed in fetch order, see `api.replay`.
+
+    Disabled by default, enable it with `archive.enable(archive_dir)`.
+    Requires `zstandard`.
+    """
+
+    def __init__(self, level: int = 3) -> None:
+        """
+        :param level: zstd compression level
+        """
+        self.level = level
+        self.archive_dir: Optional[str] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def enabled(self) -> bool:
+        return self.archive_dir is not None
+
+    def enable(self, archive_dir: str) -> None:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise ImportError("Response archive requires zstandard, install it with `pip install zstandard`")
+        self.archive_dir = archive_dir
+        os.makedirs(f"{archive_dir}/objects", exist_ok=True)
+
+    def disable(self) -> None:
+        self.archive_dir = None
+
+    def _codec(self) -> Tuple[Any, Any]:
+        # zstd (de)compressors aren't thread-safe, keep one pair per thread
+        codec = getattr(self._local, "codec", None)
+        if codec is None:
+            import zstandard
+            codec = (zstandard.ZstdCompressor(level=self.level), zstandard.ZstdDecompressor())
+            self._local.codec = codec
+        return codec
+
+    def object_path(self, digest: str) -> str:
+        return f"{self.archive_dir}/objects/{digest[:2]}/{digest}.zst"
+
+    def index_path(self, service: str, chain: Chain) -> str:
+        return f"{self.archive_dir}/index/{service}/{chain}.jsonl"
+
+    def put(
+        self,
+        service: str,
+        chain: Chain,
+        endpoint: str,
+        action: str,
+        params: Dict[str, Any],
+        response: Any,
+        block_range: Tuple[Optional[int], Optional[int]] = (None, None)) -> str:
+        """Archive a response, returns its digest
+
+        :param service: `explorer`, `subgraph` or `rpc`
+        :param chain: chain the request is for
+        :param endpoint: host or subgraph name
+        :param action: explorer action, GraphQL entity or RPC method
+        :param params: request parameters, `apikey` is dropped
+        :param response: decoded JSON response
+        :param block_range: first and last block covered by the response, if known
+        """
+        data = json.dumps(response, sort_keys=True, separators=(",", ":")).encode()
+        digest = hashlib.sha256(data).hexdigest()
+
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as fp:
+                fp.write(self._codec()[0].compress(data))
+            os.replace(tmp_path, object_path)
+
+        entry = {
+            "time": time.time(),
+            "endpoint": endpoint,
+            "action": action,
+            "params": {k: v for k, v in params.items() if k != "apikey"},
+            "from_block": block_range[0],
+            "to_block": block_range[1],
+            "digest": digest,
+            "size": len(data),
+        }
+        index_path = self.index_path(service, chain)
+        line = json.dumps(entry, default=str) + "\n"
+        with self._lock:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            # one write per line in append mode, so lines of concurrent writers don't interleave
+            with open(index_path, "a") as fp:
+                fp.write(line)
+        return digest
+
+    def get(self, digest: str) -> Any:
+        with open(self.object_path(digest), "rb") as fp:
+            return json.loads(self._codec()[1].decompress(fp.read()))
+
+    def entries(
+        self,
+        service: str,
+        chain: Chain,
+        action: Optional[str] = None,
+        start_block: Optional[int] = None,
+        end_block: Optional[int] = None,
+        where: Optional[Callable[[Dict], bool]] = None) -> Iterator[Dict]:
+        """Stream index entries of a service and chain in fetch order
+
+        :param action: only entries of this action
+        :param start_block: only entries covering blocks from here on, entries without range are kept
+        :param end_block: only entries covering blocks up to here, entries without range are kept
+        :param where: extra predicate on the entry
+        """
+        index_path = self.index_path(service, chain)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "r") as fp:
+            for line in fp:
+                entry = json.loads(line)
+                if action is not None and entry["action"] != action:
+                    continue
+                if start_block is not None and entry["to_block"] is not None and entry["to_block"] < start_block:
+                    continue
+                if end_block is not None and entry["from_block"] is not None and entry["from_block"] > end_block:
+                    continue
+                if where is not None and not where(entry):
+                    continue
+                yield entry
+
+    def responses(self, service: str, chain: Chain, **kwargs) -> Iterator[Tuple[Dict, Any]]:
+        """Stream `(entry, response)` pairs, see `entries` for filters"""
+        for entry in self.entries(service, chain, **kwargs):
+            yield entry, self.get(entry["digest"])
+
+    @staticmethod
+    def block_range(result: Any) -> Tuple[Optional[int], Optional[int]]:
+        """Block range of an explorer page of rows, or of RPC results (logs, a receipt, a block)"""
+        def to_int(block: Union[int, str]) -> int:
+            # explorer rows have decimal strings, RPC results hex
+            return int(block, 16) if isinstance(block, str) and block.startswith("0x") else int(block)
+
+        if isinstance(result, dict):
+            result = [result]
+        if not isinstance(result, list):
+            return None, None
+        # receipts and logs have `blockNumber`, blocks have `number`
+        blocks = [
+            to_int(row.get("blockNumber", row.get("number"))) for row in result
+            if isinstance(row, dict) and row.get("blockNumber", row.get("number")) is not None
+        ]
+        return (min(blocks), max(blocks)) if blocks else (None, None)
+
+
+# process-wide archive, disabled unless enabled
+archive = ResponseArchive()
+
+
+def rpc_archive_middleware(chain: str, endpoint: str) -> Callable:
+    """web3 middleware archiving every successful JSON-RPC response of a provider"""
+    def middleware(make_request, w3):
+        def record(method, params):
+            response = make_request(method, params)
+            if archive.enabled and "error" not in response:
+                archive.put(
+                    "rpc", chain, endpoint, method, {"params": params}, response.get("result"),
+                    block_range=ResponseArchive.block_range(response.get("result")))
+            return response
+        return record
+    return middleware
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, List, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from api.archive import rpc_archive_middleware
+from api.constant import Chain
+from api.metrics import rpc_metrics_middleware
+from api.retry import rpc_retry_middleware
+
+if TYPE_CHECKING:
+    from web3 import Web3
+    from web3.contract import Contract
+
+
+class ClientRegistry(object):
+    """
+    Per-process cache of parsed ABIs, pooled HTTP sessions, Web3 providers
+    and contract objects, so workers don't rebuild them for every task.
+
+    The registry is cleared in forked children as sessions must not be
+    shared across processes. web3 is only imported once a provider is built.
+    """
+
+    def __init__(self, pool_size: int = 64) -> None:
+        """
+        :param pool_size: max pooled connections per host
+        """
+        self.pool_size = pool_size
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self) -> None:
+        self._lock = threading.RLock()
+        self.abis: Dict[str, List[dict]] = {}
+        self.sessions: Dict[str, requests.Session] = {}
+        self.providers: Dict[Tuple[Chain, str], Web3] = {}
+        self.contracts: Dict[Tuple[Chain, str, str], Contract] = {}
+        self.decoders: Dict[Tuple[str, str], Tuple[List[str], List[str]]] = {}
+        self.shared: Dict[Hashable, Any] = {}
+
+    def get_shared(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Instance built once per process by `factory`, e.g. a `ScanAPI` per chain"""
+        instance = self.shared.get(key)
+        if instance is None:
+            with self._lock:
+                if key not in self.shared:
+                    self.shared[key] = factory()
+                instance = self.shared[key]
+        return instance
+
+    def get_abi(self, abi_path: str) -> List[dict]:
+        """Parsed ABI, shared between callers so it must not be mutated"""
+        abi_path = os.path.abspath(abi_path)
+        abi = self.abis.get(abi_path)
+        if abi is None:
+            with self._lock:
+                if abi_path not in self.abis:
+                    with open(abi_path, "r") as fp:
+                        self.abis[abi_path] = json.load(fp)
+                abi = self.abis[abi_path]
+        return abi
+
+    def get_session(self, url: str) -> requests.Session:
+        """Keep-alive session with a connection pool per host"""
+        host = urlparse(url).netloc
+        session = self.sessions.get(host)
+        if session is None:
+            with self._lock:
+                if host not in self.sessions:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self.sessions[host] = session
+                session = self.sessions[host]
+        return session
+
+    def get_provider(self, chain: Chain, url: str) -> Web3:
+        """Web3 over a pooled session, with request metrics, response archiving and retries"""
+        key = (chain, url)
+        provider = self.providers.get(key)
+        if provider is None:
+            from web3 import HTTPProvider, Web3
+
+            with self._lock:
+                if key not in self.providers:
+                    http_provider = HTTPProvider(url, session=self.get_session(url))
+                    # retried with backoff by `rpc_retry_middleware` instead
+                    http_provider.middlewares = []
+                    provider = Web3(http_provider)
+                    provider.middleware_onion.add(rpc_metrics_middleware(chain, urlparse(url).netloc), "metrics")
+                    # innermost, to archive raw responses before web3 formatting
+                    provider.middleware_onion.inject(
+                        rpc_archive_middleware(chain, urlparse(url).netloc), "archive", layer=0)
+                    provider.middleware_onion.inject(rpc_retry_middleware(chain, url), "retry", layer=0)
+                    self.providers[key] = provider
+                provider = self.providers[key]
+        return provider
+
+    def get_contract(self, chain: Chain, address: str, abi_path: str, provider: Web3) -> Contract:
+        key = (chain, address, os.path.abspath(abi_path))
+        contract = self.contracts.get(key)
+        if contract is None:
+            with self._lock:
+                if key not in self.contracts:
+                    self.contracts[key] = provider.eth.contract(address, abi=self.get_abi(abi_path))
+                contract = self.contracts[key]
+        return contract
+
+    def get_decoder(self, contract: Contract, abi_path: str, selector: str) -> Tuple[List[str], List[str]]:
+        """Input names and types of the function matching a 4-byte selector"""
+        key = (os.path.abspath(abi_path), selector)
+        decoder = self.decoders.get(key)
+        if decoder is None:
+            from web3._utils.abi import get_abi_input_names, get_abi_input_types
+
+            # raises ValueError for unknown selectors, e.g. contract creation
+            func = contract.get_function_by_selector(selector)
+            decoder = (get_abi_input_names(func.abi), get_abi_input_types(func.abi))
+            with self._lock:
+                self.decoders[key] = decoder
+        return decoder
+
+
+# process-wide registry
+clients = ClientRegistry()
+os.register_at_fork(after_in_child=clients.clear)
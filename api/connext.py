@@ -1,14 +1,28 @@
+from __future__ import annotations
+
 import json
 import logging
-import multiprocessing as mp
 import os
-from glob import glob
-from typing import Dict, List
+from functools import partial
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
 
-from api.constant import Chain, DiamondContract
+from api.archive import ResponseArchive
+from api.constant import Chain, ConfirmationDepth, DiamondContract
+from api.dedup import DedupIndex
+from api.executor import Executor
+from api.log_scanner import LogScanner
+from api.profiling import stage
+from api.receipt_queue import PendingReceiptQueue
+from api.replay import ArchiveReplay
 from api.scan import ScanAPI, ScanTxn
+from api.store import TxnStore
 from api.subgraph import ConnextSubgraph
 from api.token import Token
+from api.watchlist import Watch, Watchlist, WatchState
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
 
 
 class ConnextAPI(object):
@@ -18,23 +32,27 @@ class ConnextAPI(object):
 
     def __init__(
         self, 
-        data_dir: str = "data",) -> None:
+        data_dir: str = "data",
+        confirmations: Optional[Dict[Chain, int]] = None,
+        watchlist: Optional[Watchlist] = None) -> None:
         """
         :param data_dir: directory to store cache
-        :param config_path: path to config file
+        :param confirmations: blocks re-fetched per chain on every run,
+            defaults to `ConfirmationDepth`
+        :param watchlist: addresses to fetch transactions of, only `transactions`
+            watches are used, defaults to `ConnextAPI.default_watchlist`
         """
         self.data_dir = data_dir
-        self.scan_api = {
-            Chain.ETHEREUM: ScanAPI(Chain.ETHEREUM),
-            Chain.BNB_CHAIN: ScanAPI(Chain.BNB_CHAIN),
-            Chain.POLYGON: ScanAPI(Chain.POLYGON),
-            Chain.OPTIMISM: ScanAPI(Chain.OPTIMISM),
-            Chain.GNOSIS: ScanAPI(Chain.GNOSIS),
-            Chain.ARBITRUM_ONE: ScanAPI(Chain.ARBITRUM_ONE),
-        }
+        self.confirmations = confirmations or {}
+        self.watchlist = (watchlist if watchlist is not None else ConnextAPI.default_watchlist()).select(kind=Watch.TRANSACTIONS)
+        self.scan_api = {chain: ScanAPI.shared(chain) for chain in self.watchlist.chains()}
         self.graphs = {
             chain: ConnextSubgraph(chain) for chain in self.scan_api.keys()
         }
+        self.store = TxnStore(f"{self.data_dir}/amarok_txs")
+        self.receipt_queue = PendingReceiptQueue(f"{self.data_dir}/pending_receipts/amarok_txs")
+        self.dedup = DedupIndex(f"{self.data_dir}/dedup/amarok_txs")
+        self.watch_state = WatchState(f"{self.data_dir}/watchlist/amarok_txs.json")
 
     @staticmethod
     def get_init_block(chain: Chain = Chain.ETHEREUM) -> int:
@@ -54,83 +72,275 @@ class ConnextAPI(object):
         else:
             raise ValueError(f"Invalid chain {chain}")
 
+    @staticmethod
+    def default_watchlist() -> Watchlist:
+        """Connext Diamond of every chain, from its deployment block"""
+        return Watchlist([
+            Watch(
+                chain, DiamondContract.get_contract_address(chain), Watch.TRANSACTIONS,
+                start_block=ConnextAPI.get_init_block(chain), name="connext_diamond", tenant="connext")
+            for chain in [
+                Chain.ETHEREUM, Chain.BNB_CHAIN, Chain.POLYGON, Chain.OPTIMISM, Chain.GNOSIS, Chain.ARBITRUM_ONE]
+        ])
+
     def load_cache(self) -> Dict[Chain, List[ScanTxn]]:
         """Load cache from data directory"""
         logging.info("Loading cache")
-        data_path = f"{self.data_dir}/amarok_txs"
-        if not os.path.exists(data_path):
+        if not os.path.exists(self.store.data_path):
             # create empty cache
             logging.info("Cache not found, creating empty cache")
             return {chain: [] for chain in self.scan_api.keys()}
         else:
-            # load cache
+            # load cache, sorted by block number
             logging.info("Cache found, loading cache")
-            data = {chain: [] for chain in self.scan_api.keys()}
-            for chain in self.scan_api.keys():
-                for tx in os.listdir(f"{data_path}/{chain}"):
-                    with open(f"{data_path}/{chain}/{tx}", "r") as fp:
-                        # logging.debug(f"Loading {tx} from `{data_path}/{chain}/{tx}`")
-                        data[chain].append(ScanTxn(**json.load(fp)))
-            # sort by block number
-            data = {chain: sorted(data[chain], key=lambda x: x.blockNumber) for chain in data.keys()}
-            return data
+            with stage("load"):
+                return {chain: list(self.store.iter_txs(chain)) for chain in self.scan_api.keys()}
 
     def save_cache(self, data: Dict[Chain, List[ScanTxn]]) -> None:
         """Save cache to data directory"""
         data = data.copy()
         logging.info("Saving cache")
-        data_path = f"{self.data_dir}/amarok_txs"
-        # convert to dict
         for chain in data.keys():
+            with stage("save"):
+                self.store.save(chain, data[chain])
             for tx in data[chain]:
-                save_path = f"{data_path}/{chain}/{tx.hash}.json"
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                with open(save_path, "w") as fp:
-                    json.dump(tx.to_json(), fp, indent=4)
+                if tx.logs is None:
+                    self.receipt_queue.push(chain, TxnStore.tx_key(tx))
+
+    def get_pending_receipts(self) -> List[str]:
+        """Get paths of cached transactions that haven't had their receipt resolved"""
+        if not self.receipt_queue.exists():
+            self.receipt_queue.rebuild(self.store.data_path)
+        self.receipt_queue.recover()
+        return [self.store.tx_path(chain, key) for chain, key in self.receipt_queue.pending()]
+
+    def iter_txs(
+        self,
+        chain: Chain,
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None) -> Iterator[ScanTxn]:
+        """Stream cached transactions of a chain in block order without loading the whole cache
+
+        :param chain: chain to read
+        :param start_block: first block to include
+        :param end_block: last block to include, None for no upper bound
+        :param function_names: only include these function names, e.g. `["xcall"]`
+        """
+        return self.store.iter_txs(chain, start_block, end_block, function_names)
+
+    def to_frame(
+        self,
+        chains: Optional[List[Chain]] = None,
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None,
+        engine: str = "pandas") -> Union[pd.DataFrame, pa.Table]:
+        """Build a compact typed table of cached transactions, see `TxnStore.to_frame`
+
+        :param chains: chains to include, defaults to all supported chains
+        :param engine: `pandas` or `arrow`
+        """
+        if chains is None:
+            chains = list(self.scan_api.keys())
+        return self.store.to_frame(chains, start_block, end_block, function_names, engine)
 
     @staticmethod
-    def resolve_receipt(tx_path: str) -> bool:
-        """Resolve transaction receipt"""
-        tx = ScanTxn.from_json(tx_path)
+    def resolve_receipt(tx_path: str, queue: Optional[PendingReceiptQueue] = None) -> bool:
+        """Resolve transaction receipt
 
-        if tx.logs is not None:
-            logging.debug(f"Transaction {tx.hash} already resolved, skipping")
+        :param tx_path: path to cached transaction
+        :param queue: pending receipt queue to claim the transaction from, if any
+        """
+        chain = os.path.basename(os.path.dirname(tx_path))
+        key = os.path.splitext(os.path.basename(tx_path))[0]
+        if queue is not None and not queue.claim(chain, key):
+            logging.debug(f"Transaction {key} claimed by another worker, skipping")
             return False
 
-        logging.debug(f"Resolving transaction {tx.hash}")
-        receipt = ScanAPI(tx.chain, apikey_schedule="random").get_transaction_receipt(
-            tx.hash, timeout=10, max_attempt=10, wait_time=1)
-        if isinstance(receipt, str):
-            raise TypeError(f"Error resolving transaction {tx.hash}: {receipt}")
-        logs = receipt["logs"]
-        tx.logs = logs
+        try:
+            tx = ScanTxn.from_json(tx_path)
 
-        with open(tx_path, "w") as fp:
-            json.dump(tx.to_json(), fp, indent=4)
+            if tx.logs is not None:
+                logging.debug(f"Transaction {tx.hash} already resolved, skipping")
+                resolved = False
+            else:
+                logging.debug(f"Resolving transaction {tx.hash}")
+                with stage("receipt"):
+                    receipt = ScanAPI.shared(tx.chain, apikey_schedule="random").get_transaction_receipt(
+                        tx.hash, timeout=10)
+                if isinstance(receipt, str):
+                    raise TypeError(f"Error resolving transaction {tx.hash}: {receipt}")
+                logs = receipt["logs"]
+                tx.logs = logs
 
-        return True
+                with open(tx_path, "w") as fp:
+                    json.dump(tx.to_json(), fp, indent=4)
+                # logs changed, e.g. `LPSupplyIndex` series must be rebuilt
+                TxnStore(os.path.dirname(os.path.dirname(tx_path))).touch(chain)
+                resolved = True
+        except Exception:
+            if queue is not None:
+                queue.release(chain, key)
+            raise
 
-    def load_txs(self) -> Dict[Chain, List[ScanTxn]]:
-        """Load transactions from scan API"""
-        data = self.load_cache()
-        # get latest block number
-        latest_block = {
-            chain: max([tx.blockNumber for tx in data[chain]]) + 1 if data[chain] else 0
+        if queue is not None:
+            queue.complete(chain, key)
+        return resolved
+
+    def get_tail_start(self, chain: Chain, cached: List[ScanTxn]) -> int:
+        """First block to re-fetch, the last confirmation-depth blocks of the cache"""
+        if not cached:
+            return 0
+        depth = self.confirmations.get(chain, ConfirmationDepth.get_depth(chain))
+        return max(0, max(tx.blockNumber for tx in cached) + 1 - depth)
+
+    def get_fetch_start(self, data: Dict[Chain, List[ScanTxn]]) -> Dict[Chain, Dict[str, int]]:
+        """First block to fetch per watch key of each chain, the cache tail or the start of newly added watches"""
+        if self.watch_state.exists():
+            synced = self.watch_state.load()
+        else:
+            synced = self.watch_state.rebuild(self.watchlist, data)
+        return {
+            chain: self.watchlist.fetch_starts(chain, self.get_tail_start(chain, data[chain]), synced.get(chain, set()))
             for chain in self.scan_api.keys()
         }
 
+    @staticmethod
+    def get_reorged_out(chain: Chain, cached: List[ScanTxn], fetched: List[ScanTxn], missing: List[str]) -> List[str]:
+        """Row keys of cached transactions missing from a re-fetch whose block was verifiably replaced
+
+        An empty, lagging or truncated explorer response also misses transactions,
+        so a missing transaction is only dropped if the canonical block at its
+        height now has another hash. Nothing is dropped when the re-fetch came
+        back empty or the block can't be checked.
+
+        :param cached: cached transactions of the chain
+        :param fetched: transactions re-fetched from the tail start
+        :param missing: row keys cached from the tail start on that weren't re-fetched, see `TxnStore.key`
+        """
+        if not missing:
+            return []
+        if not fetched:
+            logging.warning(f"Re-fetch of {chain} came back empty, keeping {len(missing)} cached transactions")
+            return []
+
+        from api.contract import SmartContract
+
+        provider = SmartContract.get_default_provider(chain)
+        missing = set(missing)
+        canonical: Dict[int, Optional[str]] = {}
+        reorged = []
+        for tx in cached:
+            key = TxnStore.tx_key(tx)
+            if key not in missing:
+                continue
+            if tx.blockNumber not in canonical:
+                try:
+                    canonical[tx.blockNumber] = provider.toHex(provider.eth.get_block(tx.blockNumber)["hash"]).lower()
+                except Exception as e:
+                    logging.warning(f"Can't verify block {tx.blockNumber} on {chain}, keeping its transactions: {e}")
+                    canonical[tx.blockNumber] = None
+            block_hash = canonical[tx.blockNumber]
+            if block_hash is not None and tx.blockHash and block_hash != tx.blockHash.lower():
+                reorged.append(key)
+        if len(reorged) < len(missing):
+            logging.info(f"Keeping {len(missing) - len(reorged)} transactions on {chain} missing from the re-fetch in canonical blocks")
+        return reorged
+
+    def refresh_tail(
+        self,
+        chain: Chain,
+        cached: List[ScanTxn],
+        fetched: List[ScanTxn],
+        start_block: int) -> Tuple[List[ScanTxn], List[ScanTxn]]:
+        """Reconcile re-fetched transactions from `start_block` on with the cache
+
+        Transactions fetched below `start_block`, backfilled for new watches,
+        are only added if they aren't cached yet.
+
+        Reorged-out transactions are deleted (see `get_reorged_out`), transactions
+        that moved to another block are replaced and have their receipt resolved again.
+
+        :return: updated transactions of the chain, and the ones to save
+        """
+        # cached transactions of addresses no longer watched aren't re-fetched, keep them
+        new, changed, removed = self.store.diff_tail(
+            chain, fetched, start_block, where=partial(self.watchlist.matches, chain))
+        removed = ConnextAPI.get_reorged_out(chain, cached, fetched, removed)
+        new = self.dedup.filter_new(chain, new)
+        if removed:
+            logging.info(f"Removing {len(removed)} reorged transactions on {chain}")
+            self.store.delete(chain, removed)
+            self.dedup.remove(DedupIndex.row_key(chain, key) for key in removed)
+            for key in removed:
+                self.receipt_queue.discard(chain, key)
+        if changed:
+            logging.info(f"Replacing {len(changed)} reorged transactions on {chain}")
+        dropped = set(removed) | {TxnStore.tx_key(tx) for tx in changed}
+        updated = [tx for tx in cached if TxnStore.tx_key(tx) not in dropped] + changed + new
+        return sorted(updated, key=lambda x: x.blockNumber), changed + new
+
+    def replay(self, archive: ResponseArchive) -> Dict[Chain, List[ScanTxn]]:
+        """Rebuild the cache from archived explorer responses, see `ArchiveReplay`
+
+        Archived transactions overwrite cached ones, replay into an empty
+        `data_dir` to re-derive the whole cache.
+        """
+        replay = ArchiveReplay(archive)
+        data = {
+            chain: self.watchlist.filter(chain, list({
+                tx.hash: tx for address in self.watchlist.addresses(chain)
+                for tx in replay.transactions(scan_api, address)}.values()))
+            for chain, scan_api in self.scan_api.items()
+        }
+        self.save_cache(data)
+        if self.dedup.exists():
+            for chain in data.keys():
+                self.dedup.add_txs(chain, data[chain])
+        return data
+
+    def fetch_watches(self, chain: Chain, starts: Dict[str, int]) -> List[ScanTxn]:
+        """Transactions of every watched address of a chain, each from its start block
+
+        Explorer `txlist` takes a single address, so each watch costs one scan.
+
+        :param starts: first block to fetch per watch key, see `get_fetch_start`
+        """
+        txs = []
+        for watch in self.watchlist.get(chain):
+            txs.extend(self.scan_api[chain].get_transaction_by_address(watch.address, startblock=starts[watch.key]))
+        return self.watchlist.filter(chain, txs)
+
+    def load_txs(
+        self,
+        executor: str = Executor.DEFAULT_MODE,
+        num_workers: int = Executor.DEFAULT_NUM_WORKERS) -> Dict[Chain, List[ScanTxn]]:
+        """Load transactions from scan API
+
+        :param executor: concurrency backend for receipt resolution (thread|async|process)
+        :param num_workers: number of concurrent receipt workers
+        """
+        data = self.load_cache()
+        # re-fetch the unconfirmed tail of the cache, and new watches from their start
+        tail_start = {chain: self.get_tail_start(chain, data[chain]) for chain in self.scan_api.keys()}
+        starts = self.get_fetch_start(data)
+
         # verbose logging
         for chain in self.scan_api.keys():
-            logging.info(f"Latest block number on {chain}: {latest_block[chain]}")
+            n_backfill = sum(start < tail_start[chain] for start in starts[chain].values())
+            logging.info(f"Re-fetching {chain} from block number {tail_start[chain]}, backfilling {n_backfill} new watches")
 
         # load transactions from scan API
         logging.info("Loading transactions from scan API")
-        amarok_txs = {
-            chain: self.scan_api[chain].get_transaction_by_address(
-                DiamondContract.get_contract_address(chain), 
-                startblock=latest_block[chain])
-            for chain in [
-                Chain.ETHEREUM, Chain.POLYGON, Chain.ARBITRUM_ONE, Chain.GNOSIS, Chain.BNB_CHAIN, Chain.OPTIMISM]}
+        amarok_txs = {chain: self.fetch_watches(chain, starts[chain]) for chain in self.scan_api.keys()}
+
+        # diff against cache, only new and reorged transactions are saved
+        if not self.dedup.exists():
+            self.dedup.rebuild(self.store, list(self.scan_api.keys()))
+        for chain in self.scan_api.keys():
+            data[chain], amarok_txs[chain] = self.refresh_tail(
+                chain, data[chain], amarok_txs[chain], tail_start[chain])
 
         # if no new transactions, return cache
         for chain in self.scan_api.keys():
@@ -139,95 +349,246 @@ class ConnextAPI(object):
         if all([len(amarok_txs[chain]) == 0 for chain in self.scan_api.keys()]):
             logging.info("No new transactions, returning cache")
         else:
-            # update cache
+            # save cache
             logging.info("Updating cache")
+            self.save_cache(amarok_txs)
             for chain in self.scan_api.keys():
-                data[chain] += amarok_txs[chain]
+                self.dedup.add_txs(chain, amarok_txs[chain])
+        self.watch_state.save({chain: {watch.key for watch in self.watchlist.get(chain)} for chain in self.scan_api.keys()})
 
-            # sort by block number
-            for chain in self.scan_api.keys():
-                data[chain] = sorted(data[chain], key=lambda x: x.blockNumber)
-
-            # save cache
-            self.save_cache(data)
-
-        # multiprocessing resolve receipt
+        # concurrently resolve receipt
         logging.info("Resolving receipt")
-        # create cache files
-        cache_files = []
-        for json_path in sorted(glob(f"{self.data_dir}/amarok_txs/**/*.json")):
-            tx = ScanTxn.from_json(json_path)
-            if tx.logs is None:
-                cache_files.append(json_path)
-        # start multiprocessing
-        with mp.Pool(12) as pool:
-            pool.map(ConnextAPI.resolve_receipt, cache_files)
+        cache_files = self.get_pending_receipts()
+        Executor(executor, num_workers).map(
+            partial(ConnextAPI.resolve_receipt, queue=self.receipt_queue), cache_files)
 
         return data
     
 
 class ConnextLPTransferAPI(object):
 
-    def __init__(self, data_dir: str = "data"):
+    def __init__(
+        self,
+        data_dir: str = "data",
+        confirmations: Optional[Dict[Chain, int]] = None,
+        watchlist: Optional[Watchlist] = None):
+        """
+        :param data_dir: directory to store cache
+        :param confirmations: blocks re-fetched per chain on every run,
+            defaults to `ConfirmationDepth`
+        :param watchlist: tokens to fetch transfers of, only `transfers` watches
+            are used, defaults to `ConnextLPTransferAPI.default_watchlist`
+        """
         self.data_dir = data_dir
-        self.scan_api = {
-            Chain.BNB_CHAIN: ScanAPI(Chain.BNB_CHAIN),
-            Chain.POLYGON: ScanAPI(Chain.POLYGON),
-            Chain.OPTIMISM: ScanAPI(Chain.OPTIMISM),
-            Chain.GNOSIS: ScanAPI(Chain.GNOSIS),
-            Chain.ARBITRUM_ONE: ScanAPI(Chain.ARBITRUM_ONE),
-        }
+        self.confirmations = confirmations or {}
+        self.watchlist = (watchlist if watchlist is not None else ConnextLPTransferAPI.default_watchlist()).select(kind=Watch.TRANSFERS)
+        self.scan_api = {chain: ScanAPI.shared(chain) for chain in self.watchlist.chains()}
+        self.store = TxnStore(f"{self.data_dir}/lp_transfer_txs")
+        self.receipt_queue = PendingReceiptQueue(f"{self.data_dir}/pending_receipts/lp_transfer_txs")
+        self.dedup = DedupIndex(f"{self.data_dir}/dedup/lp_transfer_txs")
+        self.watch_state = WatchState(f"{self.data_dir}/watchlist/lp_transfer_txs.json")
+
+    @staticmethod
+    def default_watchlist() -> Watchlist:
+        """USDC and WETH LP tokens of every chain with Connext pools, from the Diamond deployment block"""
+        return Watchlist([
+            Watch(
+                chain, Token.get_lp(chain, token).address, Watch.TRANSFERS,
+                start_block=ConnextAPI.get_init_block(chain), name=f"{token}_lp", tenant="connext")
+            for chain in [Chain.BNB_CHAIN, Chain.POLYGON, Chain.OPTIMISM, Chain.GNOSIS, Chain.ARBITRUM_ONE]
+            for token in [Token.USDC, Token.WETH]
+        ])
 
     def load_cache(self) -> Dict[Chain, List[ScanTxn]]:
         """Load cache from data directory"""
         logging.info("Loading cache")
-        data_path = f"{self.data_dir}/lp_transfer_txs"
-        if not os.path.exists(data_path):
+        if not os.path.exists(self.store.data_path):
             # create empty cache
             logging.info("Cache not found, creating empty cache")
             return {chain: [] for chain in self.scan_api.keys()}
         else:
-            # load cache
+            # load cache, sorted by block number
             logging.info("Cache found, loading cache")
-            data = {chain: [] for chain in self.scan_api.keys()}
-            for chain in self.scan_api.keys():
-                for tx in os.listdir(f"{data_path}/{chain}"):
-                    with open(f"{data_path}/{chain}/{tx}", "r") as fp:
-                        # logging.debug(f"Loading {tx} from `{data_path}/{chain}/{tx}`")
-                        data[chain].append(ScanTxn(**json.load(fp)))
-            # sort by block number
-            data = {chain: sorted(data[chain], key=lambda x: x.blockNumber) for chain in data.keys()}
-            return data
+            with stage("load"):
+                return {chain: list(self.store.iter_txs(chain)) for chain in self.scan_api.keys()}
         
     def save_cache(self, data: Dict[Chain, List[ScanTxn]]) -> None:
         """Save cache to data directory"""
         data = data.copy()
         logging.info("Saving cache")
-        data_path = f"{self.data_dir}/lp_transfer_txs"
-        # convert to dict
         for chain in data.keys():
+            with stage("save"):
+                self.store.save(chain, data[chain])
             for tx in data[chain]:
-                save_path = f"{data_path}/{chain}/{tx.hash}.json"
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                with open(save_path, "w") as fp:
-                    json.dump(tx.to_json(), fp, indent=4)
+                if tx.logs is None:
+                    self.receipt_queue.push(chain, TxnStore.tx_key(tx))
     
-    def load_transfers(self) -> Dict[Chain, List[ScanTxn]]:
-        """Load transfers from scan API"""
-        data = self.load_cache()
-        # get latest block number
-        latest_block = {
-            chain: max([tx.blockNumber for tx in data[chain]]) + 1 if data[chain] else 0
+    def get_pending_receipts(self) -> List[str]:
+        """Get paths of cached transfers that haven't had their receipt resolved"""
+        if not self.receipt_queue.exists():
+            self.receipt_queue.rebuild(self.store.data_path)
+        self.receipt_queue.recover()
+        return [self.store.tx_path(chain, key) for chain, key in self.receipt_queue.pending()]
+
+    def iter_txs(
+        self,
+        chain: Chain,
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None) -> Iterator[ScanTxn]:
+        """Stream cached transactions of a chain in block order without loading the whole cache
+
+        :param chain: chain to read
+        :param start_block: first block to include
+        :param end_block: last block to include, None for no upper bound
+        :param function_names: only include these function names, e.g. `["xcall"]`
+        """
+        return self.store.iter_txs(chain, start_block, end_block, function_names)
+
+    def to_frame(
+        self,
+        chains: Optional[List[Chain]] = None,
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None,
+        engine: str = "pandas") -> Union[pd.DataFrame, pa.Table]:
+        """Build a compact typed table of cached transactions, see `TxnStore.to_frame`
+
+        :param chains: chains to include, defaults to all supported chains
+        :param engine: `pandas` or `arrow`
+        """
+        if chains is None:
+            chains = list(self.scan_api.keys())
+        return self.store.to_frame(chains, start_block, end_block, function_names, engine)
+
+    def get_tail_start(self, chain: Chain, cached: List[ScanTxn]) -> int:
+        """First block to re-fetch, the last confirmation-depth blocks of the cache"""
+        if not cached:
+            return 0
+        depth = self.confirmations.get(chain, ConfirmationDepth.get_depth(chain))
+        return max(0, max(tx.blockNumber for tx in cached) + 1 - depth)
+
+    def get_fetch_start(self, data: Dict[Chain, List[ScanTxn]]) -> Dict[Chain, Dict[str, int]]:
+        """First block to fetch per watch key of each chain, the cache tail or the start of newly added watches"""
+        if self.watch_state.exists():
+            synced = self.watch_state.load()
+        else:
+            synced = self.watch_state.rebuild(self.watchlist, data)
+        return {
+            chain: self.watchlist.fetch_starts(chain, self.get_tail_start(chain, data[chain]), synced.get(chain, set()))
             for chain in self.scan_api.keys()
         }
 
-        amarok_transfer = {chain: [] for chain in self.scan_api.keys()}
+    def refresh_tail(
+        self,
+        chain: Chain,
+        cached: List[ScanTxn],
+        fetched: List[ScanTxn],
+        start_block: int) -> Tuple[List[ScanTxn], List[ScanTxn]]:
+        """Reconcile re-fetched transactions from `start_block` on with the cache
+
+        Transactions fetched below `start_block`, backfilled for new watches,
+        are only added if they aren't cached yet.
+
+        Reorged-out transactions are deleted (see `get_reorged_out`), transactions
+        that moved to another block are replaced and have their receipt resolved again.
+
+        :return: updated transactions of the chain, and the ones to save
+        """
+        # cached transactions of addresses no longer watched aren't re-fetched, keep them
+        new, changed, removed = self.store.diff_tail(
+            chain, fetched, start_block, where=partial(self.watchlist.matches, chain))
+        removed = ConnextAPI.get_reorged_out(chain, cached, fetched, removed)
+        new = self.dedup.filter_new(chain, new)
+        if removed:
+            logging.info(f"Removing {len(removed)} reorged transactions on {chain}")
+            self.store.delete(chain, removed)
+            self.dedup.remove(DedupIndex.row_key(chain, key) for key in removed)
+            for key in removed:
+                self.receipt_queue.discard(chain, key)
+        if changed:
+            logging.info(f"Replacing {len(changed)} reorged transactions on {chain}")
+        dropped = set(removed) | {TxnStore.tx_key(tx) for tx in changed}
+        updated = [tx for tx in cached if TxnStore.tx_key(tx) not in dropped] + changed + new
+        return sorted(updated, key=lambda x: x.blockNumber), changed + new
+
+    def replay(self, archive: ResponseArchive) -> Dict[Chain, List[ScanTxn]]:
+        """Rebuild the cache from archived explorer responses, see `ArchiveReplay`
+
+        Archived transfers overwrite cached ones, replay into an empty
+        `data_dir` to re-derive the whole cache.
+        """
+        replay = ArchiveReplay(archive)
+        data = {
+            chain: self.watchlist.filter(chain, replay.transfers(scan_api, self.watchlist.addresses(chain)))
+            for chain, scan_api in self.scan_api.items()
+        }
+        self.save_cache(data)
+        if self.dedup.exists():
+            for chain in data.keys():
+                self.dedup.add_txs(chain, data[chain])
+        return data
+
+    def fetch_watches(self, chain: Chain, starts: Dict[str, int], source: Optional[str] = None) -> List[ScanTxn]:
+        """Transfers of every watched token of a chain, each from its start block
+
+        With `rpc`, tokens with the same start block are scanned in a single pass
+        over shared `eth_getLogs` windows, so more watched tokens cost no more requests.
+        Explorer `tokentx` takes a single token, so each watch costs one scan.
+
+        :param starts: first block to fetch per watch key, see `get_fetch_start`
+        :param source: `explorer` or `rpc`, None for `rpc` on chains with several
+            watched tokens and `explorer` otherwise
+        """
+        watches = self.watchlist.get(chain)
+        if source is None:
+            source = "rpc" if len(watches) > 1 else "explorer"
+        if source == "rpc":
+            addresses: Dict[int, Dict[str, str]] = {}
+            for watch in watches:
+                addresses.setdefault(starts[watch.key], {})[watch.address.lower()] = watch.address
+            scanner = LogScanner(chain)
+            rows = []
+            for start_block, group in sorted(addresses.items()):
+                rows.extend(scanner.get_transfer_rows(list(group.values()), start_block))
+            transfers = self.scan_api[chain].parse_transfer_events(rows)
+        else:
+            transfers = []
+            for watch in watches:
+                transfers.extend(self.scan_api[chain].get_transfer_events(
+                    token_address=watch.address, startblock=starts[watch.key]))
+        return self.watchlist.filter(chain, transfers)
+
+    def load_transfers(
+        self,
+        executor: str = Executor.DEFAULT_MODE,
+        num_workers: int = Executor.DEFAULT_NUM_WORKERS,
+        source: Optional[str] = None) -> Dict[Chain, List[ScanTxn]]:
+        """Load transfers from scan API
+
+        :param executor: concurrency backend for receipt resolution (thread|async|process)
+        :param num_workers: number of concurrent receipt workers
+        :param source: `explorer` to paginate `tokentx` once per token, or `rpc` to scan
+            `eth_getLogs` of the default providers once for all tokens, see `LogScanner`.
+            None picks `rpc` on chains with several watched tokens, see `fetch_watches`
+        """
+        if source not in [None, "explorer", "rpc"]:
+            raise ValueError(f"Unknown source {source}, only explorer|rpc")
+
+        data = self.load_cache()
+        # re-fetch the unconfirmed tail of the cache, and new watches from their start
+        tail_start = {chain: self.get_tail_start(chain, data[chain]) for chain in self.scan_api.keys()}
+        starts = self.get_fetch_start(data)
+
+        amarok_transfer = {
+            chain: self.fetch_watches(chain, starts[chain], source) for chain in self.scan_api.keys()}
+
+        # diff against cache, the same tx can move both LP tokens
+        if not self.dedup.exists():
+            self.dedup.rebuild(self.store, list(self.scan_api.keys()))
         for chain in self.scan_api.keys():
-            for token in [Token.USDC, Token.WETH]:
-                token_address = Token.get_lp(chain, token).address
-                amarok_transfer[chain].extend(self.scan_api[chain].get_transfer_events(
-                    token_address=token_address, 
-                    startblock=latest_block[chain]))
+            data[chain], amarok_transfer[chain] = self.refresh_tail(
+                chain, data[chain], amarok_transfer[chain], tail_start[chain])
 
         # if no new transactions, return cache
         for chain in self.scan_api.keys():
@@ -236,31 +597,20 @@ class ConnextLPTransferAPI(object):
         if all([len(amarok_transfer[chain]) == 0 for chain in self.scan_api.keys()]):
             logging.info("No new transfers, returning cache")
         else:
-            # update cache
+            # save cache
             logging.info("Updating cache")
+            self.save_cache(amarok_transfer)
             for chain in self.scan_api.keys():
-                data[chain] += amarok_transfer[chain]
-
-            # sort by block number
-            for chain in self.scan_api.keys():
-                data[chain] = sorted(data[chain], key=lambda x: x.blockNumber)
-
-            # save cache
-            self.save_cache(data)
+                self.dedup.add_txs(chain, amarok_transfer[chain])
+        self.watch_state.save({chain: {watch.key for watch in self.watchlist.get(chain)} for chain in self.scan_api.keys()})
             
-        # multiprocessing resolve receipt
+        # concurrently resolve receipt
         logging.info("Resolving receipt")
-        # create cache files
-        cache_files = []
-        for json_path in sorted(glob(f"{self.data_dir}/lp_transfer_txs/**/*.json")):
-            tx = ScanTxn.from_json(json_path)
-            if tx.logs is None:
-                cache_files.append(json_path)
+        cache_files = self.get_pending_receipts()
                 
         print(f"Resolving {len(cache_files)} txs")
-        # start multiprocessing
-        with mp.Pool(12) as pool:
-            pool.map(ConnextAPI.resolve_receipt, cache_files)
+        Executor(executor, num_workers).map(
+            partial(ConnextAPI.resolve_receipt, queue=self.receipt_queue), cache_files)
 
         return data
     
\ No newline at end of file
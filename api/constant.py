@@ -53,3 +53,36 @@ class DiamondContract:
             return DiamondContract.POLYGON
         else:
             raise Exception("Chain {chain} not supported")
+
+
+class ConfirmationDepth:
+    """Blocks re-fetched on every run as they may still be reorged or not yet indexed,
+    roughly 15 minutes per chain"""
+    ETHEREUM = 64
+    OPTIMISM = 450
+    ARBITRUM_ONE = 3600
+    BNB_CHAIN = 300
+    GNOSIS = 180
+    POLYGON = 512
+
+    @staticmethod
+    def get_depth(chain: Chain) -> int:
+        if chain == Chain.ETHEREUM:
+            return ConfirmationDepth.ETHEREUM
+        elif chain == Chain.OPTIMISM:
+            return ConfirmationDepth.OPTIMISM
+        elif chain == Chain.ARBITRUM_ONE:
+            return ConfirmationDepth.ARBITRUM_ONE
+        elif chain == Chain.BNB_CHAIN:
+            return ConfirmationDepth.BNB_CHAIN
+        elif chain == Chain.GNOSIS:
+            return ConfirmationDepth.GNOSIS
+        elif chain == Chain.POLYGON:
+            return ConfirmationDepth.POLYGON
+        else:
+            raise Exception(f"Chain {chain} not supported")
+
+
+class EventTopic:
+    # keccak256("Transfer(address,address,uint256)")
+    TRANSFER = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
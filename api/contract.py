@@ -1,11 +1,17 @@
 import json
 import logging
 import os
+from typing import Any, Dict, Hashable, List, Optional, Tuple
 
-from web3 import Web3, HTTPProvider
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
 from web3.datastructures import AttributeDict
 
+from api.clients import clients
 from api.constant import Chain, DiamondContract
+from api.providers import pools
 
 
 class SmartContract(object):
@@ -25,17 +31,21 @@ class SmartContract(object):
 
     @staticmethod
     def get_default_provider(chain: Chain) -> Web3:
-        return Web3(HTTPProvider(SmartContract.default_providers[chain]))
+        """Shared Web3 of chain, see `api.clients.ClientRegistry`
+
+        Requests are routed over the endpoints of the chain's `api.providers` pool.
+        """
+        return clients.get_provider(chain, pools.primary(chain))
 
     def __init__(self, chain: Chain, address: str, abi_path: str) -> None:
+        self.chain = chain
         self.provider = SmartContract.get_default_provider(chain)
 
         self.address = address if self.provider.isChecksumAddress(address) else self.provider.toChecksumAddress(address)
 
-        with open(abi_path, "r") as fp:
-            self.abi = json.load(fp)
-
-        self.contract = self.provider.eth.contract(self.address, abi=self.abi)
+        self.abi_path = abi_path
+        self.abi = clients.get_abi(abi_path)
+        self.contract = clients.get_contract(chain, self.address, abi_path, self.provider)
 
     @staticmethod
     def parse_bytes(item):
@@ -48,9 +58,89 @@ class SmartContract(object):
         return item
 
     def decode_input(self, input: str) -> dict:
-        _, func_params = self.contract.decode_function_input(input)
+        # same as `contract.decode_function_input` with the selector lookup cached
+        data = HexBytes(input)
+        names, types = clients.get_decoder(self.contract, self.abi_path, data[:4].hex())
+        decoded = self.provider.codec.decode(types, data[4:])
+        func_params = dict(zip(names, map_abi_data(BASE_RETURN_NORMALIZERS, types, decoded)))
         return {k: SmartContract.parse_bytes(v) for k, v in func_params.items()}
 
+    def encode_call(self, fn_name: str, *args) -> str:
+        """ABI-encode a call to `fn_name`"""
+        return self.contract.encodeABI(fn_name=fn_name, args=list(args))
+
+    def decode_output(self, fn_name: str, data: bytes) -> Any:
+        """Decode return data of `fn_name`, unwrapping single return values"""
+        types = get_abi_output_types(self.contract.get_function_by_name(fn_name).abi)
+        decoded = map_abi_data(BASE_RETURN_NORMALIZERS, types, self.provider.codec.decode(types, data))
+        return decoded[0] if len(decoded) == 1 else tuple(decoded)
+
+
+class Multicall3(SmartContract):
+    """Multicall3, deployed at the same address on every supported chain"""
+
+    ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+    def __init__(self, chain: Chain, abi_path: str = "./abi/Multicall3.json") -> None:
+        super().__init__(chain, Multicall3.ADDRESS, abi_path)
+
+
+class BatchStateReader(object):
+    """
+    Aggregate many contract view calls into Multicall3 `aggregate3` requests.
+
+    >>> reader = BatchStateReader(Chain.GNOSIS)
+    >>> reader.add(token, "totalSupply", key="supply")
+    >>> reader.add(token, "balanceOf", holder)
+    >>> reader.execute(block=27000000)
+    {"supply": ..., (token.address, "balanceOf", (holder,)): ...}
+
+    Failed calls don't fail the batch, their result is None.
+    """
+
+    def __init__(self, chain: Chain, batch_size: int = 500) -> None:
+        """
+        :param chain: chain to read from
+        :param batch_size: max calls per `eth_call`
+        """
+        self.chain = chain
+        self.batch_size = batch_size
+        self.multicall = Multicall3(chain)
+        self.calls: List[Tuple[Hashable, SmartContract, str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def add(self, contract: SmartContract, fn_name: str, *args, key: Optional[Hashable] = None) -> Hashable:
+        """Queue a view call, returns the key of its result
+
+        :param contract: contract to call
+        :param fn_name: function name
+        :param key: key of the result, defaults to `(address, fn_name, args)`
+        """
+        if key is None:
+            key = (contract.address, fn_name, args)
+        self.calls.append((key, contract, fn_name, contract.encode_call(fn_name, *args)))
+        return key
+
+    def execute(self, block: Optional[int] = None) -> Dict[Hashable, Any]:
+        """Run all queued calls, optionally pinned to a block, and clear the queue"""
+        calls, self.calls = self.calls, []
+        results = {}
+        block_identifier = "latest" if block is None else block
+        for i in range(0, len(calls), self.batch_size):
+            batch = calls[i: i + self.batch_size]
+            returned = self.multicall.contract.functions.aggregate3(
+                [(contract.address, True, HexBytes(data)) for _, contract, _, data in batch]
+            ).call(block_identifier=block_identifier)
+            for (key, contract, fn_name, _), (success, return_data) in zip(batch, returned):
+                if not success or len(return_data) == 0:
+                    logging.debug(f"Multicall to {contract.address}.{fn_name} failed on {self.chain}")
+                    results[key] = None
+                    continue
+                results[key] = contract.decode_output(fn_name, return_data)
+        return results
+
 
 class ConnextDiamond(SmartContract):
 
@@ -58,8 +148,58 @@ class ConnextDiamond(SmartContract):
         address = DiamondContract.get_contract_address(chain)
         super().__init__(chain, address, abi_path)
 
+    @staticmethod
+    def calculate_canonical_hash(canonical_id: bytes, domain: int) -> bytes:
+        """Stable swap pool key, `keccak256(abi.encode(id, domain))` as in Connext's AssetLogic"""
+        return Web3.keccak(HexBytes(canonical_id).rjust(32, b"\0") + domain.to_bytes(32, "big"))
+
+    def get_pool_keys(self, local_tokens: List[str], block: Optional[int] = None) -> Dict[str, bytes]:
+        """Stable swap pool keys of local (`next`) assets, in one multicall"""
+        reader = BatchStateReader(self.chain)
+        for address in local_tokens:
+            reader.add(self, "getTokenId", Web3.toChecksumAddress(address), key=address)
+        keys = {}
+        for address, token_id in reader.execute(block).items():
+            if token_id is None:
+                continue
+            domain, canonical_id = token_id
+            keys[address] = ConnextDiamond.calculate_canonical_hash(canonical_id, domain)
+        return keys
+
+    def get_pool_states(
+        self,
+        pool_keys: Dict[Hashable, bytes],
+        lp_tokens: Optional[Dict[Hashable, "ERC20Token"]] = None,
+        block: Optional[int] = None) -> Dict[Hashable, Dict[str, Any]]:
+        """Reserves, virtual price and LP supply of stable swap pools in one multicall
+
+        :param pool_keys: pool key per name
+        :param lp_tokens: LP token per name, to read `totalSupply`
+        :param block: block to read at, latest if None
+        """
+        reader = BatchStateReader(self.chain)
+        for name, pool_key in pool_keys.items():
+            reader.add(self, "getSwapTokenBalance", pool_key, 0, key=(name, "balance0"))
+            reader.add(self, "getSwapTokenBalance", pool_key, 1, key=(name, "balance1"))
+            reader.add(self, "getSwapVirtualPrice", pool_key, key=(name, "virtual_price"))
+            reader.add(self, "getSwapLPToken", pool_key, key=(name, "lp_token"))
+            if lp_tokens is not None and name in lp_tokens:
+                reader.add(lp_tokens[name], "totalSupply", key=(name, "lp_supply"))
+        states = {name: {"block": block} for name in pool_keys.keys()}
+        for (name, field), value in reader.execute(block).items():
+            states[name][field] = value
+        return states
+
 
 class ERC20Token(SmartContract):
+    """
+    ERC20 token with its metadata cached on disk.
+
+    Metadata (`name`, `symbol`, `decimal`, `total_supply`) is loaded on first
+    access, from the cache or the chain, so building a token does no I/O.
+    """
+
+    METADATA = ["name", "symbol", "decimal", "total_supply"]
 
     def __init__(
         self, 
@@ -70,23 +210,52 @@ class ERC20Token(SmartContract):
         super().__init__(chain, address, abi_path)
         self.cache_path = f"{data_dir}/{chain}/{self.address}.json"
         os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
-        self.load_data()
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for attributes not set yet
+        if name in ERC20Token.METADATA:
+            self.load_data()
+            return self.__dict__[name]
+        raise AttributeError(f"{type(self).__name__} has no attribute {name}")
 
     def load_data(self):
+        data = None
         if os.path.exists(self.cache_path):
             logging.debug(f"Loading token data from {self.cache_path}")
             with open(self.cache_path, "r") as fp:
                 data = json.load(fp)
-                self.name = data["name"]
-                self.symbol = data["symbol"]
-                self.decimal = data["decimal"]
-                self.total_supply = data["total_supply"]
+        # caches written before failed calls were skipped can hold nulls
+        if data is not None and None not in data.values():
+            self.name = data["name"]
+            self.symbol = data["symbol"]
+            self.decimal = data["decimal"]
+            self.total_supply = data["total_supply"]
         else:
-            self.name = self.contract.functions.name().call()
-            self.symbol = self.contract.functions.symbol().call()
-            self.decimal = self.contract.functions.decimals().call()
-            self.total_supply = self.contract.functions.totalSupply().call()
-            self.save_data()
+            ERC20Token.load_many([self])
+
+    @staticmethod
+    def load_many(tokens: List["ERC20Token"], block: Optional[int] = None) -> None:
+        """Fetch metadata of tokens of one chain with a single multicall and cache it"""
+        if not tokens:
+            return
+        reader = BatchStateReader(tokens[0].chain)
+        for i, token in enumerate(tokens):
+            for fn_name in ["name", "symbol", "decimals", "totalSupply"]:
+                reader.add(token, fn_name, key=(i, fn_name))
+        results = reader.execute(block)
+        failed = []
+        for i, token in enumerate(tokens):
+            # a failed call is None, don't cache it as the token's metadata
+            if any(results[(i, fn_name)] is None for fn_name in ["name", "symbol", "decimals", "totalSupply"]):
+                failed.append(token.address)
+                continue
+            token.name = results[(i, "name")]
+            token.symbol = results[(i, "symbol")]
+            token.decimal = results[(i, "decimals")]
+            token.total_supply = results[(i, "totalSupply")]
+            token.save_data()
+        if failed:
+            raise ValueError(f"Failed to read metadata of {failed} on {tokens[0].chain}")
         
     def save_data(self):
         data = {
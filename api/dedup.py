@@ -0,0 +1,209 @@
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Tuple
+
+from api.constant import Chain
+from api.scan import ScanTxn
+from api.store import TxnStore
+
+DedupKey = Tuple[Chain, str, int]
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over string keys using double hashing of a blake2b digest.
+
+    False positives happen at roughly `error_rate` once `capacity` keys are added,
+    false negatives never do.
+    """
+
+    def __init__(self, capacity: int = 1_000_000, error_rate: float = 0.001) -> None:
+        """
+        :param capacity: expected number of keys
+        :param error_rate: false positive rate at capacity
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key: str) -> Iterable[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, key: str) -> None:
+        for idx in self._indexes(key):
+            self.bits[idx >> 3] |= 1 << (idx & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[idx >> 3] & (1 << (idx & 7)) for idx in self._indexes(key))
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(f"{self.capacity},{self.error_rate},{self.count}\n".encode())
+            fp.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "BloomFilter":
+        with open(path, "rb") as fp:
+            capacity, error_rate, count = fp.readline().decode().strip().split(",")
+            bloom = BloomFilter(int(capacity), float(error_rate))
+            bloom.bits = bytearray(fp.read())
+            bloom.count = int(count)
+        return bloom
+
+
+class DedupIndex(object):
+    """
+    Persistent set of ingested `(chain, hash, logIndex)` keys.
+
+    Keys live in a SQLite table at `{path}.sqlite`, fronted by an in-memory
+    Bloom filter persisted at `{path}.bloom`, so checking new rows only
+    touches SQLite for keys that were probably seen already. Transfer rows are
+    keyed by their log index, so one transaction moving several tokens keeps
+    all its transfers, transaction-level rows have none and use -1.
+    """
+
+    TX_LOG_INDEX = -1
+
+    def __init__(self, path: str, capacity: int = 1_000_000, error_rate: float = 0.001) -> None:
+        """
+        :param path: path prefix of the index files
+        :param capacity: initial Bloom filter capacity, doubled when exceeded
+        :param error_rate: Bloom filter false positive rate
+        """
+        self.path = path
+        self.db_path = f"{path}.sqlite"
+        self.bloom_path = f"{path}.bloom"
+        self.error_rate = error_rate
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            "chain TEXT, hash TEXT, log_index INTEGER, PRIMARY KEY (chain, hash, log_index)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+        self.bloom = self._load_bloom(capacity)
+
+    @staticmethod
+    def _key_str(key: DedupKey) -> str:
+        chain, tx_hash, log_index = key
+        return f"{chain}:{tx_hash.lower()}:{log_index}"
+
+    @staticmethod
+    def tx_key(chain: Chain, tx: ScanTxn) -> DedupKey:
+        return DedupIndex.row_key(chain, TxnStore.tx_key(tx))
+
+    @staticmethod
+    def row_key(chain: Chain, key: str) -> DedupKey:
+        """Dedup key of a `TxnStore` row key"""
+        tx_hash, log_index = TxnStore.split_key(key)
+        return chain, tx_hash.lower(), DedupIndex.TX_LOG_INDEX if log_index is None else log_index
+
+    def _load_bloom(self, capacity: int) -> BloomFilter:
+        n_keys = len(self)
+        if os.path.exists(self.bloom_path):
+            bloom = BloomFilter.load(self.bloom_path)
+            if bloom.count == n_keys:
+                return bloom
+            logging.info(f"Bloom filter at {self.bloom_path} is stale, rebuilding")
+        return self._rebuild_bloom(max(capacity, 2 * n_keys))
+
+    def _rebuild_bloom(self, capacity: int) -> BloomFilter:
+        bloom = BloomFilter(capacity, self.error_rate)
+        for key in self.db.execute("SELECT chain, hash, log_index FROM seen"):
+            bloom.add(DedupIndex._key_str(key))
+        return bloom
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def __contains__(self, key: DedupKey) -> bool:
+        chain, tx_hash, log_index = key
+        key = (chain, tx_hash.lower(), log_index)
+        if DedupIndex._key_str(key) not in self.bloom:
+            return False
+        with self._lock:
+            row = self.db.execute(
+                "SELECT 1 FROM seen WHERE chain = ? AND hash = ? AND log_index = ?", key).fetchone()
+        return row is not None
+
+    def exists(self) -> bool:
+        """Whether the index has been built, see `rebuild`"""
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'initialized'").fetchone()
+        return row is not None
+
+    def add(self, keys: Iterable[DedupKey]) -> None:
+        """Record keys as ingested"""
+        keys = [(chain, tx_hash.lower(), log_index) for chain, tx_hash, log_index in keys]
+        with self._lock:
+            n_stored = self.bloom.count
+            cursor = self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?, ?)", keys)
+            self.db.commit()
+            if cursor.rowcount == 0:
+                return
+            for key in keys:
+                self.bloom.add(DedupIndex._key_str(key))
+            # count only newly stored keys, it's compared against SQLite on load
+            self.bloom.count = n_stored + cursor.rowcount
+            if self.bloom.count > self.bloom.capacity:
+                self.bloom = self._rebuild_bloom(2 * max(self.bloom.capacity, self.bloom.count))
+            self.bloom.save(self.bloom_path)
+
+    def remove(self, keys: Iterable[DedupKey]) -> None:
+        """Forget keys, e.g. of reorged transactions, so they can be ingested again
+
+        Their Bloom bits stay set, lookups then fall through to SQLite.
+        """
+        keys = [(chain, tx_hash.lower(), log_index) for chain, tx_hash, log_index in keys]
+        with self._lock:
+            cursor = self.db.executemany(
+                "DELETE FROM seen WHERE chain = ? AND hash = ? AND log_index = ?", keys)
+            self.db.commit()
+            if cursor.rowcount > 0:
+                self.bloom.count -= cursor.rowcount
+                self.bloom.save(self.bloom_path)
+
+    def add_txs(self, chain: Chain, txs: List[ScanTxn]) -> None:
+        self.add(DedupIndex.tx_key(chain, tx) for tx in txs)
+
+    def filter_new(self, chain: Chain, txs: List[ScanTxn]) -> List[ScanTxn]:
+        """Drop transactions already ingested or repeated within `txs`
+
+        Kept transactions are not recorded, call `add_txs` once they are saved.
+        """
+        new_txs = []
+        batch = set()
+        for tx in txs:
+            key = DedupIndex.tx_key(chain, tx)
+            if key in batch or key in self:
+                continue
+            batch.add(key)
+            new_txs.append(tx)
+        if len(new_txs) < len(txs):
+            logging.info(f"Dropped {len(txs) - len(new_txs)} duplicate transactions on {chain}")
+        return new_txs
+
+    def rebuild(self, store: TxnStore, chains: List[Chain]) -> None:
+        """Index every transaction cached in `store`, by its block index"""
+        logging.info(f"Building dedup index at {self.db_path}")
+        for chain in chains:
+            self.add(DedupIndex.row_key(chain, key) for _, key, _ in store.read_index(chain))
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('initialized', '1')")
+            self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List
+
+
+class Executor(object):
+    """
+    Run a function over many items with a configurable concurrency backend.
+
+    - `thread` (default): thread pool, suited to network-bound workers as
+      there's no fork, no pickling and the module state is shared
+    - `async`: asyncio event loop, coroutine functions are awaited directly and
+      blocking functions are offloaded to a thread pool of `num_workers`
+    - `process`: multiprocessing pool, for CPU-bound workers
+    """
+
+    PROCESS = "process"
+    THREAD = "thread"
+    ASYNC = "async"
+
+    DEFAULT_MODE = THREAD
+    DEFAULT_NUM_WORKERS = 32
+
+    def __init__(self, mode: str = DEFAULT_MODE, num_workers: int = DEFAULT_NUM_WORKERS) -> None:
+        """
+        :param mode: one of `thread`, `async` or `process`
+        :param num_workers: maximum number of concurrent workers
+        """
+        if mode not in [Executor.PROCESS, Executor.THREAD, Executor.ASYNC]:
+            raise ValueError(f"Unknown executor mode {mode}, only {Executor.PROCESS}|{Executor.THREAD}|{Executor.ASYNC}")
+        if num_workers < 1:
+            raise ValueError(f"num_workers must be positive, got {num_workers}")
+        self.mode = mode
+        self.num_workers = num_workers
+
+    def __repr__(self) -> str:
+        return f"Executor(mode={self.mode}, num_workers={self.num_workers})"
+
+    def map(self, fn: Callable[[Any], Any], items: Iterable[Any]) -> List[Any]:
+        """Apply `fn` to every item and return results in order"""
+        items = list(items)
+        if not items:
+            return []
+        logging.debug(f"Running {len(items)} tasks with {self}")
+
+        if self.mode == Executor.PROCESS:
+            with mp.Pool(self.num_workers) as pool:
+                return pool.map(fn, items)
+        elif self.mode == Executor.THREAD:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                return list(pool.map(fn, items))
+        else:
+            return asyncio.run(self._async_map(fn, items))
+
+    async def _async_map(self, fn: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+        semaphore = asyncio.Semaphore(self.num_workers)
+        loop = asyncio.get_running_loop()
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            async def run(item):
+                async with semaphore:
+                    if asyncio.iscoroutinefunction(fn):
+                        return await fn(item)
+                    return await loop.run_in_executor(pool, fn, item)
+
+            return await asyncio.gather(*[run(item) for item in items])
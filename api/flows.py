@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from api.constant import Chain, ConfirmationDepth
+from api.store import TxnStore
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+FlowKey = Tuple[Chain, str, str, int]
+
+
+class FlowCube(object):
+    """
+    Hourly rollups of bridge flows, by `(origin, destination, asset, hour)`.
+
+    Each cell holds the number of `xcall`/`xcallIntoLocal` transactions, their
+    volume in token units, relayer fees (the native value sent with the call)
+    and gas fees, both in native units of the origin chain. Cells are built
+    from the decoded transaction cache and updated incrementally: only
+    transactions after each chain's watermark are rolled up, and only once
+    they are deeper than `ConfirmationDepth`, so reorged transactions never
+    enter the cube. A digest of the transactions rolled up below each
+    watermark is kept, and a chain whose cache gained (or lost) transactions
+    below its watermark, e.g. the backfill of a newly added watch, is rolled up
+    again from scratch.
+
+    The cube is a single `.npz` of columns at `{data_dir}/flows/cube.npz`,
+    with the symbol and decimals of each asset so reloaded cubes don't read
+    token metadata again, queries are numpy masks over it.
+    """
+
+    FUNCTIONS = ["xcall", "xcallIntoLocal"]
+    # asset of message-only xcalls, which bridge no token
+    NULL_ADDRESS = "0x" + "0" * 40
+    NATIVE_ASSETS = {
+        Chain.ETHEREUM: "ETH", Chain.OPTIMISM: "ETH", Chain.ARBITRUM_ONE: "ETH",
+        Chain.BNB_CHAIN: "BNB", Chain.GNOSIS: "XDAI", Chain.POLYGON: "MATIC",
+    }
+    COLUMNS = ["count", "volume", "relayer_fee", "gas_fee"]
+    FREQS = {"hour": 3600, "day": 86400}
+
+    def __init__(self, data_dir: str = "data", confirmations: Optional[Dict[Chain, int]] = None) -> None:
+        """
+        :param data_dir: directory of the transaction cache
+        :param confirmations: blocks per chain not rolled up yet, defaults to `ConfirmationDepth`
+        """
+        self.path = f"{data_dir}/flows/cube.npz"
+        self.store = TxnStore(f"{data_dir}/amarok_txs")
+        self.confirmations = confirmations or {}
+        # (chain, address) -> (asset name, decimals)
+        self.assets: Dict[Tuple[Chain, str], Tuple[str, int]] = {}
+        self.cells: Dict[FlowKey, List[float]] = {}
+        self.watermarks: Dict[Chain, int] = {}
+        # digest of the transactions rolled up below each watermark
+        self.digests: Dict[Chain, str] = {}
+        self._columns: Optional[Dict[str, np.ndarray]] = None
+        if os.path.exists(self.path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def resolve_asset(self, chain: Chain, address: str) -> Tuple[str, int]:
+        """Registry symbol (e.g. `USDC`) or token symbol, and decimals of an asset
+
+        The zero address is the native asset of the chain. Tokens whose
+        metadata can't be read are rolled up by address in raw units.
+        """
+        key = (chain, address.lower())
+        if key not in self.assets:
+            if key[1] == FlowCube.NULL_ADDRESS:
+                self.assets[key] = (FlowCube.NATIVE_ASSETS.get(chain, key[1]), 18)
+                return self.assets[key]
+
+            from api.contract import ERC20Token
+            from api.token import Token
+
+            try:
+                token = ERC20Token(chain, address)
+                name = Token.symbol_lookup(address, chain) or token.symbol or key[1]
+                self.assets[key] = (name, token.decimal if token.decimal is not None else 0)
+            except Exception as e:
+                logging.warning(f"Can't read metadata of {address} on {chain}, rolling it up in raw units: {e}")
+                self.assets[key] = (key[1], 0)
+        return self.assets[key]
+
+    def add(self, chain: Chain, tx: Dict) -> bool:
+        """Roll up one cached transaction (JSON of a `ScanTxn`), returns whether it was an xcall"""
+        fn_name = tx["functionName"].split("(")[0] if tx["functionName"] else ""
+        params = tx["input"]
+        if fn_name not in FlowCube.FUNCTIONS or not isinstance(params, dict):
+            return False
+        try:
+            destination = Chain.resolve_connext_domain(params["_destination"])
+        except Exception:
+            destination = str(params["_destination"])
+        asset, decimals = self.resolve_asset(chain, params["_asset"])
+        hour = int(tx["timeStamp"]) // 3600 * 3600
+
+        cell = self.cells.setdefault((chain, destination, asset, hour), [0, 0., 0., 0.])
+        cell[0] += 1
+        cell[1] += int(params["_amount"]) / 10 ** decimals
+        cell[2] += int(tx["value"]) / 1e18
+        cell[3] += int(tx["gasUsed"]) * int(tx["gasPrice"]) / 1e18
+        self._columns = None
+        return True
+
+    def update(self, chains: Optional[List[Chain]] = None) -> int:
+        """Roll up confirmed transactions cached since the last update and save, returns how many"""
+        if chains is None:
+            chains = [
+                Chain.ETHEREUM, Chain.BNB_CHAIN, Chain.POLYGON, Chain.OPTIMISM, Chain.GNOSIS, Chain.ARBITRUM_ONE]
+        n_added = 0
+        for chain in chains:
+            if chain in self.watermarks and self.digests.get(chain) != self.rolled_digest(chain, self.watermarks[chain]):
+                logging.info(f"Cache of {chain} changed below block {self.watermarks[chain]}, rolling it up again")
+                self.reset(chain)
+            start_block = self.watermarks.get(chain, -1) + 1
+            head = max((block for block, _, _ in self.store.read_index(chain, start_block)), default=None)
+            if head is None:
+                continue
+            end_block = head - self.confirmations.get(chain, ConfirmationDepth.get_depth(chain))
+            if end_block < start_block:
+                continue
+            n_chain = sum(
+                self.add(chain, tx)
+                for tx in self.store.iter_raw(chain, start_block, end_block, FlowCube.FUNCTIONS))
+            self.watermarks[chain] = end_block
+            self.digests[chain] = self.rolled_digest(chain, end_block)
+            logging.info(f"Rolled up {n_chain} xcalls on {chain} in blocks [{start_block}, {end_block}]")
+            n_added += n_chain
+        self.save()
+        return n_added
+
+    def rolled_digest(self, chain: Chain, end_block: int) -> str:
+        """Digest of the hashes of the cached xcalls of a chain up to `end_block`"""
+        hashes = sorted(tx_hash for _, tx_hash, _ in self.store.read_index(chain, 0, end_block, FlowCube.FUNCTIONS))
+        return hashlib.sha256("\n".join(hashes).encode()).hexdigest()
+
+    def reset(self, chain: Chain) -> None:
+        """Drop the cells and watermark of a chain, the next `update` rolls it up from scratch"""
+        self.cells = {key: cell for key, cell in self.cells.items() if key[0] != chain}
+        self.watermarks.pop(chain, None)
+        self.digests.pop(chain, None)
+        self._columns = None
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Cells as column arrays, cached until the next `add`"""
+        if self._columns is None:
+            keys = list(self.cells.keys())
+            values = np.array(list(self.cells.values()), dtype=np.float64).reshape(-1, len(FlowCube.COLUMNS))
+            self._columns = {
+                "origin": np.array([key[0] for key in keys], dtype=str),
+                "destination": np.array([key[1] for key in keys], dtype=str),
+                "asset": np.array([key[2] for key in keys], dtype=str),
+                "hour": np.array([key[3] for key in keys], dtype=np.int64),
+                "count": values[:, 0].astype(np.int64),
+                "volume": values[:, 1],
+                "relayer_fee": values[:, 2],
+                "gas_fee": values[:, 3],
+            }
+        return self._columns
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # `np.savez` appends `.npz` to paths without it
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            watermark_chains=np.array(list(self.watermarks.keys()), dtype=str),
+            watermark_blocks=np.array(list(self.watermarks.values()), dtype=np.int64),
+            watermark_digests=np.array([self.digests.get(chain, "") for chain in self.watermarks.keys()], dtype=str),
+            asset_chains=np.array([key[0] for key in self.assets.keys()], dtype=str),
+            asset_addresses=np.array([key[1] for key in self.assets.keys()], dtype=str),
+            asset_names=np.array([asset[0] for asset in self.assets.values()], dtype=str),
+            asset_decimals=np.array([asset[1] for asset in self.assets.values()], dtype=np.int64),
+            **self.columns())
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        with np.load(self.path) as data:
+            self.watermarks = dict(zip(data["watermark_chains"].tolist(), data["watermark_blocks"].tolist()))
+            # cubes saved without digests are rolled up again on the next update
+            if "watermark_digests" in data.files:
+                self.digests = dict(zip(data["watermark_chains"].tolist(), data["watermark_digests"].tolist()))
+            if "asset_names" in data.files:
+                keys = zip(data["asset_chains"].tolist(), data["asset_addresses"].tolist())
+                self.assets = dict(zip(keys, zip(data["asset_names"].tolist(), data["asset_decimals"].tolist())))
+            keys = zip(data["origin"].tolist(), data["destination"].tolist(), data["asset"].tolist(), data["hour"].tolist())
+            values = zip(*[data[column].tolist() for column in FlowCube.COLUMNS])
+            self.cells = {key: list(value) for key, value in zip(keys, values)}
+        self._columns = None
+
+    def query(
+        self,
+        origin: Optional[Chain] = None,
+        destination: Optional[Chain] = None,
+        asset: Optional[str] = None,
+        start_time: Optional[int] = None,
+        end_time: Optional[int] = None,
+        by: Tuple[str, ...] = ("origin", "destination", "asset"),
+        freq: Optional[str] = "day") -> pd.DataFrame:
+        """Flows summed by `by` and time bucket
+
+        :param origin: only flows from this chain
+        :param destination: only flows to this chain
+        :param asset: only this asset, e.g. `USDC`
+        :param start_time: unix time of the first hour to include
+        :param end_time: unix time of the last hour to include
+        :param by: dimensions to keep, among origin, destination and asset
+        :param freq: `hour`, `day`, or None for totals over the whole range
+        """
+        import pandas as pd
+
+        if freq is not None and freq not in FlowCube.FREQS:
+            raise ValueError(f"Unknown freq {freq}, only {'|'.join(FlowCube.FREQS.keys())}")
+        columns = self.columns()
+        mask = np.ones(len(columns["hour"]), dtype=bool)
+        for name, value in [("origin", origin), ("destination", destination), ("asset", asset)]:
+            if value is not None:
+                mask &= columns[name] == value
+        if start_time is not None:
+            mask &= columns["hour"] >= start_time // 3600 * 3600
+        if end_time is not None:
+            mask &= columns["hour"] <= end_time
+
+        df = pd.DataFrame({name: values[mask] for name, values in columns.items()})
+        keys = list(by)
+        if freq is not None:
+            df["time"] = pd.to_datetime(df["hour"] // FlowCube.FREQS[freq] * FlowCube.FREQS[freq], unit="s")
+            keys.append("time")
+        if not keys:
+            return df[FlowCube.COLUMNS].sum().to_frame().T.astype({"count": np.int64})
+        return df.groupby(keys)[FlowCube.COLUMNS].sum().reset_index()
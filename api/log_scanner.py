@@ -0,0 +1,177 @@
+import json
+import logging
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from api.clients import clients
+from api.constant import Chain, EventTopic
+from api.executor import Executor
+from api.profiling import stage
+from api.providers import pools
+
+
+class LogScanner(object):
+    """
+    Fetch event logs of many contracts over JSON-RPC `eth_getLogs`, as an
+    alternative to paginating explorer `tokentx` with API keys.
+
+    The block range is split into windows fetched concurrently, a round of
+    `num_workers` windows at a time. A window rejected for returning too many
+    results is bisected until it fits. The window size for the next round is
+    halved after a rejection and doubled after a clean round.
+
+    Only the `thread` and `async` executors are supported as the provider
+    can't be pickled.
+    """
+
+    # substrings of provider errors asking for a smaller range, rate limits must not match
+    TOO_MANY_RESULTS = [
+        "more than", "too many", "response size", "range is too", "range too", "block range",
+        "exceed maximum", "is limited to",
+    ]
+
+    def __init__(
+        self,
+        chain: Chain,
+        rpc_url: Optional[str] = None,
+        window: int = 2000,
+        min_window: int = 1,
+        max_window: int = 100000,
+        executor: str = Executor.THREAD,
+        num_workers: int = 8) -> None:
+        """
+        :param chain: chain to scan
+        :param rpc_url: JSON-RPC endpoint, defaults to the primary endpoint of the chain's `api.providers` pool
+        :param window: initial number of blocks per `eth_getLogs`
+        :param min_window: smallest window, a rejected window of this size raises
+        :param max_window: largest window
+        :param executor: `thread` or `async`
+        :param num_workers: concurrent `eth_getLogs` calls
+        """
+        if executor == Executor.PROCESS:
+            raise ValueError("LogScanner doesn't support the process executor")
+        self.chain = chain
+        self.provider = clients.get_provider(chain, rpc_url or pools.primary(chain))
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.executor = Executor(executor, num_workers)
+
+    @staticmethod
+    def is_too_many_results(error: Exception) -> bool:
+        message = str(error).lower()
+        return any(pattern in message for pattern in LogScanner.TOO_MANY_RESULTS)
+
+    @staticmethod
+    def _to_raw(log: Dict) -> Dict:
+        from web3 import Web3
+
+        # web3-formatted log back to the hex JSON of `eth_getTransactionReceipt`
+        log = json.loads(Web3.toJSON(log))
+        for key in ["blockNumber", "logIndex", "transactionIndex"]:
+            log[key] = hex(log[key])
+        return log
+
+    def get_logs(self, addresses: List[str], topics: List[Optional[str]], from_block: int, to_block: int) -> List[Dict]:
+        """Single `eth_getLogs` call, logs in receipt format"""
+        from web3 import Web3
+
+        with stage("get_logs"):
+            logs = self.provider.eth.get_logs({
+                "fromBlock": from_block,
+                "toBlock": to_block,
+                "address": [Web3.toChecksumAddress(address) for address in addresses],
+                "topics": topics,
+            })
+        return [LogScanner._to_raw(log) for log in logs]
+
+    def _scan_window(
+        self,
+        addresses: List[str],
+        topics: List[Optional[str]],
+        window: Tuple[int, int]) -> Tuple[List[Dict], bool]:
+        """Logs of a window, bisected while the provider rejects it, and whether it was"""
+        from_block, to_block = window
+        try:
+            return self.get_logs(addresses, topics, from_block, to_block), False
+        except ValueError as e:
+            if not LogScanner.is_too_many_results(e) or to_block - from_block + 1 <= self.min_window:
+                raise
+        middle = (from_block + to_block) // 2
+        logging.debug(f"Too many logs in [{from_block}, {to_block}] on {self.chain}, splitting at {middle}")
+        left, _ = self._scan_window(addresses, topics, (from_block, middle))
+        right, _ = self._scan_window(addresses, topics, (middle + 1, to_block))
+        return left + right, True
+
+    def scan(
+        self,
+        addresses: List[str],
+        topics: List[Optional[str]],
+        start_block: int,
+        end_block: Optional[int] = None) -> List[Dict]:
+        """Logs of `addresses` matching `topics` in `[start_block, end_block]`, in block and log order
+
+        :param addresses: contracts emitting the logs
+        :param topics: topic filter, e.g. `[EventTopic.TRANSFER]`
+        :param start_block: first block
+        :param end_block: last block, the chain head if None
+        """
+        if end_block is None:
+            end_block = self.provider.eth.block_number
+        logs = []
+        cursor = start_block
+        while cursor <= end_block:
+            windows = []
+            while cursor <= end_block and len(windows) < self.executor.num_workers:
+                windows.append((cursor, min(cursor + self.window - 1, end_block)))
+                cursor = windows[-1][1] + 1
+            results = self.executor.map(partial(self._scan_window, addresses, topics), windows)
+            for window_logs, _ in results:
+                logs.extend(window_logs)
+            if any(split for _, split in results):
+                self.window = max(self.min_window, self.window // 2)
+            else:
+                self.window = min(self.max_window, self.window * 2)
+        logging.info(f"Scanned {len(logs)} logs on {self.chain} in blocks [{start_block}, {end_block}]")
+        return sorted(logs, key=lambda x: (int(x["blockNumber"], 16), int(x["logIndex"], 16)))
+
+    def get_block_timestamps(self, blocks: List[int]) -> Dict[int, int]:
+        """Unix timestamp of each block, fetched concurrently"""
+        blocks = sorted(set(blocks))
+        timestamps = self.executor.map(lambda block: self.provider.eth.get_block(block)["timestamp"], blocks)
+        return dict(zip(blocks, timestamps))
+
+    def get_transfer_rows(self, token_addresses: List[str], start_block: int, end_block: Optional[int] = None) -> List[Dict]:
+        """Transfer events of tokens as explorer `tokentx` rows, see `ScanAPI.parse_transfer_events`
+
+        Fields only known to the explorer (gas, nonce, ...) are 0, `input` is `deprecated`
+        like in `tokentx`.
+        """
+        logs = self.scan(token_addresses, [EventTopic.TRANSFER], start_block, end_block)
+        timestamps = self.get_block_timestamps([int(log["blockNumber"], 16) for log in logs])
+        rows = []
+        for log in logs:
+            if len(log["topics"]) != 3:
+                # ERC721-style Transfer with indexed token id
+                continue
+            block_number = int(log["blockNumber"], 16)
+            rows.append({
+                "blockNumber": str(block_number),
+                "timeStamp": str(timestamps[block_number]),
+                "hash": log["transactionHash"],
+                "nonce": "0",
+                "blockHash": log["blockHash"],
+                "transactionIndex": str(int(log["transactionIndex"], 16)),
+                "logIndex": str(int(log["logIndex"], 16)),
+                "from": "0x" + log["topics"][1][-40:],
+                "to": "0x" + log["topics"][2][-40:],
+                "value": str(int(log["data"], 16)),
+                "contractAddress": log["address"].lower(),
+                "gas": "0",
+                "gasPrice": "0",
+                "gasUsed": "0",
+                "cumulativeGasUsed": "0",
+                "input": "deprecated",
+                "confirmations": "0",
+            })
+        return rows
@@ -0,0 +1,197 @@
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from api.constant import Chain, EventTopic
+from api.store import TxnStore
+from api.token import Token
+
+NULL_TOPIC = "0x" + "0" * 64
+
+
+class LPSupplySeries(object):
+    """
+    Total supply of an LP token over time, one point per block where it changed.
+
+    Arrays are sorted by block so as-of lookups are a binary search.
+    Supply is in token units (scaled by decimals).
+    """
+
+    def __init__(self, blocks: np.ndarray, timestamps: np.ndarray, supply: np.ndarray) -> None:
+        """
+        :param blocks: int64 blocks where supply changed, ascending
+        :param timestamps: int64 unix time of each block
+        :param supply: float64 total supply after each block
+        """
+        self.blocks = blocks
+        self.timestamps = timestamps
+        self.supply = supply
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    @staticmethod
+    def _as_of(keys: np.ndarray, values: np.ndarray, at: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        # index 0 of the padded values is the supply before the first change
+        idx = np.searchsorted(keys, at, side="right")
+        result = np.concatenate([[0.], values])[idx]
+        return float(result) if np.ndim(result) == 0 else result
+
+    def supply_at(self, block: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        """Supply at the end of `block`, 0 before the first mint"""
+        return LPSupplySeries._as_of(self.blocks, self.supply, block)
+
+    def supply_at_time(self, unixtime: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        """Supply as of unix time `unixtime`"""
+        return LPSupplySeries._as_of(self.timestamps, self.supply, unixtime)
+
+    def share_of_pool(
+        self,
+        balance: Union[float, np.ndarray],
+        block: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        """Fraction of the pool held by `balance` LP tokens at `block`"""
+        supply = np.asarray(self.supply_at(block), dtype=np.float64)
+        balance = np.asarray(balance, dtype=np.float64)
+        share = np.divide(
+            balance, supply, out=np.zeros(np.broadcast(balance, supply).shape), where=supply > 0)
+        return float(share) if share.ndim == 0 else share
+
+    def tvl_at(
+        self,
+        block: Union[int, np.ndarray],
+        virtual_price: Union[float, np.ndarray] = 1.) -> Union[float, np.ndarray]:
+        """Pool TVL in underlying units, LP supply times virtual price
+
+        Connext stable swap LP tokens start at a virtual price of 1 and only grow
+        with fees, pass `virtual_price` (e.g. from `Token.snapshot_pools`, scaled
+        by 1e18) for exact figures.
+        """
+        return self.supply_at(block) * virtual_price
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # `np.savez` appends `.npz` to paths without it
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, blocks=self.blocks, timestamps=self.timestamps, supply=self.supply)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "LPSupplySeries":
+        with np.load(path) as data:
+            return LPSupplySeries(data["blocks"], data["timestamps"], data["supply"])
+
+    @staticmethod
+    def from_events(events: List[Tuple[int, int, int, int]], decimals: int) -> "LPSupplySeries":
+        """Build from `(blockNumber, logIndex, timeStamp, raw_delta)` mint/burn events
+
+        Deltas are summed as Python ints so large raw amounts don't lose precision
+        before scaling.
+        """
+        events = sorted(events)
+        blocks, timestamps, supply = [], [], []
+        total = 0
+        for block_number, _, timestamp, delta in events:
+            total += delta
+            if blocks and blocks[-1] == block_number:
+                supply[-1] = total
+                continue
+            blocks.append(block_number)
+            timestamps.append(timestamp)
+            supply.append(total)
+        scale = 10 ** decimals
+        return LPSupplySeries(
+            np.array(blocks, dtype=np.int64),
+            np.array(timestamps, dtype=np.int64),
+            np.array([s / scale for s in supply], dtype=np.float64))
+
+
+class LPSupplyIndex(object):
+    """
+    LP supply series of every `lp` token in `Token.address_mapper`, derived from
+    mint and burn Transfer logs in the transaction caches. No on-chain calls.
+
+    Mint/burn logs are read from both the Diamond txs (`addSwapLiquidity`,
+    `removeSwapLiquidity`) and the LP transfer txs, as explorer `tokentx`
+    doesn't always list null-address transfers, and deduplicated by
+    `(hash, logIndex)`. Series are cached at `{data_dir}/lp_supply/{chain}/{address}.npz`
+    and rebuilt when a transaction cache changed since, see `TxnStore.changed_at`.
+    """
+
+    def __init__(self, data_dir: str = "data") -> None:
+        """
+        :param data_dir: directory of the transaction caches
+        """
+        self.data_path = f"{data_dir}/lp_supply"
+        self.stores = [TxnStore(f"{data_dir}/amarok_txs"), TxnStore(f"{data_dir}/lp_transfer_txs")]
+
+    def series_path(self, chain: Chain, token_address: str) -> str:
+        return f"{self.data_path}/{chain}/{token_address.lower()}.npz"
+
+    @staticmethod
+    def lp_tokens(chain: Chain) -> Dict[str, str]:
+        """LP token addresses of a chain, by token name"""
+        return {
+            token: lp.address for token, lp in Token.address_mapper[chain]["lp"].items()
+            if not isinstance(lp, str)
+        }
+
+    def iter_events(self, chain: Chain, token_addresses: List[str]) -> Iterator[Tuple[str, Tuple[int, int, int, int]]]:
+        """Yield `(lp_address, (blockNumber, logIndex, timeStamp, raw_delta))` of mints and burns"""
+        token_addresses = {address.lower() for address in token_addresses}
+        seen = set()
+        for store in self.stores:
+            for tx in store.iter_raw(chain):
+                for log in tx["logs"] or []:
+                    address = log["address"].lower()
+                    topics = log["topics"]
+                    if address not in token_addresses or len(topics) < 3 or topics[0] != EventTopic.TRANSFER:
+                        continue
+                    if topics[1] == NULL_TOPIC:
+                        sign = 1
+                    elif topics[2] == NULL_TOPIC:
+                        sign = -1
+                    else:
+                        continue
+                    log_index = int(log["logIndex"], 16)
+                    if (tx["hash"], log_index) in seen:
+                        continue
+                    seen.add((tx["hash"], log_index))
+                    yield address, (tx["blockNumber"], log_index, tx["timeStamp"], sign * int(log["data"], 16))
+
+    def build(self, chain: Chain) -> Dict[str, LPSupplySeries]:
+        """Rebuild and cache LP supply series of a chain, by token name"""
+        lp_tokens = LPSupplyIndex.lp_tokens(chain)
+        events = {address.lower(): [] for address in lp_tokens.values()}
+        for address, event in self.iter_events(chain, list(lp_tokens.values())):
+            events[address].append(event)
+
+        series = {}
+        for token, address in lp_tokens.items():
+            decimals = Token.get_lp(chain, token).decimal
+            series[token] = LPSupplySeries.from_events(events[address.lower()], decimals)
+            series[token].save(self.series_path(chain, address))
+            logging.info(f"Built LP supply of {token} on {chain} from {len(events[address.lower()])} mints/burns")
+        return series
+
+    def is_stale(self, chain: Chain, token_address: str) -> bool:
+        series_path = self.series_path(chain, token_address)
+        if not os.path.exists(series_path):
+            return True
+        # receipts resolved after the build change logs without touching the block index
+        mtime = os.path.getmtime(series_path)
+        return any(store.changed_at(chain) > mtime for store in self.stores)
+
+    def get(self, chain: Chain, token: str) -> LPSupplySeries:
+        """LP supply series of `token` (e.g. `Token.USDC`) on chain, rebuilt if stale"""
+        address = LPSupplyIndex.lp_tokens(chain)[token]
+        if self.is_stale(chain, address):
+            return self.build(chain)[token]
+        return LPSupplySeries.load(self.series_path(chain, address))
+
+    def load(self, chains: Optional[List[Chain]] = None) -> Dict[Chain, Dict[str, LPSupplySeries]]:
+        """LP supply series of every LP token, by chain and token name"""
+        if chains is None:
+            chains = [Chain.BNB_CHAIN, Chain.POLYGON, Chain.OPTIMISM, Chain.GNOSIS, Chain.ARBITRUM_ONE]
+        return {chain: {token: self.get(chain, token) for token in LPSupplyIndex.lp_tokens(chain)} for chain in chains}
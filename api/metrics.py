@@ -0,0 +1,169 @@
+import json
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Metrics(object):
+    """
+    In-process registry of counters and latency histograms for outbound calls.
+
+    Metrics are kept per process, when running with the `process` executor
+    each worker holds its own registry.
+    """
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., math.inf)
+
+    def __init__(self, prefix: str = "connext") -> None:
+        """
+        :param prefix: prefix of every metric name on export
+        """
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters: Dict[str, Dict[LabelKey, float]] = {}
+            self.histograms: Dict[str, Dict[LabelKey, Dict]] = {}
+
+    @staticmethod
+    def _key(labels: Dict[str, str]) -> LabelKey:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, labels: Dict[str, str], value: float = 1.) -> None:
+        """Increment counter `name` with labels by `value`"""
+        key = Metrics._key(labels)
+        with self._lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0.) + value
+
+    def observe(self, name: str, labels: Dict[str, str], value: float) -> None:
+        """Record `value` into histogram `name` with labels"""
+        key = Metrics._key(labels)
+        with self._lock:
+            histogram = self.histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(Metrics.LATENCY_BUCKETS), "sum": 0., "count": 0}
+                self.histograms[name][key] = histogram
+            for i, bound in enumerate(Metrics.LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def observe_request(
+        self,
+        service: str,
+        chain: str,
+        endpoint: str,
+        action: str,
+        latency: float,
+        status: str,
+        n_bytes: int = 0,
+        apikey: str = "") -> None:
+        """Record one outbound request attempt
+
+        :param service: `explorer`, `subgraph` or `rpc`
+        :param chain: chain the request is for
+        :param endpoint: host or subgraph name
+        :param action: explorer action, GraphQL entity or RPC method
+        :param latency: seconds spent waiting for the response
+        :param status: `ok`, `error`, `timeout` or `rate_limited`
+        :param n_bytes: response size
+        :param apikey: label of the API key used, never the key itself
+        """
+        labels = {"service": service, "chain": chain or "", "endpoint": endpoint, "action": action, "apikey": apikey}
+        self.inc("requests_total", dict(labels, status=status))
+        self.observe("request_latency_seconds", labels, latency)
+        if n_bytes:
+            self.inc("response_bytes_total", labels, n_bytes)
+        if status == "rate_limited":
+            self.inc("rate_limited_total", labels)
+
+    def observe_retry(self, service: str, chain: str, endpoint: str, action: str) -> None:
+        self.inc("retries_total", {"service": service, "chain": chain or "", "endpoint": endpoint, "action": action})
+
+    def to_json(self) -> Dict:
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in values.items()]
+                    for name, values in self.counters.items()
+                },
+                "histograms": {
+                    name: [
+                        {
+                            "labels": dict(key),
+                            "buckets": {str(bound): n for bound, n in zip(Metrics.LATENCY_BUCKETS, histogram["buckets"])},
+                            "sum": histogram["sum"],
+                            "count": histogram["count"],
+                        }
+                        for key, histogram in values.items()
+                    ]
+                    for name, values in self.histograms.items()
+                },
+            }
+
+    @staticmethod
+    def _format_labels(labels: Dict[str, str]) -> str:
+        if not labels:
+            return ""
+        items = ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in labels.items())
+        return "{" + items + "}"
+
+    def to_prometheus(self) -> str:
+        """Export in Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            for name, values in self.counters.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in values.items():
+                    lines.append(f"{metric}{Metrics._format_labels(dict(key))} {value}")
+            for name, values in self.histograms.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for key, histogram in values.items():
+                    labels = dict(key)
+                    for bound, n in zip(Metrics.LATENCY_BUCKETS, histogram["buckets"]):
+                        le = "+Inf" if math.isinf(bound) else str(bound)
+                        lines.append(f"{metric}_bucket{Metrics._format_labels(dict(labels, le=le))} {n}")
+                    lines.append(f"{metric}_sum{Metrics._format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{metric}_count{Metrics._format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """Write metrics to `path`, Prometheus text if it ends with `.prom`, JSON otherwise"""
+        with open(path, "w") as fp:
+            if path.endswith(".prom"):
+                fp.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), fp, indent=4)
+
+
+# process-wide registry used by the fetchers
+metrics = Metrics()
+
+
+def rpc_metrics_middleware(chain: str, endpoint: str) -> Callable:
+    """web3 middleware recording every JSON-RPC call of a provider into `metrics`"""
+    def middleware(make_request, w3):
+        def record(method, params):
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                response = make_request(method, params)
+                if "error" in response:
+                    status = "error"
+                return response
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                metrics.observe_request("rpc", chain, endpoint, method, time.perf_counter() - start, status)
+        return record
+    return middleware
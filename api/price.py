@@ -1,94 +1,426 @@
+from __future__ import annotations
+
 import logging
-import multiprocessing as mp
 import os
-from typing import Dict, List, Optional
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Union
 
-import pandas as pd
+import numpy as np
 
 from api.connext import ConnextAPI
+from api.executor import Executor
+from api.profiling import stage
 from api.subgraph import EthereumBlocksSubGraph, UniswapV3SubGraph
-from api.contract import SmartContract
-from api.constant import Chain
+from api.constant import Chain, ConfirmationDepth
+from api.metrics import metrics
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# (asset, blocktime, unixtime, price)
+PriceRow = Tuple[str, int, int, float]
+
+
+class PriceStore(object):
+    """
+    Prices of every asset in a single CSV of `asset,blocktime,unixtime,price`.
+
+    Rows are appended as they are fetched, in any order, and `compact` sorts
+    them by `(asset, unixtime)` and drops refetched blocks. Reads are indexed:
+    `load` returns a frame indexed by `(asset, unixtime)` and `price_at` is a
+    binary search over an asset's sorted unix times, both cached until the
+    file changes.
+    """
+
+    COLUMNS = ["asset", "blocktime", "unixtime", "price"]
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: path of the CSV, created with its header if missing
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if not os.path.exists(self.path):
+            with open(self.path, "w") as fp:
+                fp.write(",".join(PriceStore.COLUMNS) + "\n")
+        self._lock = threading.Lock()
+        self._frame: Optional[pd.DataFrame] = None
+        self._version: Optional[Tuple[float, int]] = None
+        self._series: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def __getstate__(self) -> dict:
+        # locks can't be pickled when running with process executor
+        state = self.__dict__.copy()
+        state.pop("_lock", None)
+        state.update(_frame=None, _version=None, _series={})
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def append(self, rows: Iterable[PriceRow]) -> None:
+        with self._lock, open(self.path, "a") as fp:
+            fp.writelines(f"{asset},{blocktime},{unixtime},{price}\n" for asset, blocktime, unixtime, price in rows)
+
+    def _read(self) -> pd.DataFrame:
+        import pandas as pd
+
+        stat = os.stat(self.path)
+        version = (stat.st_mtime, stat.st_size)
+        if self._frame is None or self._version != version:
+            df = pd.read_csv(self.path, dtype={"asset": str})
+            df = df.drop_duplicates(["asset", "blocktime"], keep="last").sort_values(["asset", "unixtime"], kind="stable")
+            self._frame = df.set_index(["asset", "unixtime"])
+            self._version = version
+            self._series = {}
+        return self._frame
+
+    def load(
+        self,
+        asset: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None) -> pd.DataFrame:
+        """Prices indexed by `(asset, unixtime)`, of one asset and unix times in `[start, end)` if given"""
+        df = self._read()
+        if asset is not None:
+            df = df.loc[[asset]] if asset in df.index.get_level_values(0) else df.iloc[:0]
+        if start is not None or end is not None:
+            unixtime = df.index.get_level_values("unixtime")
+            mask = np.ones(len(df), dtype=bool)
+            if start is not None:
+                mask &= unixtime >= start
+            if end is not None:
+                mask &= unixtime < end
+            df = df[mask]
+        return df
 
+    def assets(self) -> List[str]:
+        return self._read().index.get_level_values(0).unique().tolist()
 
-class WETHPriceFetcher(object):
-    """Class to fetch historical prices from
-    UniSwapV3 Subgraph, and store them in a cache
+    def series(self, asset: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Sorted unix times and prices of an asset"""
+        df = self._read()
+        if asset not in self._series:
+            df = self.load(asset)
+            self._series[asset] = (
+                df.index.get_level_values("unixtime").to_numpy(np.int64), df["price"].to_numpy(np.float64))
+        return self._series[asset]
+
+    def price_at(self, asset: str, unixtime: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        """Last price at or before `unixtime`, NaN before the first one"""
+        times, prices = self.series(asset)
+        idx = np.searchsorted(times, unixtime, side="right") - 1
+        result = np.where(idx >= 0, prices[np.maximum(idx, 0)] if len(prices) else np.nan, np.nan)
+        return float(result) if np.ndim(result) == 0 else result
+
+    def hourly(self, asset: str, how: str = "median") -> pd.Series:
+        """Price of an asset aggregated by hour, indexed by naive UTC datetimes"""
+        import pandas as pd
+
+        times, prices = self.series(asset)
+        series = pd.Series(prices, index=pd.to_datetime(times, unit="s"), name="price")
+        return series.resample("h").agg(how).dropna()
+
+    def blocks(self, asset: str) -> np.ndarray:
+        """Blocks with a price of an asset"""
+        return self.load(asset)["blocktime"].to_numpy(np.int64)
+
+    def last_block(self, asset: Optional[str] = None) -> Optional[int]:
+        """Highest block with a price, of one asset or of every asset"""
+        blocks = self.load(asset)["blocktime"] if asset is not None else self._read()["blocktime"]
+        return int(blocks.max()) if len(blocks) else None
+
+    def compact(self) -> None:
+        """Rewrite the file sorted by `(asset, unixtime)` without duplicates"""
+        with self._lock:
+            df = self._read().reset_index()[PriceStore.COLUMNS]
+            tmp_path = f"{self.path}.tmp"
+            df.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.path)
+
+    def import_legacy(self, path: str, asset: str) -> int:
+        """Append a single-asset cache of `blocktime,unixtime,price` (e.g. `weth.csv`), returns rows added"""
+        import pandas as pd
+
+        df = pd.read_csv(path)
+        self.append(
+            (asset, int(blocktime), int(unixtime), float(price))
+            for blocktime, unixtime, price in zip(df["blocktime"], df["unixtime"], df["price"]))
+        self.compact()
+        return len(df)
+
+
+class PriceFetcher(object):
+    """Class to fetch historical prices of several assets from
+    UniSwapV3 Subgraph pools, and store them in a shared `PriceStore`
+
+    Blocks are fetched in batches: one aliased query returns the price of
+    every pool at every block of the batch, one query their unix times, so
+    adding an asset doesn't add requests.
+
+    `multiprocess_fetch` backfills every block up to the current head once,
+    `follow` keeps tailing the chain head and appends new blocks as they are
+    confirmed, with the last price of each asset in `latest`.
     """
 
+    # seconds between Ethereum blocks
+    BLOCK_TIME = 12.
+
+    # asset -> (Uniswap V3 pool id, field of the pool quoting the asset in USDC)
+    DEFAULT_POOLS = {
+        "WETH": ("0x88e6a0c2ddd26feeb64f039a2c41296fcb3f5640", "token0Price"),
+    }
+
     def __init__(
         self,
-        data_dir: str = "data",) -> None:
+        data_dir: str = "data",
+        pools: Optional[Dict[str, Tuple[str, str]]] = None,
+        batch_size: int = 50) -> None:
         """
         :param data_dir: directory to store cache
+        :param pools: asset -> (pool id, `token0Price` or `token1Price`), defaults to `DEFAULT_POOLS`
+        :param batch_size: blocks per subgraph query
         """
         self.data_dir = data_dir
-        self.save_path = f"{self.data_dir}/amarok_prices/weth.csv"
-        os.makedirs(os.path.dirname(self.save_path), exist_ok=True)
-        if not os.path.exists(self.save_path):
-            with open(self.save_path, "w") as fp:
-                fp.write("blocktime,unixtime,price\n")
+        self.pools = dict(pools or PriceFetcher.DEFAULT_POOLS)
+        self.batch_size = batch_size
+        self.store = PriceStore(f"{self.data_dir}/amarok_prices/prices.csv")
+        # caches of the WETH-only fetcher are imported once
+        legacy_path = f"{self.data_dir}/amarok_prices/weth.csv"
+        if os.path.exists(legacy_path) and self.store.last_block() is None:
+            n_rows = self.store.import_legacy(legacy_path, "WETH")
+            logging.info(f"Imported {n_rows} prices from {legacy_path}")
 
         self.eth_block_sg = EthereumBlocksSubGraph()
         self.univ3_sg = UniswapV3SubGraph()
+        # asset -> (blocktime, unixtime, price) of the last block appended by `follow`
+        self.latest: Dict[str, Tuple[int, int, float]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
 
-    def load_cache(self) -> pd.DataFrame:
-        """Load cache from data directory"""
+    def __getstate__(self) -> dict:
+        # threads can't be pickled when running with process executor
+        state = self.__dict__.copy()
+        for key in ["_stop", "_thread"]:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load_cache(self, asset: Optional[str] = None) -> pd.DataFrame:
+        """Load cache from data directory, with columns `asset,blocktime,unixtime,price`"""
         logging.info("Loading cache")
-        return pd.read_csv(self.save_path)
+        return self.store.load(asset).reset_index()[PriceStore.COLUMNS]
 
-    def fetch_eth_price(self, blocktime: int) -> None:
-        """Fetch price of token at blocktime and save to cache
+    def get_prices(self, blocks: List[int]) -> List[PriceRow]:
+        """Prices of every asset at blocks, blocks the subgraphs don't have yet are missing"""
+        with stage("blocktime"):
+            unixtimes = self.eth_block_sg.get_unix_from_blocktimes(blocks)
+        blocks = [block for block in blocks if block in unixtimes]
+        if not blocks:
+            return []
+        pool_ids = [pool_id for pool_id, _ in self.pools.values()]
+        with stage("price"):
+            try:
+                pools = self.univ3_sg.get_pool_prices(pool_ids, blocks)
+            except ConnectionError:
+                # the pools subgraph can lag the blocks subgraph, fetch the blocks it indexed
+                indexed = self.univ3_sg.get_indexed_block()
+                if indexed is None or max(blocks) <= indexed:
+                    raise
+                blocks = [block for block in blocks if block <= indexed]
+                if not blocks:
+                    return []
+                pools = self.univ3_sg.get_pool_prices(pool_ids, blocks)
+
+        rows = []
+        for block in blocks:
+            by_id = {pool["id"].lower(): pool for pool in pools.get(block, [])}
+            for asset, (pool_id, field) in self.pools.items():
+                pool = by_id.get(pool_id.lower())
+                if pool is not None:
+                    rows.append((asset, block, unixtimes[block], float(pool[field])))
+        return rows
+
+    def fetch_batch(self, blocks: List[int]) -> int:
+        """Fetch prices at blocks and save to cache, returns rows saved"""
+        rows = self.get_prices(blocks)
+        self.store.append(rows)
+        return len(rows)
+
+    def missing_blocks(self, start_block: int, end_block: int) -> List[int]:
+        """Blocks in `[start_block, end_block)` without the price of some asset"""
+        missing = np.zeros(0, dtype=np.int64)
+        blocks = np.arange(start_block, end_block, dtype=np.int64)
+        for asset in self.pools.keys():
+            missing = np.union1d(missing, np.setdiff1d(blocks, self.store.blocks(asset), assume_unique=True))
+        return missing.tolist()
+
+    def multiprocess_fetch(
+        self,
+        num_workers: int = Executor.DEFAULT_NUM_WORKERS,
+        executor: str = Executor.DEFAULT_MODE,
+        start_block: Optional[int] = None,
+        end_block: Optional[int] = None) -> int:
+        """Fetch prices of every asset at every block missing from the cache
+
+        :param num_workers: number of concurrent workers
+        :param executor: concurrency backend (thread|async|process)
+        :param start_block: first block, defaults to the Connext deployment on Ethereum
+        :param end_block: block after the last one, defaults to the current head
+
+        :returns: number of prices fetched
+        """
+        from api.contract import SmartContract
+
+        if start_block is None:
+            start_block = ConnextAPI.get_init_block(Chain.ETHEREUM)
+        if end_block is None:
+            end_block = SmartContract.get_default_provider(Chain.ETHEREUM).eth.get_block_number()
+
+        blocks = self.missing_blocks(start_block, end_block)
+        batches = [blocks[i: i + self.batch_size] for i in range(0, len(blocks), self.batch_size)]
+        logging.info(
+            f"Fetching prices of {len(self.pools)} assets from block {start_block} to {end_block} "
+            f"({len(blocks)} blocks, {len(batches)} batches)")
+
+        n_rows = sum(Executor(executor, num_workers).map(self.fetch_batch, batches))
+        self.store.compact()
+        return n_rows
+
+    def latest_price(self, asset: str = "WETH") -> Optional[float]:
+        """Price at the last block appended by `follow`, None before the first one"""
+        latest = self.latest.get(asset)
+        return latest[2] if latest is not None else None
+
+    def poll(
+        self,
+        start_block: int,
+        confirmations: int = 0,
+        max_blocks: int = 100,
+        num_workers: int = 8,
+        executor: str = Executor.THREAD) -> int:
+        """Fetch and append prices of confirmed blocks from `start_block` on, returns the next block to fetch
+
+        Blocks are appended in order up to the first one the subgraphs haven't
+        indexed yet, which is fetched again on the next poll.
+
+        :param start_block: first block to fetch
+        :param confirmations: blocks behind the head not fetched yet
+        :param max_blocks: blocks fetched per poll when catching up
+        :param num_workers: concurrent workers
+        :param executor: concurrency backend (thread|async), batches are fetched concurrently
+        """
+        from api.contract import SmartContract
+
+        head = SmartContract.get_default_provider(Chain.ETHEREUM).eth.block_number - confirmations
+        end_block = min(head, start_block + max_blocks - 1)
+        if end_block < start_block:
+            return start_block
+
+        blocks = list(range(start_block, end_block + 1))
+        batches = [blocks[i: i + self.batch_size] for i in range(0, len(blocks), self.batch_size)]
+        rows = [row for batch in Executor(executor, num_workers).map(self.get_prices, batches) for row in batch]
+        fetched = {row[1] for row in rows}
+        next_block = next((block for block in blocks if block not in fetched), end_block + 1)
+        rows = [row for row in rows if row[1] < next_block]
+        if rows:
+            self.store.append(rows)
+            n_rows: Dict[str, int] = {}
+            for asset, blocktime, unixtime, price in rows:
+                self.latest[asset] = (blocktime, unixtime, price)
+                n_rows[asset] = n_rows.get(asset, 0) + 1
+            for asset, n in n_rows.items():
+                metrics.inc("price_blocks_total", {"asset": asset}, n)
+            logging.info(f"Appended prices of blocks [{start_block}, {next_block - 1}], head {head}")
+        return next_block
+
+    def follow(
+        self,
+        start_block: Optional[int] = None,
+        poll_interval: float = BLOCK_TIME,
+        confirmations: Optional[int] = None,
+        max_blocks: int = 100,
+        num_workers: int = 8,
+        executor: str = Executor.THREAD,
+        max_polls: Optional[int] = None) -> None:
+        """Tail the chain head, appending the prices of every new block until `stop` is called
+
+        :param start_block: first block to fetch, defaults to the one after the cache, or the head if the cache is empty
+        :param poll_interval: seconds between polls once caught up with the head
+        :param confirmations: blocks behind the head not fetched yet, defaults to `ConfirmationDepth.ETHEREUM`
+            as the subgraphs lag behind the head
+        :param max_blocks: blocks fetched per poll when catching up
+        :param num_workers: concurrent workers per poll
+        :param executor: concurrency backend (thread|async)
+        :param max_polls: stop after this many polls, None to run until `stop`
         """
-        unixtime = self.eth_block_sg.get_unix_from_blocktime(blocktime)
-        if isinstance(unixtime, list):
-            if len(unixtime) == 1:
-                unixtime = unixtime[0]
-            if len(unixtime) > 1:
-                logging.warning(f"Got multiple unixtimes for blocktime {blocktime}, using first")
+        from api.contract import SmartContract
+
+        if confirmations is None:
+            confirmations = ConfirmationDepth.ETHEREUM
+        if start_block is None:
+            last_block = self.store.last_block()
+            if last_block is not None:
+                start_block = last_block + 1
             else:
-                logging.warning(f"Got no unixtimes for blocktime {blocktime}, skipping")
-                return
-        
-        prices = self.univ3_sg.get_weth_price(blocktime)
+                start_block = SmartContract.get_default_provider(Chain.ETHEREUM).eth.block_number - confirmations
+        logging.info(f"Following prices of {', '.join(self.pools.keys())} from block {start_block}")
+
+        n_polls = 0
+        while not self._stop.is_set() and (max_polls is None or n_polls < max_polls):
+            next_block = start_block
+            try:
+                next_block = self.poll(start_block, confirmations, max_blocks, num_workers, executor)
+            except Exception as e:
+                # keep following through transient RPC or subgraph outages
+                logging.warning(f"Price poll from block {start_block} failed: {e}")
+            n_polls += 1
+            caught_up = next_block - start_block < max_blocks
+            start_block = next_block
+            if caught_up:
+                self._stop.wait(poll_interval)
+        self._stop.clear()
 
-        
-        with open(self.save_path, "a") as fp:
-            fp.write(f"{blocktime},{unixtime},{prices}\n")
+    def start(self, **kwargs) -> threading.Thread:
+        """Run `follow` in a daemon thread, `kwargs` are passed to `follow`"""
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError("Already following")
+        self._thread = threading.Thread(target=self.follow, kwargs=kwargs, name="price", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop `follow` after the current poll"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class WETHPriceFetcher(PriceFetcher):
+    """`PriceFetcher` of WETH only, with the `blocktime,unixtime,price` frame of the former `weth.csv`"""
+
+    def __init__(self, data_dir: str = "data", batch_size: int = 50) -> None:
+        """
+        :param data_dir: directory to store cache
+        :param batch_size: blocks per subgraph query
+        """
+        super().__init__(data_dir, {"WETH": PriceFetcher.DEFAULT_POOLS["WETH"]}, batch_size)
+
+    def load_cache(self, asset: Optional[str] = "WETH") -> pd.DataFrame:
+        """Load cache from data directory"""
+        return super().load_cache(asset)[["blocktime", "unixtime", "price"]]
+
+    def fetch_eth_price(self, blocktime: int) -> None:
+        """Fetch price of token at blocktime and save to cache
+        """
+        self.fetch_batch([blocktime])
 
     def sort_cache(self) -> None:
         """Sort cache by blocktime"""
-        df = self.load_cache()
-        df = df.sort_values("blocktime").drop_duplicates()
-        df.to_csv(self.save_path, index=False)
-    
-    def multiprocess_fetch(self, num_workers: Optional[int] = None) -> Dict[str, Dict[str, float]]:
-        """Fetch prices of tokens at blocktimes
-
-        :param blocktimes: blocktimes to fetch prices at
-
-        :returns: dict of prices in the following format:
-            {
-                "token": {
-                    "blocktime": blocktime,
-                    "unixtime": unixtime,
-                    "price": price,
-                }
-            }
-        """
-        if num_workers is None:
-            num_workers = mp.cpu_count() - 1
-        # get blocktimes
-        provider = SmartContract.get_default_provider(Chain.ETHEREUM)
-        start_block = ConnextAPI.get_init_block(Chain.ETHEREUM)
-        end_block = provider.eth.get_block_number()
-
-        data = self.load_cache()
-        blocks = sorted(set(range(start_block, end_block)) - set(data["blocktime"].unique()))
-        logging.info(f"Fetching prices from block {start_block} to {end_block} ({len(blocks)} blocks)")
-        
-        pool = mp.Pool(num_workers)
-        pool.map(
-            self.fetch_eth_price, 
-            blocks)
-        self.sort_cache()
+        self.store.compact()
@@ -0,0 +1,129 @@
+import cProfile
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from api.metrics import metrics
+
+
+class StageTimer(object):
+    """
+    Opt-in wall-clock timings of pipeline stages (fetch, decode, receipt, save, load, ...).
+
+    Disabled by default, `stage` is then a near no-op so it can wrap hot paths.
+    Enabled timings are accumulated here and recorded into the
+    `stage_seconds` histogram of `api.metrics.metrics`.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self.totals: Dict[str, Dict[str, float]] = {}
+
+    def record(self, name: str, elapsed: float) -> None:
+        with self._lock:
+            total = self.totals.setdefault(name, {"count": 0, "total_sec": 0., "max_sec": 0.})
+            total["count"] += 1
+            total["total_sec"] += elapsed
+            total["max_sec"] = max(total["max_sec"], elapsed)
+        metrics.observe("stage_seconds", {"stage": name}, elapsed)
+
+    def summary(self) -> str:
+        """Table of stages sorted by total time"""
+        lines = [f"{'stage':<20}{'count':>10}{'total (s)':>12}{'mean (ms)':>12}{'max (ms)':>12}"]
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda x: -x[1]["total_sec"])
+        for name, total in totals:
+            mean_ms = 1000 * total["total_sec"] / total["count"]
+            lines.append(
+                f"{name:<20}{total['count']:>10}{total['total_sec']:>12.3f}{mean_ms:>12.3f}{1000 * total['max_sec']:>12.3f}")
+        return "\n".join(lines)
+
+
+class _Stage(object):
+
+    __slots__ = ["timer", "name", "start"]
+
+    def __init__(self, timer: StageTimer, name: str) -> None:
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self) -> "_Stage":
+        if self.timer.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.start is not None:
+            self.timer.record(self.name, time.perf_counter() - self.start)
+
+
+# process-wide stage timer
+timer = StageTimer()
+
+
+def stage(name: str) -> _Stage:
+    """Time the enclosed block as stage `name` when profiling is enabled
+
+    >>> with stage("receipt"):
+    ...     resolve(tx)
+    """
+    return _Stage(timer, name)
+
+
+@contextmanager
+def profile(
+    cprofile_path: Optional[str] = None,
+    tracemalloc_path: Optional[str] = None,
+    stages: bool = True,
+    top: int = 30) -> Iterator[None]:
+    """Profile the enclosed block
+
+    :param cprofile_path: write cProfile stats here (load with `pstats` or snakeviz)
+    :param tracemalloc_path: write top allocation sites and peak memory here
+    :param stages: enable stage timings and log their summary on exit
+    :param top: number of entries in the tracemalloc report
+    """
+    profiler = cProfile.Profile() if cprofile_path is not None else None
+    if stages:
+        timer.enable()
+    if tracemalloc_path is not None:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+            logging.info(f"cProfile stats written to {cprofile_path}")
+            if logging.root.isEnabledFor(logging.DEBUG):
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+        if tracemalloc_path is not None:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(tracemalloc_path, "w") as fp:
+                fp.write(f"peak traced memory: {peak / 2**20:.2f} MB\n")
+                for stat in snapshot.statistics("lineno")[:top]:
+                    fp.write(f"{stat}\n")
+            logging.info(f"tracemalloc report written to {tracemalloc_path}")
+        if stages:
+            timer.disable()
+            logging.info(f"Stage timings:\n{timer.summary()}")
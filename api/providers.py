@@ -0,0 +1,275 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, TypeVar
+from urllib.parse import urlparse
+
+from api.constant import Chain
+from api.metrics import metrics
+from api.retry import CircuitBreaker, RetryPolicy, health
+
+T = TypeVar("T")
+
+
+class EndpointStats(object):
+    """Exponentially weighted latency and error rate of an endpoint, and its requests in flight"""
+
+    def __init__(self, alpha: float = 0.2, window: int = 200) -> None:
+        """
+        :param alpha: weight of the latest observation in the moving averages
+        :param window: recent latencies kept for the hedging quantile
+        """
+        self.alpha = alpha
+        self.latency = 0.
+        self.error_rate = 0.
+        self.n_requests = 0
+        self.in_flight = 0
+        self.recent: deque = deque(maxlen=window)
+
+    def __repr__(self) -> str:
+        return (f"EndpointStats(latency={self.latency:.3f}, error_rate={self.error_rate:.3f}, "
+                f"n_requests={self.n_requests}, in_flight={self.in_flight})")
+
+    def observe(self, latency: float, failed: bool) -> None:
+        if self.n_requests == 0:
+            self.latency = latency
+        elif not failed:
+            # failures are often fast, they'd make a broken endpoint look good
+            self.latency += self.alpha * (latency - self.latency)
+        self.error_rate += self.alpha * (float(failed) - self.error_rate)
+        self.n_requests += 1
+        if not failed:
+            self.recent.append(latency)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        latencies = sorted(self.recent)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class ProviderPool(object):
+    """
+    JSON-RPC endpoints of a chain, routing each request to the endpoint with the
+    best expected latency: the moving average latency, scaled up by requests in
+    flight (so concurrent requests spread over endpoints) and by the error rate.
+    Endpoints whose circuit is open in `api.retry.health` are skipped.
+
+    A request still pending after the `hedge_quantile` latency of its endpoint
+    is hedged: the same request is sent to the next best endpoint and the first
+    response wins. At most `hedge_budget` of the requests are hedged so a slow
+    chain doesn't double its load, and only read methods are hedged.
+    """
+
+    # methods with side effects, never sent twice
+    UNHEDGED_METHODS = ["eth_sendRawTransaction", "eth_sendTransaction"]
+
+    def __init__(
+        self,
+        chain: Chain,
+        urls: List[str],
+        hedge_quantile: float = 0.95,
+        hedge_after: Optional[float] = None,
+        hedge_budget: float = 0.1,
+        min_samples: int = 20,
+        max_workers: int = 64) -> None:
+        """
+        :param chain: chain of the endpoints
+        :param urls: endpoints, the first one is the primary used before latencies are known
+        :param hedge_quantile: latency quantile of an endpoint after which its request is hedged
+        :param hedge_after: fixed hedging delay in seconds, overrides `hedge_quantile`
+        :param hedge_budget: max fraction of requests hedged, 0 to disable hedging
+        :param min_samples: latencies observed on an endpoint before hedging its requests
+        :param max_workers: threads sending hedged requests
+        """
+        if not urls:
+            raise ValueError(f"No RPC endpoint for {chain}")
+        self.chain = chain
+        self.urls = list(dict.fromkeys(urls))
+        self.hedge_quantile = hedge_quantile
+        self.hedge_after = hedge_after
+        self.hedge_budget = hedge_budget
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"ProviderPool(chain={self.chain}, urls={self.urls})"
+
+    def reset(self) -> None:
+        """Forget observed latencies, the thread pool is rebuilt on the next hedge"""
+        self._lock = threading.Lock()
+        self.stats: Dict[str, EndpointStats] = {url: EndpointStats() for url in self.urls}
+        self.n_requests = 0
+        self.n_hedged = 0
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def score(self, url: str) -> float:
+        """Expected cost of sending a request to `url`, lower is better"""
+        stats = self.stats[url]
+        return (stats.latency + 1e-3) * (1 + stats.in_flight) / (1 - min(stats.error_rate, 0.9))
+
+    def rank(self) -> List[str]:
+        """Endpoints by score, those with an open circuit last"""
+        # stable, the configured order breaks ties before latencies are known
+        return sorted(self.urls, key=lambda url: (health.breaker(url).state == CircuitBreaker.OPEN, self.score(url)))
+
+    def hedge_delay(self, url: str) -> Optional[float]:
+        """Seconds before hedging a request to `url`, None to not hedge it"""
+        if len(self.urls) < 2 or self.n_hedged >= self.hedge_budget * max(self.n_requests, 1):
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        stats = self.stats[url]
+        if len(stats.recent) < self.min_samples:
+            return None
+        return stats.quantile(self.hedge_quantile)
+
+    def _timed(self, send: Callable[[str], T], url: str) -> T:
+        stats = self.stats[url]
+        with self._lock:
+            stats.in_flight += 1
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = send(url)
+            failed = False
+            return result
+        finally:
+            with self._lock:
+                stats.in_flight -= 1
+                stats.observe(time.perf_counter() - start, failed)
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"hedge-{self.chain}")
+        return self._pool
+
+    def _hedge_target(self, url: str) -> Optional[str]:
+        for candidate in self.rank():
+            if candidate != url and health.breaker(candidate).state == CircuitBreaker.CLOSED:
+                return candidate
+        return None
+
+    def request(self, send: Callable[[str], T], url: str, method: str = "") -> T:
+        """Send a request to `url` with `send(endpoint)`, hedged to another endpoint if slow
+
+        The outcome of each endpoint is recorded on its breaker from its own
+        request, so a winning hedge doesn't mark a hung primary as healthy.
+
+        :param send: sends the request to an endpoint and returns the response
+        :param url: endpoint picked by `rank`
+        :param method: RPC method, requests with side effects aren't hedged
+        """
+        with self._lock:
+            self.n_requests += 1
+        delay = None if method in ProviderPool.UNHEDGED_METHODS else self.hedge_delay(url)
+        if delay is None:
+            return self._recorded(url, lambda: self._timed(send, url))
+
+        primary = self._executor().submit(self._timed, send, url)
+        done, _ = wait([primary], timeout=delay)
+        target = None if done else self._hedge_target(url)
+        if target is None:
+            return self._recorded(url, primary.result)
+
+        with self._lock:
+            self.n_hedged += 1
+        host = urlparse(target).netloc
+        labels = {"service": "rpc", "chain": self.chain, "endpoint": host, "action": method}
+        metrics.inc("hedged_requests_total", labels)
+        logging.debug(f"Hedging {method} on {self.chain} to {host} after {delay:.3f}s")
+        hedge = self._executor().submit(self._timed, send, target)
+        # each endpoint's outcome comes from its own future, a winning hedge says nothing of the primary
+        primary.add_done_callback(lambda future: self._record(url, future.exception()))
+        hedge.add_done_callback(lambda future: self._record(target, future.exception()))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.inc("hedge_wins_total", labels)
+                    return future.result()
+        raise primary.exception()
+
+    def _recorded(self, url: str, fn: Callable[[], T]) -> T:
+        try:
+            result = fn()
+        except Exception as e:
+            self._record(url, e)
+            raise
+        self._record(url, None)
+        return result
+
+    def _record(self, url: str, error: Optional[BaseException]) -> None:
+        """Record the outcome of a request to `url` on its breaker, like `RetryPolicy.call`"""
+        breaker = health.breaker(url)
+        if error is None or not RetryPolicy.is_retryable(error) or not RetryPolicy.is_endpoint_failure(error):
+            # the endpoint answered
+            breaker.record_success()
+        elif breaker.record_failure():
+            logging.warning(f"Circuit opened for {url} after {breaker.failures} failures: {error}")
+            metrics.inc("circuit_opened_total", {"service": "rpc", "chain": self.chain, "endpoint": urlparse(url).netloc})
+
+
+class ProviderPools(object):
+    """
+    Provider pool of each chain. The endpoints of a chain are set with
+    `set_urls`, or read from the comma-separated `{CHAIN}_RPC_URLS` environment
+    variable (e.g. `GNOSIS_RPC_URLS`) as alternates of
+    `SmartContract.default_providers`.
+
+    Latencies are per process, forked children start from scratch.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.urls: Dict[Chain, List[str]] = {}
+        self.pools: Dict[Chain, ProviderPool] = {}
+
+    def set_urls(self, chain: Chain, urls: List[str], **kwargs) -> ProviderPool:
+        """Replace the endpoints of a chain, `kwargs` are passed to `ProviderPool`"""
+        with self._lock:
+            self.urls[chain] = list(urls)
+            self.pools[chain] = ProviderPool(chain, urls, **kwargs)
+            return self.pools[chain]
+
+    def get(self, chain: Chain) -> ProviderPool:
+        pool = self.pools.get(chain)
+        if pool is None:
+            from api.contract import SmartContract
+
+            with self._lock:
+                if chain not in self.pools:
+                    urls = self.urls.get(chain)
+                    if urls is None:
+                        extra = os.getenv(f"{chain.upper()}_RPC_URLS", "")
+                        urls = [SmartContract.default_providers[chain]] + [url.strip() for url in extra.split(",") if url.strip()]
+                    self.pools[chain] = ProviderPool(chain, urls)
+                pool = self.pools[chain]
+        return pool
+
+    def find(self, chain: Chain, url: str) -> Optional[ProviderPool]:
+        """Pool of a chain if `url` is one of its endpoints"""
+        pool = self.pools.get(chain)
+        if pool is None and (chain in self.urls or os.getenv(f"{chain.upper()}_RPC_URLS")):
+            pool = self.get(chain)
+        return pool if pool is not None and url in pool.urls else None
+
+    def primary(self, chain: Chain) -> str:
+        """First configured endpoint of a chain, the provider of contract calls"""
+        return self.get(chain).urls[0]
+
+    def reset(self) -> None:
+        for pool in list(self.pools.values()):
+            pool.reset()
+
+
+pools = ProviderPools()
+os.register_at_fork(after_in_child=pools.reset)
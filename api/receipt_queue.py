@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import time
+from glob import glob
+from typing import List, Optional, Tuple
+
+from api.constant import Chain
+from api.store import TxnStore
+
+
+class PendingReceiptQueue(object):
+    """
+    Persistent queue of transactions whose receipt hasn't been resolved yet.
+
+    Each pending transaction is an empty marker file at
+    `{queue_dir}/pending/{chain}/{key}`, its `TxnStore` row key. A worker claims a transaction by
+    atomically renaming its marker into `{queue_dir}/inflight`, so several
+    processes can drain the same queue without resolving a receipt twice.
+    """
+
+    def __init__(self, queue_dir: str) -> None:
+        """
+        :param queue_dir: directory to store queue markers
+        """
+        self.queue_dir = queue_dir
+        self.pending_dir = f"{queue_dir}/pending"
+        self.inflight_dir = f"{queue_dir}/inflight"
+
+    def exists(self) -> bool:
+        """Whether the queue has been built from the cache on disk"""
+        return os.path.exists(f"{self.queue_dir}/.initialized")
+
+    def _pending_path(self, chain: Chain, tx_hash: str) -> str:
+        return f"{self.pending_dir}/{chain}/{tx_hash}"
+
+    def _inflight_path(self, chain: Chain, tx_hash: str) -> str:
+        return f"{self.inflight_dir}/{chain}/{tx_hash}"
+
+    def push(self, chain: Chain, tx_hash: str) -> None:
+        """Add transaction to the queue, no-op if already queued or claimed"""
+        if os.path.exists(self._inflight_path(chain, tx_hash)):
+            return
+        path = self._pending_path(chain, tx_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a"):
+            pass
+
+    def discard(self, chain: Chain, tx_hash: str) -> None:
+        """Drop transaction from the queue, e.g. when it was reorged out"""
+        for path in [self._pending_path(chain, tx_hash), self._inflight_path(chain, tx_hash)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def pending(self, chain: Optional[Chain] = None) -> List[Tuple[Chain, str]]:
+        """List queued (chain, key) pairs, optionally for one chain only"""
+        if not os.path.exists(self.pending_dir):
+            return []
+        chains = [chain] if chain is not None else sorted(os.listdir(self.pending_dir))
+        items = []
+        for _chain in chains:
+            chain_dir = f"{self.pending_dir}/{_chain}"
+            if not os.path.exists(chain_dir):
+                continue
+            items.extend((_chain, tx_hash) for tx_hash in sorted(os.listdir(chain_dir)))
+        return items
+
+    def __len__(self) -> int:
+        return len(self.pending())
+
+    def claim(self, chain: Chain, tx_hash: str) -> bool:
+        """Claim transaction for processing, returns False if another worker got it first"""
+        dst = self._inflight_path(chain, tx_hash)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.rename(self._pending_path(chain, tx_hash), dst)
+        except FileNotFoundError:
+            return False
+        # rename keeps mtime, touch it to record when the claim happened
+        os.utime(dst)
+        return True
+
+    def complete(self, chain: Chain, tx_hash: str) -> None:
+        """Remove claimed transaction from the queue"""
+        try:
+            os.remove(self._inflight_path(chain, tx_hash))
+        except FileNotFoundError:
+            pass
+
+    def release(self, chain: Chain, tx_hash: str) -> None:
+        """Put claimed transaction back to the queue"""
+        dst = self._pending_path(chain, tx_hash)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.rename(self._inflight_path(chain, tx_hash), dst)
+        except FileNotFoundError:
+            pass
+
+    def recover(self, max_age: float = 600.) -> int:
+        """Re-queue claims older than `max_age` seconds left by crashed workers"""
+        if not os.path.exists(self.inflight_dir):
+            return 0
+        now = time.time()
+        n_recovered = 0
+        for chain in os.listdir(self.inflight_dir):
+            for tx_hash in os.listdir(f"{self.inflight_dir}/{chain}"):
+                path = self._inflight_path(chain, tx_hash)
+                try:
+                    if now - os.path.getmtime(path) < max_age:
+                        continue
+                except FileNotFoundError:
+                    continue
+                self.release(chain, tx_hash)
+                n_recovered += 1
+        if n_recovered > 0:
+            logging.info(f"Recovered {n_recovered} stale receipt claims")
+        return n_recovered
+
+    def rebuild(self, data_path: str) -> int:
+        """Initialize queue from an existing cache by scanning every transaction once"""
+        logging.info(f"Building pending receipt queue from `{data_path}`")
+        os.makedirs(self.pending_dir, exist_ok=True)
+        n_pending = 0
+        for json_path in glob(f"{data_path}/*/*.json"):
+            with open(json_path, "r") as fp:
+                tx = json.load(fp)
+            if tx.get("logs") is None:
+                self.push(tx["chain"], TxnStore.key(tx["hash"], tx.get("logIndex")))
+                n_pending += 1
+        with open(f"{self.queue_dir}/.initialized", "w"):
+            pass
+        return n_pending
@@ -0,0 +1,86 @@
+import logging
+from typing import Dict, List, Optional
+
+from api.archive import ResponseArchive
+from api.constant import Chain
+from api.scan import ScanAPI, ScanTxn
+from api.store import TxnStore
+
+
+class ArchiveReplay(object):
+    """
+    Re-derive transactions from archived explorer responses, without network calls.
+
+    Pages are replayed in fetch order per stream (action and address). Like
+    `ConnextAPI.refresh_tail`, a fetch starting at block `S` replaces every row
+    of its stream replayed so far from `S` on, so reorged-out rows don't come back.
+    Parsing goes through `ScanAPI.parse_transactions` and
+    `ScanAPI.parse_transfer_events`, so parser changes apply on replay.
+    """
+
+    PAGING_PARAMS = ["page", "offset", "startblock", "endblock", "sort"]
+
+    def __init__(self, archive: ResponseArchive) -> None:
+        """
+        :param archive: enabled archive to replay
+        """
+        self.archive = archive
+
+    def replay_rows(self, chain: Chain, action: str, addresses: Optional[List[str]] = None) -> List[dict]:
+        """Raw explorer rows of `action`, as of the latest fetch of each stream
+
+        :param chain: chain to replay
+        :param action: explorer action, e.g. `txlist`
+        :param addresses: only streams of these `address` / `contractaddress`
+        """
+        if addresses is not None:
+            addresses = {address.lower() for address in addresses}
+
+        def match(entry: Dict) -> bool:
+            params = entry["params"]
+            address = params.get("address", params.get("contractaddress", ""))
+            return addresses is None or address.lower() in addresses
+
+        streams: Dict[str, List[dict]] = {}
+        for entry, response in self.archive.responses("explorer", chain, action=action, where=match):
+            params = entry["params"]
+            stream = str(sorted((k, str(v)) for k, v in params.items() if k not in ArchiveReplay.PAGING_PARAMS))
+            rows = streams.setdefault(stream, [])
+            if int(params.get("page", 1)) == 1:
+                start_block = int(params.get("startblock", 0))
+                rows[:] = [row for row in rows if int(row["blockNumber"]) < start_block]
+            rows.extend(response["result"] or [])
+        return [row for rows in streams.values() for row in rows]
+
+    def receipts(self, chain: Chain) -> Dict[str, dict]:
+        """Latest archived receipt per transaction hash"""
+        receipts = {}
+        for _, response in self.archive.responses("explorer", chain, action="eth_getTransactionReceipt"):
+            receipt = response["result"]
+            if isinstance(receipt, dict):
+                receipts[receipt["transactionHash"]] = receipt
+        return receipts
+
+    def _finalize(self, chain: Chain, txs: List[ScanTxn]) -> List[ScanTxn]:
+        receipts = self.receipts(chain)
+        # dedup by row key, later fetches win
+        txs = list({TxnStore.tx_key(tx): tx for tx in txs}.values())
+        n_resolved = 0
+        for tx in txs:
+            receipt = receipts.get(tx.hash)
+            # receipts of a reorged block don't apply
+            if receipt is not None and receipt.get("blockHash", tx.blockHash) == tx.blockHash:
+                tx.logs = receipt["logs"]
+                n_resolved += 1
+        logging.info(f"Replayed {len(txs)} transactions on {chain}, {n_resolved} with receipt")
+        return sorted(txs, key=lambda x: x.blockNumber)
+
+    def transactions(self, scan_api: ScanAPI, address: str) -> List[ScanTxn]:
+        """Transactions of `address`, as fetched by `ScanAPI.get_transaction_by_address`"""
+        rows = self.replay_rows(scan_api.chain, "txlist", [address])
+        return self._finalize(scan_api.chain, scan_api.parse_transactions(rows))
+
+    def transfers(self, scan_api: ScanAPI, token_addresses: List[str]) -> List[ScanTxn]:
+        """Token transfers, as fetched by `ScanAPI.get_transfer_events`"""
+        rows = self.replay_rows(scan_api.chain, "tokentx", token_addresses)
+        return self._finalize(scan_api.chain, scan_api.parse_transfer_events(rows))
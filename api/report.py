@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+import glob
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from api.analytics import AnalyticsRunner, LPAnalytics
+from api.constant import Chain
+from api.metrics import metrics
+from api.profiling import stage
+from api.store import TxnStore
+from api.token import Token
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def digest(*parts) -> str:
+    """sha256 of JSON-serializable parts"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def frame_digest(frame: pd.DataFrame) -> str:
+    """sha256 of the values and index of a frame, independent of its memory layout"""
+    import pandas as pd
+
+    hashes = pd.util.hash_pandas_object(frame, index=True).to_numpy()
+    return hashlib.sha256(hashes.tobytes() + ",".join(map(str, frame.columns)).encode()).hexdigest()
+
+
+class ArtifactCache(object):
+    """
+    Pickled frames of the report stages at `{cache_dir}/{stage}/{name}-{key}.pkl`.
+
+    An artifact is found by the key of its inputs, so a changed input is a
+    miss and never a stale hit. Writing an artifact removes the older ones of
+    the same name.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        """
+        :param cache_dir: directory of the artifacts
+        """
+        self.cache_dir = cache_dir
+
+    def path(self, stage: str, name: str, key: str) -> str:
+        return f"{self.cache_dir}/{stage}/{name}-{key[:32]}.pkl"
+
+    def get(self, stage: str, name: str, key: str) -> Optional[pd.DataFrame]:
+        import pandas as pd
+
+        path = self.path(stage, name, key)
+        if not os.path.exists(path):
+            metrics.inc("report_artifacts_total", {"stage": stage, "result": "miss"})
+            return None
+        metrics.inc("report_artifacts_total", {"stage": stage, "result": "hit"})
+        return pd.read_pickle(path)
+
+    def put(self, stage: str, name: str, key: str, frame: pd.DataFrame) -> pd.DataFrame:
+        path = self.path(stage, name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        frame.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        for stale_path in glob.glob(f"{self.cache_dir}/{stage}/{glob.escape(name)}-*.pkl"):
+            if stale_path != path:
+                os.remove(stale_path)
+        return frame
+
+
+class CampaignReport(object):
+    """
+    LP campaign report of the notebook, computed in stages whose outputs are
+    cached by the content hash of their inputs:
+
+    1. `events`: decoded LP events of a chain (`LPAnalytics.get_lp_txs`), keyed
+       by the cached transaction files of the chain
+    2. `priced`: the events with values (`LPAnalytics.join_price`), keyed by
+       the events and the WETH prices of the hours with WETH LP events
+    3. `scores`: balance, value and time-weighted score of each wallet of a
+       `(chain, token)`, keyed by its priced events and the scoring window
+    4. thresholds: qualified wallets and minimum score or balance, always
+       recomputed as they only sort the wallets
+
+    After a refresh only the chains whose transactions changed are decoded
+    again, and only the `(chain, token)` whose events or prices changed are
+    scored again. Hashing a chain's transactions reads only the files whose
+    size or mtime changed since the last run, other digests are kept in
+    `{cache_dir}/manifests`.
+    """
+
+    # bump a stage's version when its computation changes, to invalidate its artifacts
+    VERSIONS = {"events": 1, "priced": 1, "scores": 1}
+    TOKENS = [Token.CUSDCLP, Token.CWETHLP]
+    EPSILON = 1e-10
+
+    def __init__(
+        self,
+        data_dir: str = "data",
+        cache_dir: Optional[str] = None,
+        chains: Optional[List[Chain]] = None,
+        filter_function: Optional[List[str]] = None,
+        blacklist_token: Optional[List[str]] = None) -> None:
+        """
+        :param data_dir: directory of the transaction and price caches
+        :param cache_dir: directory of the stage artifacts, defaults to `{data_dir}/report_cache`
+        :param chains: chains with stable swap pools, see `LPAnalytics.get_lp_txs`
+        :param filter_function: Diamond functions minting or burning LP tokens
+        :param blacklist_token: deprecated LP tokens to skip in the Diamond txs
+        """
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir or f"{data_dir}/report_cache"
+        self.chains = chains or [Chain.POLYGON, Chain.ARBITRUM_ONE, Chain.BNB_CHAIN, Chain.GNOSIS, Chain.OPTIMISM]
+        self.filter_function = filter_function
+        self.blacklist_token = sorted(address.lower() for address in blacklist_token or [])
+        self.stores = {
+            "amarok_txs": TxnStore(f"{data_dir}/amarok_txs"),
+            "lp_transfer_txs": TxnStore(f"{data_dir}/lp_transfer_txs"),
+        }
+        self.artifacts = ArtifactCache(self.cache_dir)
+        # stage -> number of artifacts reused and computed by the last `build`
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def fingerprint(self, store_name: str, chain: Chain) -> str:
+        """Content hash of the cached transactions of a chain, and of its block index"""
+        store = self.stores[store_name]
+        manifest_path = f"{self.cache_dir}/manifests/{store_name}/{chain}.json"
+        manifest: Dict[str, List] = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as fp:
+                manifest = json.load(fp)
+
+        files: Dict[str, List] = {}
+        chain_dir = f"{store.data_path}/{chain}"
+        if os.path.exists(chain_dir):
+            with os.scandir(chain_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    stat = entry.stat()
+                    cached = manifest.get(entry.name)
+                    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+                        files[entry.name] = cached
+                        continue
+                    # rewritten by a refresh of the cache tail or a resolved receipt
+                    with open(entry.path, "rb") as fp:
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns, hashlib.sha256(fp.read()).hexdigest()]
+
+        if files != manifest:
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            tmp_path = f"{manifest_path}.tmp"
+            with open(tmp_path, "w") as fp:
+                json.dump(files, fp)
+            os.replace(tmp_path, manifest_path)
+
+        sha = hashlib.sha256()
+        for name in sorted(files):
+            sha.update(f"{name}:{files[name][2]}\n".encode())
+        if os.path.exists(store.index_path(chain)):
+            with open(store.index_path(chain), "rb") as fp:
+                sha.update(fp.read())
+        return sha.hexdigest()
+
+    def _cached(self, stage: str, name: str, key: str, compute) -> pd.DataFrame:
+        frame = self.artifacts.get(stage, name, key)
+        counts = self.stats.setdefault(stage, {"reused": 0, "computed": 0})
+        if frame is not None:
+            counts["reused"] += 1
+            return frame
+        logging.info(f"Computing {stage} of {name}")
+        counts["computed"] += 1
+        return self.artifacts.put(stage, name, key, compute())
+
+    def events(self, chain: Chain) -> Tuple[str, pd.DataFrame]:
+        """Key and LP events of a chain, decoded from the transaction caches if they changed"""
+        def compute() -> pd.DataFrame:
+            return LPAnalytics.get_lp_txs(
+                {chain: list(self.stores["amarok_txs"].iter_txs(chain))},
+                {chain: list(self.stores["lp_transfer_txs"].iter_txs(chain))},
+                chains=[chain], filter_function=self.filter_function, blacklist_token=self.blacklist_token)
+
+        with stage("events"):
+            key = digest(
+                "events", CampaignReport.VERSIONS["events"], chain, self.filter_function, self.blacklist_token,
+                [self.fingerprint(store_name, chain) for store_name in sorted(self.stores)])
+            return key, self._cached("events", chain, key, compute)
+
+    def priced(self, chain: Chain, events_key: str, lp_txs: pd.DataFrame, hourly_price: pd.Series) -> Tuple[str, pd.DataFrame]:
+        """Key and priced LP events of a chain, priced again if the WETH price of their hours changed"""
+        with stage("priced"):
+            # USDC LP is priced at 1, only the prices at WETH LP events matter
+            hours = lp_txs.index[(lp_txs["token"] == Token.CWETHLP).to_numpy()].floor("h").unique()
+            prices = hourly_price.reindex(hours).to_numpy()
+            key = digest("priced", CampaignReport.VERSIONS["priced"], events_key, hashlib.sha256(prices.tobytes()).hexdigest())
+            return key, self._cached("priced", chain, key, lambda: LPAnalytics.join_price(lp_txs, hourly_price))
+
+    def scores(
+        self,
+        chain: Chain,
+        token: str,
+        lp_txs: pd.DataFrame,
+        grid: Tuple[int, int, int]) -> pd.DataFrame:
+        """`wallet`, `balance`, `value` and `score` of each wallet of a `(chain, token)`, largest score first
+
+        :param lp_txs: priced LP events of the chain
+        :param grid: unix `(start, end, step)` of the scoring window, see `AnalyticsRunner.time_grid`
+        """
+        import pandas as pd
+
+        def compute() -> pd.DataFrame:
+            start, end, step = grid
+            scores = LPAnalytics.get_scores(
+                partition, chain, token, pd.Timestamp(start, unit="s"), pd.Timestamp(end, unit="s"), f"{step}s")
+            wallets = pd.DataFrame({
+                "balance": LPAnalytics.get_top_holders(partition, chain, token),
+                "value": LPAnalytics.get_top_holders(partition, chain, token, column="lp_value_change"),
+            })
+            wallets["score"] = scores.reindex(wallets.index).fillna(0.).to_numpy()
+            wallets = wallets.rename_axis("wallet").reset_index()
+            return wallets.sort_values(["score", "balance"], ascending=False, ignore_index=True)
+
+        with stage("scores"):
+            partition = lp_txs[lp_txs["token"] == token]
+            key = digest(
+                "scores", CampaignReport.VERSIONS["scores"], grid,
+                frame_digest(partition[["action", "user", "balance_change", "lp_value_change"]]))
+            return self._cached("scores", f"{chain}-{token}", key, compute)
+
+    def hourly_price(self) -> pd.Series:
+        """Hourly median WETH price of the price store"""
+        from api.price import PriceFetcher
+
+        return PriceFetcher(self.data_dir).store.hourly("WETH")
+
+    def build(
+        self,
+        start_date: Union[str, datetime] = "2023-02-15",
+        end_date: Optional[Union[str, datetime]] = None,
+        timeframe: str = "1min",
+        threshold: float = 0.3,
+        min_balance: Optional[Dict[str, float]] = None,
+        hourly_price: Optional[pd.Series] = None) -> Dict[str, pd.DataFrame]:
+        """Campaign report of every `(chain, token)`, reusing the stage artifacts whose inputs didn't change
+
+        With `end_date` None the window ends now, so scores are recomputed
+        once the window grows by a `timeframe`.
+
+        :param start_date: start of the campaign
+        :param end_date: end of the campaign, now if None
+        :param timeframe: scoring step, e.g. `1min` or `1h`
+        :param threshold: top fraction of wallets qualified, by score and by balance
+        :param min_balance: minimum LP balance to rank by balance per LP token, e.g. `{"CUSDCLP": 10.}`
+        :param hourly_price: WETH price indexed by hour, defaults to the hourly median of the price store
+        :return: `events` (priced LP events), `wallets` (`chain`, `token`, `wallet`, `balance`,
+            `value`, `score`), `qualified` (top `threshold` of the scored wallets, with their `rank`)
+            and `thresholds` (per `(chain, token)` counts, `min_score` and `min_balance`)
+        """
+        import pandas as pd
+
+        min_balance = min_balance or {}
+        if hourly_price is None:
+            hourly_price = self.hourly_price()
+        grid = AnalyticsRunner.time_grid(start_date, end_date, timeframe)
+        self.stats = {}
+
+        events, wallets, qualified, thresholds = [], [], [], []
+        for chain in self.chains:
+            events_key, lp_txs = self.events(chain)
+            _, lp_txs = self.priced(chain, events_key, lp_txs, hourly_price)
+            events.append(lp_txs)
+            for token in CampaignReport.TOKENS:
+                scores = self.scores(chain, token, lp_txs, grid)
+                scores.insert(0, "token", token)
+                scores.insert(0, "chain", chain)
+                wallets.append(scores)
+
+                # the notebook's cut-offs: top `threshold` by score, and by balance above a minimum
+                scored = scores[scores["score"] > 0]
+                n_qualified = round(threshold * len(scored))
+                top = scored.iloc[:n_qualified].assign(rank=np.arange(1, n_qualified + 1))
+                qualified.append(top)
+                holders = scores.loc[scores["balance"] > CampaignReport.EPSILON, "balance"].sort_values(ascending=False)
+                n_holders = len(holders)
+                holders = holders[holders >= min_balance.get(token, 0.)]
+                candidates = holders.iloc[:round(threshold * len(holders))]
+                thresholds.append({
+                    "chain": chain, "token": token,
+                    "n_scored": len(scored), "n_qualified": n_qualified,
+                    "min_score": top["score"].iloc[-1] if n_qualified else np.nan,
+                    "n_holders": n_holders, "n_filtered": n_holders - len(holders), "n_candidates": len(candidates),
+                    "min_balance": candidates.iloc[-1] if len(candidates) else np.nan,
+                })
+
+        logging.info(", ".join(
+            f"{stage} {counts['reused']} reused/{counts['computed']} computed" for stage, counts in self.stats.items()))
+        return {
+            "events": pd.concat(events).sort_index(kind="stable"),
+            "wallets": pd.concat(wallets, ignore_index=True),
+            "qualified": pd.concat(qualified, ignore_index=True),
+            "thresholds": pd.DataFrame(thresholds),
+        }
@@ -0,0 +1,354 @@
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+from urllib.parse import urlparse
+
+import requests
+
+from api.metrics import metrics
+
+T = TypeVar("T")
+
+
+class RetryableError(ConnectionError):
+    """Transient failure worth retrying, e.g. a 503 or a timeout"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None) -> None:
+        """
+        :param message: error message
+        :param retry_after: seconds the server asked to wait, e.g. from a `Retry-After` header
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitedError(RetryableError):
+    """Request throttled, retried but not counted against the endpoint's circuit as the endpoint is up"""
+
+
+class NotIndexedError(RetryableError):
+    """Result not available yet, e.g. the receipt of a fresh transaction, retried but the endpoint is up"""
+
+
+class CircuitOpenError(RetryableError):
+    """Every endpoint of the request has an open circuit"""
+
+
+class PermanentError(ConnectionError):
+    """Failure retrying won't fix, e.g. an invalid API key or parameters"""
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling an endpoint after `failure_threshold` consecutive transient
+    failures. Once `reset_timeout` seconds passed, a single probe request is
+    let through (half-open): its success closes the circuit, its failure opens
+    it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.) -> None:
+        """
+        :param failure_threshold: consecutive failures opening the circuit
+        :param reset_timeout: seconds before probing an open circuit
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"CircuitBreaker(state={self.state}, failures={self.failures})"
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now, takes the probe slot of a half-open circuit"""
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                self._probing = False
+            if self.state == CircuitBreaker.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> bool:
+        """Count a transient failure, returns whether it opened the circuit"""
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == CircuitBreaker.OPEN:
+                return False
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class EndpointHealth(object):
+    """
+    Circuit breakers per endpoint URL, and the alternate endpoints a URL fails
+    over to, e.g. a second RPC provider of a chain:
+
+        health.set_fallbacks(SmartContract.default_providers[Chain.GNOSIS], ["https://rpc.gnosischain.com"])
+
+    Breakers are per process, forked children start with closed circuits.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.) -> None:
+        """
+        :param failure_threshold: consecutive failures opening a circuit
+        :param reset_timeout: seconds before probing an open circuit
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.fallbacks: Dict[str, List[str]] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        """Close every circuit, fallbacks are kept"""
+        self._lock = threading.Lock()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def set_fallbacks(self, url: str, alternates: List[str]) -> None:
+        self.fallbacks[url] = list(alternates)
+
+    def endpoints(self, url: str) -> List[str]:
+        """`url` then its alternates, in failover order"""
+        return [url] + [alternate for alternate in self.fallbacks.get(url, []) if alternate != url]
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        breaker = self.breakers.get(url)
+        if breaker is None:
+            with self._lock:
+                if url not in self.breakers:
+                    self.breakers[url] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                breaker = self.breakers[url]
+        return breaker
+
+
+class RetryPolicy(object):
+    """
+    Retry transient failures with capped exponential backoff and full jitter,
+    failing over across endpoints whose circuit is closed: after an endpoint
+    failure the next attempt goes to the next alternate, throttled requests
+    are retried on the same endpoint.
+
+    The delay before retry `n` is uniform in `[0, min(max_delay, base_delay * multiplier ** n)]`,
+    at least the `Retry-After` the server asked for. Permanent errors (bad
+    parameters, invalid keys, 4xx other than 408/425/429) are raised at once.
+    """
+
+    RETRYABLE_STATUS = [408, 425, 429, 500, 502, 503, 504]
+
+    def __init__(
+        self,
+        max_attempts: int = 8,
+        base_delay: float = 0.5,
+        max_delay: float = 30.,
+        multiplier: float = 2.,
+        deadline: Optional[float] = None) -> None:
+        """
+        :param max_attempts: attempts including the first one
+        :param base_delay: cap of the first backoff in seconds
+        :param max_delay: cap of any backoff in seconds
+        :param multiplier: growth of the backoff cap per attempt
+        :param deadline: seconds after which no retry is started, None for no limit
+        """
+        if max_attempts < 1:
+            raise ValueError(f"max_attempts must be positive, got {max_attempts}")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+
+    def __repr__(self) -> str:
+        return f"RetryPolicy(max_attempts={self.max_attempts}, base_delay={self.base_delay}, max_delay={self.max_delay})"
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait after failed attempt `attempt` (0-based)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Seconds of a `Retry-After` header, given as seconds or an HTTP date"""
+        if not value:
+            return None
+        try:
+            return max(0., float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def from_status(status_code: int, message: str, headers: Optional[Dict[str, str]] = None) -> ConnectionError:
+        """Error of a non-200 HTTP response"""
+        retry_after = RetryPolicy.parse_retry_after((headers or {}).get("Retry-After"))
+        if status_code == 429:
+            return RateLimitedError(message, retry_after)
+        if status_code in RetryPolicy.RETRYABLE_STATUS:
+            return RetryableError(message, retry_after)
+        return PermanentError(message)
+
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        if isinstance(error, PermanentError):
+            return False
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            return error.response.status_code in RetryPolicy.RETRYABLE_STATUS
+        return isinstance(error, (
+            ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    @staticmethod
+    def get_retry_after(error: Exception) -> Optional[float]:
+        if isinstance(error, RetryableError):
+            return error.retry_after
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            return RetryPolicy.parse_retry_after(error.response.headers.get("Retry-After"))
+        return None
+
+    @staticmethod
+    def is_endpoint_failure(error: Exception) -> bool:
+        """Whether the error counts against the endpoint's circuit, throttling or missing results don't"""
+        if isinstance(error, (RateLimitedError, NotIndexedError, CircuitOpenError)):
+            return False
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            return error.response.status_code != 429
+        return True
+
+    def call(
+        self,
+        fn: Callable[[str], T],
+        url: str,
+        service: str = "",
+        chain: str = "",
+        action: str = "",
+        endpoints: Optional[List[str]] = None,
+        record: bool = True) -> T:
+        """Call `fn(endpoint)` on `url` or its alternates in `health` until it succeeds
+
+        :param fn: request to an endpoint URL
+        :param url: primary endpoint
+        :param service: `explorer`, `subgraph` or `rpc`, for metrics
+        :param chain: chain of the request, for metrics
+        :param action: explorer action or RPC method, for metrics
+        :param endpoints: endpoints in failover order, defaults to `url` and its alternates
+        :param record: record outcomes on the endpoint breakers, off when `fn` records them itself
+        """
+        endpoints = endpoints or health.endpoints(url)
+        start = time.monotonic()
+        error: Exception = CircuitOpenError(f"All circuits open for {url}")
+        # endpoint tried first, moves to the next alternate after each endpoint failure
+        offset = 0
+        for attempt in range(self.max_attempts):
+            candidates = endpoints[offset:] + endpoints[:offset]
+            endpoint = next((endpoint for endpoint in candidates if health.breaker(endpoint).allow()), None)
+            if endpoint is None:
+                error = CircuitOpenError(f"All circuits open for {url}")
+            else:
+                breaker = health.breaker(endpoint)
+                try:
+                    result = fn(endpoint)
+                except Exception as e:
+                    if not RetryPolicy.is_retryable(e):
+                        # the endpoint answered
+                        if record:
+                            breaker.record_success()
+                        raise
+                    error = e
+                    if not RetryPolicy.is_endpoint_failure(e):
+                        if record:
+                            breaker.record_success()
+                    else:
+                        offset = (endpoints.index(endpoint) + 1) % len(endpoints)
+                        if record and breaker.record_failure():
+                            logging.warning(f"Circuit opened for {endpoint} after {breaker.failures} failures: {e}")
+                            metrics.inc("circuit_opened_total", {"service": service, "chain": chain or "", "endpoint": urlparse(endpoint).netloc})
+                else:
+                    if record:
+                        breaker.record_success()
+                    if endpoint != endpoints[0]:
+                        metrics.inc("failovers_total", {"service": service, "chain": chain or "", "endpoint": urlparse(endpoint).netloc})
+                    return result
+
+            if attempt == self.max_attempts - 1:
+                break
+            delay = self.backoff(attempt, RetryPolicy.get_retry_after(error))
+            if self.deadline is not None and time.monotonic() - start + delay > self.deadline:
+                break
+            host = urlparse(endpoint or url).netloc
+            logging.warning(f"WARNING: {service} request to {host} failed [{attempt + 1}/{self.max_attempts}]: {error}, retrying in {delay:.2f}s")
+            metrics.observe_retry(service, chain, host, action)
+            metrics.inc("retry_backoff_seconds_total", {"service": service, "chain": chain or "", "endpoint": host}, delay)
+            time.sleep(delay)
+        raise error
+
+
+def rpc_retry_middleware(chain: str, url: str, policy: Optional[RetryPolicy] = None) -> Callable:
+    """web3 middleware retrying JSON-RPC calls of a provider with `policy`, failing over to the
+    alternates of `url` in `health`
+
+    Throttling errors in the JSON-RPC response are retried, other RPC errors are
+    returned as is so callers (e.g. `LogScanner` splitting ranges) see them.
+    When `url` belongs to the `api.providers` pool of the chain, each attempt
+    goes to the pool's best endpoint and slow requests are hedged, the pool
+    records the outcome of each endpoint on its breaker.
+    """
+    def middleware(make_request, w3):
+        from api.providers import pools
+
+        def send(method: str, params: Any, endpoint: str) -> Dict:
+            if endpoint == url:
+                response = make_request(method, params)
+            else:
+                from api.clients import clients
+
+                # raw provider of the alternate, formatting is done by the outer middlewares
+                response = clients.get_provider(chain, endpoint).provider.make_request(method, params)
+            message = str((response.get("error") or {}).get("message", "")).lower()
+            if "rate limit" in message or "too many requests" in message:
+                raise RateLimitedError(message)
+            return response
+
+        def request(method, params):
+            pool = pools.find(chain, url)
+            if pool is None:
+                return (policy or rpc_retry_policy).call(
+                    lambda endpoint: send(method, params, endpoint), url, "rpc", chain, method)
+            return (policy or rpc_retry_policy).call(
+                lambda endpoint: pool.request(lambda target: send(method, params, target), endpoint, method),
+                url, "rpc", chain, method, endpoints=pool.rank(), record=False)
+        return request
+    return middleware
+
+
+# process-wide endpoint health, and the default policies of explorer and RPC requests
+health = EndpointHealth()
+explorer_retry_policy = RetryPolicy(max_attempts=8, base_delay=0.5, max_delay=30.)
+rpc_retry_policy = RetryPolicy(max_attempts=5, base_delay=0.25, max_delay=10.)
+os.register_at_fork(after_in_child=health.reset)
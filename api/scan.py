@@ -3,12 +3,22 @@ import logging
 import os
 import random
 import time
-from typing import Dict, List, Union, Optional
+from typing import TYPE_CHECKING, Dict, List, Union, Optional
+from urllib.parse import urlparse
 
 import requests
 
-from api.constant import Chain, DiamondContract
-from api.contract import ConnextDiamond
+from api.archive import ResponseArchive, archive
+from api.clients import clients
+from api.constant import Chain
+from api.metrics import metrics
+from api.profiling import stage
+from api.retry import NotIndexedError, PermanentError, RateLimitedError, RetryableError, RetryPolicy, explorer_retry_policy
+
+if TYPE_CHECKING:
+    from web3 import Web3
+
+    from api.contract import ConnextDiamond
 
 
 class ScanTxn(object):
@@ -37,6 +47,7 @@ class ScanTxn(object):
         functionName: Optional[str] = None,
         methodId: Optional[str] = None,
         logs: Optional[List[dict]] = None,
+        logIndex: Optional[Union[int, str]] = None,
         **kwargs
     ) -> None:
         self.chain = chain
@@ -77,6 +88,8 @@ class ScanTxn(object):
         self.functionName = functionName if functionName is None else functionName
         self.txreceipt_status = txreceipt_status if txreceipt_status is None else int(txreceipt_status)
         self.logs = logs
+        # set on Transfer rows of `tokentx` or `eth_getLogs`, None for transactions
+        self.logIndex = logIndex if logIndex is None or logIndex == "" else int(logIndex)
 
         self.tx_url = f"{self.scan_url}/{self.hash}"
 
@@ -108,6 +121,7 @@ class ScanTxn(object):
             "functionName": self.functionName,
             "tx_url": self.tx_url,
             "logs": self.logs,
+            "logIndex": self.logIndex,
         }
 
     @staticmethod
@@ -119,6 +133,9 @@ class ScanTxn(object):
 
 class ScanAPI(object):
 
+    # substrings of explorer errors that retrying won't fix
+    PERMANENT_ERRORS = ["invalid api key", "invalid address", "error! invalid", "unknown action", "missing or invalid"]
+
     _base_url = {
         Chain.ETHEREUM: 'https://api.etherscan.io/api',
         Chain.BNB_CHAIN: 'https://api.bscscan.com/api',
@@ -131,8 +148,7 @@ class ScanAPI(object):
     def __init__(self, chain: Chain, apikey_schedule: str = "roundrobin") -> None:
         self.api_url = ScanAPI._base_url[chain]
         self.chain = chain
-        self.diamond_contract = ConnextDiamond(self.chain)
-        self.provider = ConnextDiamond.get_default_provider(self.chain)
+        self._diamond_contract = None
         self.api_idx = 0
         
         if chain == Chain.ETHEREUM:
@@ -154,17 +170,34 @@ class ScanAPI(object):
 
         self.apikey_schedule = apikey_schedule
 
+    @property
+    def diamond_contract(self) -> "ConnextDiamond":
+        """Connext Diamond used to decode inputs, built on first use as it loads web3"""
+        if self._diamond_contract is None:
+            from api.contract import ConnextDiamond
+            self._diamond_contract = ConnextDiamond(self.chain)
+        return self._diamond_contract
+
+    @property
+    def provider(self) -> "Web3":
+        return self.diamond_contract.provider
+
+    @staticmethod
+    def shared(chain: Chain, apikey_schedule: str = "roundrobin") -> "ScanAPI":
+        """ScanAPI of chain built once per process and reused across tasks"""
+        return clients.get_shared(
+            ("scan_api", chain, apikey_schedule), lambda: ScanAPI(chain, apikey_schedule=apikey_schedule))
+
     def get_apikey(self) -> str:
         """Get the next apikey in the list of apikeys. Using a round-robin"""
         if self.apikey_schedule == "roundrobin":
-            logging.debug(f"Current apikey index: {self.api_idx}")
             self.api_idx = (self.api_idx + 1) % len(self.apikeys)
-            logging.debug(f"New apikey index: {self.api_idx}")
             apikey = self.apikeys[self.api_idx]
-            logging.debug(f"[{self.chain}] Using apikey ({self.api_idx}/{len(self.apikeys)})")
         elif self.apikey_schedule == "random":
-            self.api_idx = random.choice(range(len(self.apikeys)))
+            self.api_idx = random.randrange(len(self.apikeys))
             apikey = self.apikeys[self.api_idx]
+        # hot path: skip formatting unless debug logging is on
+        if logging.root.isEnabledFor(logging.DEBUG):
             logging.debug(f"[{self.chain}] Using apikey ({self.api_idx}/{len(self.apikeys)})")
         return apikey
 
@@ -172,54 +205,92 @@ class ScanAPI(object):
         self,
         url: str,
         params: Dict[str, str],
-        max_attempt: int = 20,
-        wait_time: float = 0.5,
+        max_attempt: Optional[int] = None,
+        wait_time: Optional[float] = None,
         timeout: int = 10,
         **kwargs
     ) -> requests.Response:
-        """Make a request to the etherscan api with retry"""
-        # initial vars
-        max_attempt = max_attempt
-        wait_time = wait_time
-        attempt = 0
+        """Make a request to the etherscan api, retrying transient errors with `explorer_retry_policy`
+
+        Every attempt uses the next API key. Alternate explorers of `url` set in
+        `api.retry.health` are used when its circuit is open.
+
+        :param max_attempt: override the attempts of the policy
+        :param wait_time: override the base backoff of the policy
+        """
+        policy = explorer_retry_policy
+        if max_attempt is not None or wait_time is not None:
+            policy = RetryPolicy(
+                max_attempts=max_attempt if max_attempt is not None else policy.max_attempts,
+                base_delay=wait_time if wait_time is not None else policy.base_delay,
+                max_delay=policy.max_delay,
+                multiplier=policy.multiplier)
 
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.93 Safari/537.36"
         }
 
-        while True:
-            try:
-                # make request
-                params["apikey"] = self.get_apikey()
-                response = requests.get(url, params=params, headers=headers, timeout=timeout, **kwargs)
-
-                # check status code
-                if response.status_code == 200:
-                    if response.json().get("status") == "0" and response.json().get("message") != "No transactions found":
-                        raise ConnectionError(response.json().get("message"))
-                    elif response.json()["result"] is None:
-                        raise ConnectionError("No result found")
-                    return response.json()
-                else:
-                    raise ConnectionError(f"Request failed with status code {response.status_code}")
-            except (ConnectionError, requests.exceptions.ReadTimeout) as e:
-                # check if we have reached max attempt
-                logging.warning(f"WARNING: Failed to fetch Etherscan API [{attempt}/{max_attempt}], retrying...")
-                if attempt == max_attempt:
-                    raise e
-
-                # sleep for a bit
-                time.sleep(wait_time)
-
-                # increment attempt
-                attempt += 1
+        def request(endpoint: str) -> dict:
+            return self._request(endpoint, dict(params, apikey=self.get_apikey()), headers=headers, timeout=timeout, **kwargs)
+
+        return policy.call(request, url, "explorer", self.chain, params.get("action", ""))
+
+    @staticmethod
+    def classify_error(message: str, result: str) -> ConnectionError:
+        """Error of an explorer response with status 0"""
+        text = f"{message} {result}".lower()
+        if "rate limit" in text:
+            return RateLimitedError(result)
+        if any(pattern in text for pattern in ScanAPI.PERMANENT_ERRORS):
+            return PermanentError(f"{message}: {result}")
+        return RetryableError(f"{message}: {result}")
+
+    def _request(self, url: str, params: Dict[str, str], **kwargs) -> dict:
+        """Make a single request to the etherscan api, recording its metrics"""
+        start = time.perf_counter()
+        status = "error"
+        n_bytes = 0
+        try:
+            response = clients.get_session(url).get(url, params=params, **kwargs)
+            n_bytes = len(response.content)
+
+            # check status code
+            if response.status_code == 200:
+                result = response.json()
+                if result.get("status") == "0" and result.get("message") != "No transactions found":
+                    error = ScanAPI.classify_error(str(result.get("message")), str(result.get("result")))
+                    if isinstance(error, RateLimitedError):
+                        status = "rate_limited"
+                    raise error
+                elif result["result"] is None:
+                    # e.g. receipt of a tx not indexed yet
+                    raise NotIndexedError("No result found")
+                status = "ok"
+                if archive.enabled:
+                    archive.put(
+                        "explorer", self.chain, urlparse(url).netloc, params.get("action", ""), params, result,
+                        block_range=ResponseArchive.block_range(result["result"]))
+                return result
+            else:
+                if response.status_code == 429:
+                    status = "rate_limited"
+                raise RetryPolicy.from_status(
+                    response.status_code, f"Request failed with status code {response.status_code}", response.headers)
+        except requests.exceptions.Timeout:
+            status = "timeout"
+            raise
+        finally:
+            metrics.observe_request(
+                "explorer", self.chain, urlparse(url).netloc, params.get("action", ""),
+                latency=time.perf_counter() - start, status=status,
+                n_bytes=n_bytes, apikey=f"key{self.apikeys.index(params['apikey'])}")
 
     def get_transaction_receipt(
         self,
         tx_hash: str,
         timeout: int = 60,
-        max_attempt: int = 20,
-        wait_time: float = 0.5,
+        max_attempt: Optional[int] = None,
+        wait_time: Optional[float] = None,
         **kwargs
     ) -> dict:
         """Get the transaction receipt for a specifed tx hash"""
@@ -238,6 +309,51 @@ class ScanAPI(object):
 
         return response["result"]
 
+    def parse_transactions(self, rows: List[dict]) -> List[ScanTxn]:
+        """Parse raw explorer `txlist` rows, skipping failed txs"""
+        transactions = []
+        for tx in rows:
+            if tx["isError"] == "1":
+                # skip failed txs
+                continue
+            tx = dict(tx)
+            # add the from_address and to_address to the tx
+            # from was reserved keyword in python
+            tx["from_address"] = tx["from"]
+            tx["to_address"] = tx["to"]
+            # convert the tx to ScanTxn object
+            try:
+                with stage("decode"):
+                    tx["input"] = self.diamond_contract.decode_input(tx["input"])
+            except ValueError as e:
+                # skip contract creation txs
+                logging.warning(f"WARNING: Failed to decode input [{self.chain} : {tx['hash']}]: {e}")
+                pass
+
+            transactions.append(ScanTxn(chain=self.chain, **tx))
+        return transactions
+
+    def parse_transfer_events(self, rows: List[dict]) -> List[ScanTxn]:
+        """Parse raw explorer `tokentx` rows, skipping mints and burns"""
+        null_address = "0x0000000000000000000000000000000000000000"
+        transactions = []
+        for tx in rows:
+            tx = dict(tx)
+            # add the from_address and to_address to the tx
+            # from was reserved keyword in python
+            tx["from_address"] = tx["from"]
+            tx["to_address"] = tx["to"]
+
+            # remove transaction from/to 0x0000
+            if tx["from_address"] == null_address or tx["to_address"] == null_address:
+                if logging.root.isEnabledFor(logging.DEBUG):
+                    logging.debug(f"Skipping transaction {tx['hash']} as it is from/to 0x0000")
+                continue
+
+            # convert the tx to ScanTxn object
+            transactions.append(ScanTxn(chain=self.chain, **tx))
+        return transactions
+
     def get_transaction_by_address(
         self, 
         address: str, 
@@ -245,8 +361,8 @@ class ScanAPI(object):
         endblock: int = 999999999,
         offset: int = 1000,
         timeout: int = 60,
-        max_attempt: int = 20,
-        wait_time: float = 0.5,
+        max_attempt: Optional[int] = None,
+        wait_time: Optional[float] = None,
         **kwargs) -> List[ScanTxn]:
         """Get the list of transactions for a specifed contracts"""
         # initialize empty txs
@@ -260,42 +376,26 @@ class ScanAPI(object):
             # iterate infinitely until reach the last page
 
             logging.debug(f"Fetching page {page} for address {address}")
-            response = self.request_with_retry(
-                url=self.api_url,
-                params={
-                    "module": "account",
-                    "action": "txlist",
-                    "address": address,
-                    "startblock": startblock,
-                    "endblock": endblock,
-                    "page": page,
-                    "offset": offset,
-                    "sort": "asc",
-                },
-                max_attempt=max_attempt,
-                wait_time=wait_time,
-                **kwargs)
+            with stage("fetch"):
+                response = self.request_with_retry(
+                    url=self.api_url,
+                    params={
+                        "module": "account",
+                        "action": "txlist",
+                        "address": address,
+                        "startblock": startblock,
+                        "endblock": endblock,
+                        "page": page,
+                        "offset": offset,
+                        "sort": "asc",
+                    },
+                    max_attempt=max_attempt,
+                    wait_time=wait_time,
+                    **kwargs)
 
             if response["result"]:
                 # if there are txs, parse the response
-                for tx in response["result"]:
-                    if tx["isError"] == "1":
-                        # skip failed txs
-                        continue
-                    # add the from_address and to_address to the tx
-                    # from was reserved keyword in python
-                    tx["from_address"] = tx["from"]
-                    tx["to_address"] = tx["to"]
-                    # convert the tx to ScanTxn object
-                    try:
-                        tx["input"] = self.diamond_contract.decode_input(tx["input"])
-                    except ValueError as e:
-                        # skip contract creation txs
-                        logging.warning(f"WARNING: Failed to decode input [{self.chain} : {tx['hash']}]: {e}")
-                        pass
-
-                    txs = ScanTxn(chain=self.chain, **tx)
-                    transactions.append(txs)
+                transactions.extend(self.parse_transactions(response["result"]))
             else:
                 # if there are no txs, break the loop
                 # as we have reached the last page
@@ -315,14 +415,10 @@ class ScanAPI(object):
         endblock: int = 999999999,
         offset: int = 1000,
         timeout: int = 60,
-        max_attempt: int = 20,
-        wait_time: float = 0.5,
+        max_attempt: Optional[int] = None,
+        wait_time: Optional[float] = None,
         **kwargs) -> List[ScanTxn]:
         """Get the list of transfer transactions for a specifed contracts"""
-        # contract address
-        contract_address =  DiamondContract.get_contract_address(self.chain)
-        null_address = "0x0000000000000000000000000000000000000000"
-
         # initialize empty txs
         transactions = []
 
@@ -346,29 +442,17 @@ class ScanAPI(object):
                 "sort": "asc",
             }
             logging.debug(f"params: {params}")
-            response = self.request_with_retry(
-                url=self.api_url,
-                params=params,
-                max_attempt=max_attempt,
-                wait_time=wait_time,
-                **kwargs)
+            with stage("fetch"):
+                response = self.request_with_retry(
+                    url=self.api_url,
+                    params=params,
+                    max_attempt=max_attempt,
+                    wait_time=wait_time,
+                    **kwargs)
 
             if response["result"]:
                 # if there are txs, parse the response
-                for tx in response["result"]:
-                    # add the from_address and to_address to the tx
-                    # from was reserved keyword in python
-                    tx["from_address"] = tx["from"]
-                    tx["to_address"] = tx["to"]
-
-                    # remove transaction from/to 0x0000
-                    if tx["from_address"] == null_address or tx["to_address"] == null_address:
-                        logging.debug(f"Skipping transaction {tx['hash']} as it is from/to 0x0000")
-                        continue
-
-                    # convert the tx to ScanTxn object
-                    txs = ScanTxn(chain=self.chain, **tx)
-                    transactions.append(txs)
+                transactions.extend(self.parse_transfer_events(response["result"]))
             else:
                 # if there are no txs, break the loop
                 # as we have reached the last page
@@ -385,8 +469,8 @@ class ScanAPI(object):
     def resolve_blocktime(
         self, 
         blocktime: int,
-        max_attempt: int = 5,
-        wait_time: int = 1,
+        max_attempt: Optional[int] = 5,
+        wait_time: Optional[float] = None,
         timeout: int = 10,
         **kwargs) -> int:
         """Convert blocktime to unix timestamp"""
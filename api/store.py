@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from api.constant import Chain
+from api.scan import ScanTxn
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+
+class TxnStore(object):
+    """
+    On-disk transaction cache.
+
+    Transactions are stored as one JSON per row key at `{data_path}/{chain}/{key}.json`,
+    the hash of a transaction or `{hash}-{logIndex}` of a transfer row, so the
+    transfers of several tokens in one transaction are kept apart (see `key`).
+    A per-chain index at `{data_path}/_index/{chain}.csv` lists
+    `blockNumber,key,functionName` in block order so that transactions can be
+    streamed and filtered without parsing every cached file.
+    """
+
+    FRAME_COLUMNS = [
+        "chain", "blockNumber", "timeStamp", "transactionIndex", "hash",
+        "from_address", "to_address", "functionName", "value", "gasPrice", "gasUsed", "isError",
+    ]
+
+    def __init__(self, data_path: str) -> None:
+        """
+        :param data_path: directory of the cache
+        """
+        self.data_path = data_path
+
+    @staticmethod
+    def key(tx_hash: str, log_index: Optional[int] = None) -> str:
+        """Row key of a transaction, or of a transfer row with its log index"""
+        return tx_hash if log_index is None else f"{tx_hash}-{log_index}"
+
+    @staticmethod
+    def split_key(key: str) -> Tuple[str, Optional[int]]:
+        """`(hash, logIndex)` of a row key, logIndex is None for a transaction"""
+        tx_hash, _, log_index = key.partition("-")
+        return tx_hash, int(log_index) if log_index else None
+
+    @staticmethod
+    def tx_key(tx: ScanTxn) -> str:
+        return TxnStore.key(tx.hash, tx.logIndex)
+
+    def tx_path(self, chain: Chain, key: str) -> str:
+        return f"{self.data_path}/{chain}/{key}.json"
+
+    def index_path(self, chain: Chain) -> str:
+        return f"{self.data_path}/_index/{chain}.csv"
+
+    def version_path(self, chain: Chain) -> str:
+        return f"{self.data_path}/_index/{chain}.version"
+
+    def touch(self, chain: Chain) -> None:
+        """Mark the transactions of a chain as changed, e.g. after rewriting one with its receipt"""
+        version_path = self.version_path(chain)
+        os.makedirs(os.path.dirname(version_path), exist_ok=True)
+        with open(version_path, "a"):
+            os.utime(version_path, None)
+
+    def changed_at(self, chain: Chain) -> float:
+        """Last time transactions of a chain were saved, deleted or rewritten, 0 if never"""
+        return max(
+            [os.path.getmtime(path) for path in [self.index_path(chain), self.version_path(chain)] if os.path.exists(path)],
+            default=0.)
+
+    @staticmethod
+    def _index_row(tx: ScanTxn) -> Tuple[int, str, str]:
+        fn_name = tx.functionName.split("(")[0] if tx.functionName else ""
+        return tx.blockNumber, TxnStore.tx_key(tx), fn_name
+
+    def _write_index_rows(self, chain: Chain, rows: List[Tuple[int, str, str]]) -> None:
+        index_path = self.index_path(chain)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        # dedup by row key, later rows win
+        rows = {key: (block_number, key, fn_name) for block_number, key, fn_name in rows}
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w") as fp:
+            for block_number, key, fn_name in sorted(rows.values(), key=lambda x: x[0]):
+                fp.write(f"{block_number},{key},{fn_name}\n")
+        os.replace(tmp_path, index_path)
+
+    def write_index(self, chain: Chain, txs: List[ScanTxn]) -> None:
+        """Merge transactions into the block index of a chain"""
+        rows = list(self.read_index(chain)) if os.path.exists(self.index_path(chain)) else []
+        self._write_index_rows(chain, rows + [TxnStore._index_row(tx) for tx in txs])
+
+    def rebuild_index(self, chain: Chain) -> None:
+        """Build block index by scanning every cached transaction of a chain once"""
+        logging.info(f"Building block index for `{self.data_path}/{chain}`")
+        rows = []
+        chain_dir = f"{self.data_path}/{chain}"
+        if os.path.exists(chain_dir):
+            for fname in os.listdir(chain_dir):
+                with open(f"{chain_dir}/{fname}", "r") as fp:
+                    rows.append(TxnStore._index_row(ScanTxn(**json.load(fp))))
+        self._write_index_rows(chain, rows)
+
+    def read_index(
+        self,
+        chain: Chain,
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None) -> Iterator[Tuple[int, str, str]]:
+        """Stream `(blockNumber, key, functionName)` of a chain in block order, see `key`
+
+        :param chain: chain to read
+        :param start_block: first block to include
+        :param end_block: last block to include, None for no upper bound
+        :param function_names: only include these function names (without signature)
+        """
+        if not os.path.exists(self.index_path(chain)):
+            if not os.path.exists(f"{self.data_path}/{chain}"):
+                return
+            self.rebuild_index(chain)
+
+        if function_names is not None:
+            function_names = {_name.split("(")[0] for _name in function_names}
+
+        with open(self.index_path(chain), "r") as fp:
+            for line in fp:
+                block_number, key, fn_name = line.rstrip("\n").split(",", 2)
+                block_number = int(block_number)
+                if block_number < start_block:
+                    continue
+                if end_block is not None and block_number > end_block:
+                    break
+                if function_names is not None and fn_name not in function_names:
+                    continue
+                yield block_number, key, fn_name
+
+    def iter_raw(
+        self,
+        chain: Chain,
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None) -> Iterator[Dict]:
+        """Stream cached transactions of a chain as JSON dicts in block order"""
+        for _, key, _ in self.read_index(chain, start_block, end_block, function_names):
+            with open(self.tx_path(chain, key), "r") as fp:
+                yield json.load(fp)
+
+    def iter_txs(
+        self,
+        chain: Chain,
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None) -> Iterator[ScanTxn]:
+        """Stream cached transactions of a chain as `ScanTxn` in block order"""
+        for tx in self.iter_raw(chain, start_block, end_block, function_names):
+            yield ScanTxn(**tx)
+
+    def to_frame(
+        self,
+        chains: List[Chain],
+        start_block: int = 0,
+        end_block: Optional[int] = None,
+        function_names: Optional[List[str]] = None,
+        engine: str = "pandas") -> Union[pd.DataFrame, pa.Table]:
+        """Build a typed table of cached transactions straight from disk
+
+        Rows are ordered by chain then block number. `chain`, `functionName` and
+        addresses are categorical (dictionary-encoded), numeric fields are int64.
+        `value` is exact as native amounts in wei exceed int64: a decimal string
+        with pandas, decimal128(38, 0) with arrow.
+
+        :param chains: chains to include
+        :param start_block: first block to include
+        :param end_block: last block to include, None for no upper bound
+        :param function_names: only include these function names
+        :param engine: `pandas` for a DataFrame or `arrow` for a pyarrow Table
+            with fixed-width binary hash and addresses
+        """
+        if engine not in ["pandas", "arrow"]:
+            raise ValueError(f"Unknown engine {engine}, only pandas|arrow")
+
+        columns = {name: [] for name in TxnStore.FRAME_COLUMNS}
+        for chain in chains:
+            for tx in self.iter_raw(chain, start_block, end_block, function_names):
+                columns["chain"].append(chain)
+                columns["blockNumber"].append(tx["blockNumber"])
+                columns["timeStamp"].append(tx["timeStamp"])
+                columns["transactionIndex"].append(tx["transactionIndex"])
+                columns["hash"].append(tx["hash"])
+                columns["from_address"].append(tx["from_address"].lower())
+                columns["to_address"].append(tx["to_address"].lower())
+                columns["functionName"].append(tx["functionName"].split("(")[0] if tx["functionName"] else "")
+                columns["value"].append(str(tx["value"]))
+                columns["gasPrice"].append(tx["gasPrice"])
+                columns["gasUsed"].append(tx["gasUsed"])
+                columns["isError"].append(tx["isError"] or 0)
+
+        if engine == "arrow":
+            return TxnStore._to_arrow(columns)
+
+        import numpy as np
+        import pandas as pd
+
+        return pd.DataFrame({
+            "chain": pd.Categorical(columns["chain"]),
+            "blockNumber": np.array(columns["blockNumber"], dtype=np.int64),
+            "timeStamp": np.array(columns["timeStamp"], dtype=np.int64),
+            "transactionIndex": np.array(columns["transactionIndex"], dtype=np.int64),
+            "hash": columns["hash"],
+            "from_address": pd.Categorical(columns["from_address"]),
+            "to_address": pd.Categorical(columns["to_address"]),
+            "functionName": pd.Categorical(columns["functionName"]),
+            "value": pd.array(columns["value"], dtype="string"),
+            "gasPrice": np.array(columns["gasPrice"], dtype=np.int64),
+            "gasUsed": np.array(columns["gasUsed"], dtype=np.int64),
+            "isError": np.array(columns["isError"], dtype=np.int8),
+        })
+
+    @staticmethod
+    def _to_arrow(columns: Dict[str, list]):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("engine=\"arrow\" requires pyarrow, install it with `pip install pyarrow`")
+
+        def to_bytes(hex_str: str) -> bytes:
+            return bytes.fromhex(hex_str[2:] if hex_str.startswith("0x") else hex_str)
+
+        def address_array(values: List[str]):
+            # empty to_address means contract creation
+            return pa.array([to_bytes(v) if v else None for v in values], type=pa.binary(20))
+
+        return pa.table({
+            "chain": pa.array(columns["chain"]).dictionary_encode(),
+            "blockNumber": pa.array(columns["blockNumber"], type=pa.int64()),
+            "timeStamp": pa.array(columns["timeStamp"], type=pa.int64()),
+            "transactionIndex": pa.array(columns["transactionIndex"], type=pa.int64()),
+            "hash": pa.array([to_bytes(v) for v in columns["hash"]], type=pa.binary(32)),
+            "from_address": address_array(columns["from_address"]),
+            "to_address": address_array(columns["to_address"]),
+            "functionName": pa.array(columns["functionName"]).dictionary_encode(),
+            "value": pa.array([int(v) for v in columns["value"]], type=pa.decimal128(38, 0)),
+            "gasPrice": pa.array(columns["gasPrice"], type=pa.int64()),
+            "gasUsed": pa.array(columns["gasUsed"], type=pa.int64()),
+            "isError": pa.array(columns["isError"], type=pa.int8()),
+        })
+
+    def diff_tail(
+        self,
+        chain: Chain,
+        txs: List[ScanTxn],
+        start_block: int,
+        where: Optional[Callable[[Dict], bool]] = None) -> Tuple[List[ScanTxn], List[ScanTxn], List[str]]:
+        """Compare transactions re-fetched from `start_block` on against the cache
+
+        :param chain: chain of the transactions
+        :param txs: every transaction of the chain from `start_block` on, as fetched now,
+            transactions below `start_block`, backfilled for new watches, are returned as new
+        :param start_block: first re-fetched block
+        :param where: only compare against cached transactions passing this predicate,
+            e.g. the ones of addresses that were re-fetched
+        :return: new transactions, transactions cached with another `blockNumber`
+            or `blockHash` (reorged), and row keys cached from `start_block` on
+            that are no longer returned, which a lagging explorer also causes
+        """
+        cached = {
+            TxnStore.key(tx["hash"], tx.get("logIndex")): (tx["blockNumber"], tx["blockHash"])
+            for tx in self.iter_raw(chain, start_block)
+            if where is None or where(tx)
+        }
+        fetched = set()
+        new, changed = [], []
+        for tx in txs:
+            key = TxnStore.tx_key(tx)
+            if key in fetched:
+                continue
+            fetched.add(key)
+            previous = cached.get(key)
+            if previous is None:
+                new.append(tx)
+            elif previous != (tx.blockNumber, tx.blockHash):
+                changed.append(tx)
+        removed = [key for key in cached.keys() if key not in fetched]
+        return new, changed, removed
+
+    def delete(self, chain: Chain, keys: List[str]) -> None:
+        """Remove transactions of a chain by row key, and their index rows"""
+        if not keys:
+            return
+        keys = set(keys)
+        for key in keys:
+            try:
+                os.remove(self.tx_path(chain, key))
+            except FileNotFoundError:
+                pass
+        rows = [row for row in self.read_index(chain) if row[1] not in keys]
+        self._write_index_rows(chain, rows)
+        self.touch(chain)
+
+    def save(self, chain: Chain, txs: List[ScanTxn]) -> None:
+        """Write transactions of a chain and add them to its block index"""
+        for tx in txs:
+            save_path = self.tx_path(chain, TxnStore.tx_key(tx))
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+            with open(save_path, "w") as fp:
+                json.dump(tx.to_json(), fp, indent=4)
+        self.write_index(chain, txs)
+        self.touch(chain)
@@ -1,28 +1,67 @@
+from __future__ import annotations
+
 import json
 import logging
-from typing import List, Union, Optional
+import re
+import time
+from typing import TYPE_CHECKING, Dict, List, Union, Optional
 
-import pandas as pd
 import requests
 
+from api.archive import archive
 from api.constant import Chain
+from api.metrics import metrics
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 class BaseSubGraphQuery(object):
 
-    def __init__(self, subgraph_url: str) -> None:
+    def __init__(self, subgraph_url: str, chain: Optional[Chain] = None) -> None:
         self.url = subgraph_url
+        self.chain = chain
 
     def query(self, query: str):
         data = json.dumps({"query": query}).replace("\n", "").replace(" ", "")
-        response = requests.post(
-            self.url, 
-            data=data)
+        # first queried entity, e.g. `pools`, used as metric label
+        entity = re.search(r"\{\s*(?:\w+\s*:\s*)?(\w+)", query)
+        action = entity.group(1) if entity is not None else ""
+        endpoint = self.url.rsplit("/", 1)[-1]
 
-        if response.status_code != 200:
-            raise ConnectionError(response.text)
+        start = time.perf_counter()
+        status = "error"
+        n_bytes = 0
+        try:
+            response = requests.post(
+                self.url, 
+                data=data)
+            n_bytes = len(response.content)
 
-        return response.json()
+            if response.status_code != 200:
+                if response.status_code == 429:
+                    status = "rate_limited"
+                raise ConnectionError(response.text)
+
+            status = "ok"
+            result = response.json()
+            if archive.enabled:
+                block = re.search(r"block:\s*\{\s*number:\s*(\d+)", query)
+                block = int(block.group(1)) if block is not None else None
+                archive.put(
+                    "subgraph", self.chain or Chain.ETHEREUM, endpoint, action, {"query": query}, result,
+                    block_range=(block, block))
+            return result
+        finally:
+            metrics.observe_request(
+                "subgraph", self.chain or Chain.ETHEREUM, endpoint, action,
+                latency=time.perf_counter() - start, status=status, n_bytes=n_bytes)
+
+    def get_indexed_block(self) -> Optional[int]:
+        """Last block indexed by the subgraph, None if it doesn't report it"""
+        result = self.query("{_meta{block{number}}}")
+        meta = (result.get("data") or {}).get("_meta")
+        return int(meta["block"]["number"]) if meta else None
 
 
 class UniswapV3SubGraph(BaseSubGraphQuery):
@@ -87,7 +126,30 @@ class UniswapV3SubGraph(BaseSubGraphQuery):
         result = self.query(query)
         logging.debug(result)
         return result["data"]["pools"]
-    
+
+    def get_pool_prices(self, pool_ids: List[str], blocks: List[int]) -> Dict[int, List[dict]]:
+        """`token0Price` and `token1Price` of pools at each block, in one aliased query
+
+        Pools not deployed yet at a block are missing from its list.
+        """
+        pool_ids = str([pool_id.lower() for pool_id in pool_ids]).replace("'", '"')
+        query = "{"
+        for block in blocks:
+            query += """
+            b""" + str(block) + """: pools(
+                block: {number: """ + str(block) + """},
+                where: {id_in: """ + pool_ids + """}
+            ) {
+                id,
+                token0Price,
+                token1Price
+            }"""
+        query += "}"
+        result = self.query(query)
+        if result.get("errors"):
+            raise ConnectionError(f"Failed to query pools at blocks {blocks[0]}-{blocks[-1]}: {result['errors']}")
+        return {int(alias[1:]): pools for alias, pools in result["data"].items()}
+
 
 class EthereumBlocksSubGraph(BaseSubGraphQuery):
 
@@ -133,14 +195,28 @@ class EthereumBlocksSubGraph(BaseSubGraphQuery):
         result = [_r["timestamp"] for _r in result["data"]["blocks"]]
         return result
 
+    def get_unix_from_blocktimes(self, blocktimes: List[int]) -> Dict[int, int]:
+        """Unix times of blocks in one query, blocks not indexed yet are missing"""
+        query = """{
+            blocks(
+                first: """ + str(len(blocktimes)) + """
+                where: {number_in: """ + str([int(block) for block in blocktimes]) + """}
+            ) {
+                number
+                timestamp
+            }
+        }"""
+        result = self.query(query)
+        return {int(_r["number"]): int(_r["timestamp"]) for _r in result["data"]["blocks"]}
+
 
 class ConnextSubgraph(BaseSubGraphQuery):
 
     def __init__(self, chain: Chain) -> None:
-        self.chain = chain
         subgraph_url = ConnextSubgraph.get_subgraph_url(chain)
         super().__init__(
-            subgraph_url=subgraph_url)
+            subgraph_url=subgraph_url,
+            chain=chain)
         
     @staticmethod
     def get_subgraph_url(chain: Chain) -> str:
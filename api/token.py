@@ -1,9 +1,29 @@
 from __future__ import annotations
-from typing import Optional
 
-from api.contract import ERC20Token
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
 from api.constant import Chain
 
+if TYPE_CHECKING:
+    from api.contract import ERC20Token
+
+
+class LazyRegistry(object):
+    """Class attribute built by `factory` on first access, so importing the module stays cheap"""
+
+    def __init__(self, factory: Callable[[], Any]) -> None:
+        self.factory = factory
+        self.value = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance: Any, owner: type) -> Any:
+        if self.value is None:
+            with self._lock:
+                if self.value is None:
+                    self.value = self.factory()
+        return self.value
+
 
 class Token:
     USDC = "USDC"
@@ -11,7 +31,71 @@ class Token:
     CUSDCLP = "CUSDCLP"
     CWETHLP = "CWETHLP"
 
-    address_mapper = {
+    # ERC20Token objects are built on first access, see `LazyRegistry`
+    address_mapper = LazyRegistry(lambda: _build_address_mapper())
+
+    @staticmethod
+    def address_lookup(address: str, chain: Chain) -> Optional[ERC20Token]:
+        for token in Token.address_mapper[chain]["canonical"].values():
+            if token.address.lower() == address.lower():
+                return token
+        for token in Token.address_mapper[chain]["next"].values():
+            if token.address.lower() == address.lower():
+                return token
+        for token in Token.address_mapper[chain]["lp"].values():
+            if token.address.lower() == address.lower():
+                return token
+        return None
+
+    @staticmethod
+    def symbol_lookup(address: str, chain: Chain) -> Optional[str]:
+        """Registry name (e.g. `USDC`) of a canonical, next or LP token, without loading its metadata"""
+        for tokens in Token.address_mapper[chain].values():
+            for symbol, token in tokens.items():
+                # unknown addresses are empty strings
+                if not isinstance(token, str) and token.address.lower() == address.lower():
+                    return symbol
+        return None
+
+    @staticmethod
+    def get_canonical(chain: Chain, token: str) -> ERC20Token:
+        return Token.address_mapper[chain]["canonical"][token]
+
+    @staticmethod
+    def get_next(chain: Chain, token: str) -> ERC20Token:
+        return Token.address_mapper[chain]["next"][token]
+
+    @staticmethod
+    def get_lp(chain: Chain, token: str) -> ERC20Token:
+        return Token.address_mapper[chain]["lp"][token]
+    
+    @staticmethod
+    def snapshot_pools(chain: Chain, block: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+        """Reserves, virtual price and LP supply of the USDC and WETH stable swap pools of chain
+
+        Pool keys and states are read in two multicalls, the states optionally at `block`.
+
+        :param chain: chain of the pools, Ethereum has none
+        :param block: block to read at, latest if None
+        """
+        from api.contract import ConnextDiamond
+
+        diamond = ConnextDiamond(chain)
+        next_tokens = {token: Token.get_next(chain, token) for token in [Token.USDC, Token.WETH]}
+        addresses = diamond.get_pool_keys([token.address for token in next_tokens.values()])
+        pool_keys = {
+            token: addresses[next_token.address]
+            for token, next_token in next_tokens.items() if next_token.address in addresses
+        }
+        lp_tokens = {token: Token.get_lp(chain, token) for token in pool_keys.keys()}
+        return diamond.get_pool_states(pool_keys, lp_tokens, block)
+
+
+def _build_address_mapper() -> Dict[Chain, Dict[str, Dict[str, Any]]]:
+    from api.contract import ERC20Token
+
+    USDC, WETH, CUSDCLP, CWETHLP = Token.USDC, Token.WETH, Token.CUSDCLP, Token.CWETHLP
+    return {
         Chain.ETHEREUM: {
             "canonical": {
                 USDC: "",
@@ -96,31 +180,5 @@ class Token:
                 WETH: ERC20Token(Chain.GNOSIS, "0x7aC5bBefAE0459F007891f9Bd245F6beaa91076c"),
             }
         },
-        
+    
     }
-
-    @staticmethod
-    def address_lookup(address: str, chain: Chain) -> Optional[ERC20Token]:
-        for token in Token.address_mapper[chain]["canonical"].values():
-            if token.address.lower() == address.lower():
-                return token
-        for token in Token.address_mapper[chain]["next"].values():
-            if token.address.lower() == address.lower():
-                return token
-        for token in Token.address_mapper[chain]["lp"].values():
-            if token.address.lower() == address.lower():
-                return token
-        return None
-
-    @staticmethod
-    def get_canonical(chain: Chain, token: str) -> ERC20Token:
-        return Token.address_mapper[chain]["canonical"][token]
-
-    @staticmethod
-    def get_next(chain: Chain, token: str) -> ERC20Token:
-        return Token.address_mapper[chain]["next"][token]
-
-    @staticmethod
-    def get_lp(chain: Chain, token: str) -> ERC20Token:
-        return Token.address_mapper[chain]["lp"][token]
-    
\ No newline at end of file
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+from functools import partial
+from typing import Dict, List, Optional, Set, Union
+
+from api.constant import Chain
+from api.scan import ScanTxn
+
+
+class Watch(object):
+    """
+    An address whose transactions or token transfers are fetched into a cache.
+
+    `transactions` watches fetch explorer `txlist` of the address, `transfers`
+    watches fetch Transfer events of the token at the address (explorer
+    `tokentx` or `eth_getLogs`).
+    """
+
+    TRANSACTIONS = "transactions"
+    TRANSFERS = "transfers"
+
+    def __init__(
+        self,
+        chain: Chain,
+        address: str,
+        kind: str = TRANSACTIONS,
+        start_block: int = 0,
+        functions: Optional[List[str]] = None,
+        name: Optional[str] = None,
+        tenant: str = "default") -> None:
+        """
+        :param chain: chain of the address
+        :param address: contract or token address
+        :param kind: `transactions` or `transfers`
+        :param start_block: first block to fetch
+        :param functions: only keep transactions calling these functions, e.g. `["xcall"]`
+        :param name: label of the watch, defaults to the address
+        :param tenant: owner of the watch, watches of every tenant are fetched together
+        """
+        if kind not in [Watch.TRANSACTIONS, Watch.TRANSFERS]:
+            raise ValueError(f"Unknown watch kind {kind}, only {Watch.TRANSACTIONS}|{Watch.TRANSFERS}")
+        self.chain = chain
+        self.address = address
+        self.kind = kind
+        self.start_block = int(start_block)
+        self.functions = None if functions is None else {_name.split("(")[0] for _name in functions}
+        self.name = name or address
+        self.tenant = tenant
+
+    def __repr__(self) -> str:
+        return f"Watch(chain={self.chain}, address={self.address}, kind={self.kind}, tenant={self.tenant})"
+
+    @property
+    def key(self) -> str:
+        return f"{self.kind}:{self.address.lower()}"
+
+    def matches(self, tx: Union[ScanTxn, Dict]) -> bool:
+        """Whether a transaction (`ScanTxn` or its JSON) falls under this watch"""
+        get = tx.get if isinstance(tx, dict) else partial(getattr, tx)
+        address = self.address.lower()
+        if int(get("blockNumber")) < self.start_block:
+            return False
+        if self.kind == Watch.TRANSFERS:
+            return (get("contractAddress") or "").lower() == address
+        # contract creations have the address in `contractAddress`
+        if address not in [(get(field) or "").lower() for field in ["from_address", "to_address", "contractAddress"]]:
+            return False
+        if self.functions is None:
+            return True
+        return (get("functionName") or "").split("(")[0] in self.functions
+
+
+class Watchlist(object):
+    """
+    Addresses fetched per chain, shared by every tenant.
+
+    Watches of a chain already fetched resume from the unconfirmed tail of the
+    cache, which is reconciled for all of them at once, and watches added later
+    are backfilled from their own start block. `transfers` watches scanned over
+    RPC from the same block share the same `eth_getLogs` windows, explorer
+    `txlist` and `tokentx` take one address and cost one scan per watch.
+
+    Load one from YAML with `Watchlist.load`:
+
+        watches:
+          - chain: gnosis
+            address: "0x5bB83e95f63217CDa6aE3D181BA580Ef377D2109"
+            kind: transactions
+            start_block: 25562300
+            functions: [xcall]
+            tenant: bridge
+    """
+
+    def __init__(self, watches: List[Watch]) -> None:
+        self.watches = watches
+
+    def __len__(self) -> int:
+        return len(self.watches)
+
+    def select(self, kind: Optional[str] = None, tenant: Optional[str] = None) -> "Watchlist":
+        """Watches of a kind and/or tenant"""
+        return Watchlist([
+            watch for watch in self.watches
+            if (kind is None or watch.kind == kind) and (tenant is None or watch.tenant == tenant)
+        ])
+
+    def chains(self) -> List[Chain]:
+        """Chains with at least one watch, in watchlist order"""
+        return list(dict.fromkeys(watch.chain for watch in self.watches))
+
+    def tenants(self) -> List[str]:
+        return list(dict.fromkeys(watch.tenant for watch in self.watches))
+
+    def get(self, chain: Chain) -> List[Watch]:
+        return [watch for watch in self.watches if watch.chain == chain]
+
+    def addresses(self, chain: Chain) -> List[str]:
+        return list({watch.address.lower(): watch.address for watch in self.get(chain)}.values())
+
+    def matches(self, chain: Chain, tx: Union[ScanTxn, Dict]) -> bool:
+        """Whether any watch of the chain covers the transaction"""
+        return any(watch.matches(tx) for watch in self.get(chain))
+
+    def filter(self, chain: Chain, txs: List[ScanTxn]) -> List[ScanTxn]:
+        """Transactions of the chain covered by a watch, e.g. to split a shared cache by tenant"""
+        return [tx for tx in txs if self.matches(chain, tx)]
+
+    def fetch_starts(self, chain: Chain, tail_start: int, synced: Set[str]) -> Dict[str, int]:
+        """First block to fetch for each watch of a chain, by watch key
+
+        Watches already fetched resume from the unconfirmed tail of the cache,
+        new watches are backfilled from their start block, so adding a watch
+        doesn't re-fetch the others.
+
+        :param chain: chain to fetch
+        :param tail_start: first unconfirmed block of the cache
+        :param synced: keys of the watches fetched on earlier runs
+        """
+        return {
+            watch.key: max(watch.start_block, tail_start) if watch.key in synced else watch.start_block
+            for watch in self.get(chain)
+        }
+
+    @staticmethod
+    def load(path: str) -> "Watchlist":
+        """Load watches from a YAML file, interpolations like `${oc.env:VAR}` are resolved"""
+        from omegaconf import OmegaConf
+
+        config = OmegaConf.to_container(OmegaConf.load(path), resolve=True)
+        return Watchlist([Watch(**watch) for watch in config.get("watches", [])])
+
+
+class WatchState(object):
+    """
+    Keys of the watches of each chain fetched into a cache, persisted as JSON
+    so watches added to the watchlist later are backfilled from their start block.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: JSON file of the state
+        """
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self) -> Dict[Chain, Set[str]]:
+        if not self.exists():
+            return {}
+        with open(self.path, "r") as fp:
+            return {chain: set(keys) for chain, keys in json.load(fp).items()}
+
+    def save(self, synced: Dict[Chain, Set[str]]) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump({chain: sorted(keys) for chain, keys in synced.items()}, fp, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def rebuild(self, watchlist: Watchlist, cached: Dict[Chain, List[ScanTxn]]) -> Dict[Chain, Set[str]]:
+        """Mark watches with cached transactions as fetched, for caches built before the state existed"""
+        logging.info(f"Building watch state at {self.path}")
+        synced = {
+            chain: {watch.key for watch in watchlist.get(chain) if any(watch.matches(tx) for tx in cached.get(chain, []))}
+            for chain in watchlist.chains()
+        }
+        self.save(synced)
+        return synced
@@ -0,0 +1,77 @@
+"""Scaling benchmark of the LP analytics runner on a synthetic event table.
+
+The same table is scored with each worker count, results must match the
+single-worker run.
+
+Usage (from the repository root):
+    python -m benchmarks.analytics
+    python -m benchmarks.analytics --events 5000000 --wallets 500000 --workers 1 2 4 8 --executor process
+"""
+import argparse
+import json
+import logging
+import time
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from api.analytics import AnalyticsRunner
+from api.constant import Chain
+from api.executor import Executor
+from api.token import Token
+
+
+def generate_events(n_events: int, n_wallets: int, days: int = 120, seed: int = 0) -> pd.DataFrame:
+    """LP event table shaped like `LPAnalytics.get_lp_txs` with random mints and burns"""
+    rng = np.random.default_rng(seed)
+    chains = [Chain.POLYGON, Chain.ARBITRUM_ONE, Chain.BNB_CHAIN, Chain.GNOSIS, Chain.OPTIMISM]
+    wallets = np.array([f"0x{i:040x}" for i in range(1, n_wallets + 1)], dtype=object)
+    actions = rng.choice(["mint", "burn"], n_events)
+    amount = rng.exponential(100., n_events)
+    times = 1675209600 + np.sort(rng.integers(0, days * 86400, n_events))
+    return pd.DataFrame({
+        "chain": rng.choice(chains, n_events),
+        "token": rng.choice([Token.CUSDCLP, Token.CWETHLP], n_events),
+        "user": wallets[rng.integers(0, n_wallets, n_events)],
+        "action": actions,
+        "amount": amount,
+        "balance_change": np.where(actions == "mint", amount, -amount),
+    }, index=pd.to_datetime(times, unit="s"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1_000_000)
+    parser.add_argument("--wallets", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--executor", default=Executor.PROCESS, choices=[Executor.PROCESS, Executor.THREAD])
+    parser.add_argument("--timeframe", default="1min")
+    parser.add_argument("--output", default=None, help="write results as JSON to this path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    lp_txs = generate_events(args.events, args.wallets)
+    results: List[Dict] = []
+    baseline = None
+    for num_workers in args.workers:
+        runner = AnalyticsRunner(args.executor, num_workers)
+        start = time.perf_counter()
+        output = runner.run(lp_txs, "2023-02-15", "2023-05-15", args.timeframe)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = output
+        elif not np.allclose(output["scores"]["score"], baseline["scores"]["score"]):
+            raise AssertionError(f"Scores with {num_workers} workers differ from {args.workers[0]} workers")
+        results.append({"num_workers": num_workers, "elapsed_sec": round(elapsed, 3), "n_scores": len(output["scores"])})
+
+    print(f"{'workers':<10}{'elapsed':>10}{'speedup':>10}")
+    for result in results:
+        print(f"{result['num_workers']:<10}{result['elapsed_sec']:>10}{results[0]['elapsed_sec'] / result['elapsed_sec']:>10.2f}")
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=4)
+
+
+if __name__ == "__main__":
+    main()
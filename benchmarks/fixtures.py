@@ -0,0 +1,196 @@
+import json
+import logging
+import random
+from typing import Dict, List, Optional
+
+from web3 import Web3
+
+from api.constant import Chain, DiamondContract
+
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+NULL_ADDRESS = "0x0000000000000000000000000000000000000000"
+WETH_USDC_POOL = "0x88e6a0c2ddd26feeb64f039a2c41296fcb3f5640"
+WBTC_USDC_POOL = "0x99ac8ca7087fa4a2a1fb6357269965a2014abc35"
+
+
+class Fixture(object):
+    """
+    Dataset served by the mock explorer/subgraph/RPC server.
+
+    The on-disk format is a single JSON document:
+        {
+            "txlist": {chain: [explorer txlist rows]},
+            "tokentx": {chain: [explorer tokentx rows]},
+            "receipts": {chain: {hash: receipt}},
+            "blocks": {block: timestamp},           # ethereum blocks subgraph
+            "pools": {pool_id: {block: pool}},      # uniswap v3 subgraph
+            "origin_transfers": {hash: transfer},   # connext subgraph
+            "lp_tokens": {chain: [address]}
+        }
+    Rows are kept in the explorer's raw string format so the fetch code
+    parses exactly what it would parse from the live API.
+    """
+
+    KEYS = ["txlist", "tokentx", "receipts", "blocks", "pools", "origin_transfers", "lp_tokens"]
+
+    def __init__(self, data: Optional[Dict] = None) -> None:
+        data = data or {}
+        for key in Fixture.KEYS:
+            setattr(self, key, data.get(key, {}))
+
+    def to_json(self) -> Dict:
+        return {key: getattr(self, key) for key in Fixture.KEYS}
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as fp:
+            json.dump(self.to_json(), fp)
+
+    @staticmethod
+    def load(path: str) -> "Fixture":
+        with open(path, "r") as fp:
+            return Fixture(json.load(fp))
+
+    def logs(self, chain: Chain) -> List[dict]:
+        """All receipt logs of a chain, as returned by `eth_getLogs`"""
+        logs = []
+        for receipt in self.receipts.get(chain, {}).values():
+            logs.extend(receipt["logs"])
+        return sorted(logs, key=lambda x: (int(x["blockNumber"], 16), int(x["logIndex"], 16)))
+
+
+def _hex32(rng: random.Random) -> str:
+    return "0x" + "".join(rng.choice("0123456789abcdef") for _ in range(64))
+
+
+def _address(rng: random.Random) -> str:
+    return "0x" + "".join(rng.choice("0123456789abcdef") for _ in range(40))
+
+
+def _topic(address: str) -> str:
+    return "0x" + address[2:].rjust(64, "0")
+
+
+def generate_fixture(
+    chains: List[Chain],
+    n_txs: int = 2000,
+    n_wallets: int = 200,
+    n_price_blocks: int = 500,
+    seed: int = 0) -> Fixture:
+    """Generate a deterministic synthetic fixture shaped like the live APIs
+
+    :param chains: chains to generate data for
+    :param n_txs: number of Diamond transactions per chain
+    :param n_wallets: number of distinct wallets
+    :param n_price_blocks: number of ethereum blocks with pool prices
+    :param seed: random seed
+    """
+    rng = random.Random(seed)
+    with open("./abi/ConnextDiamond.json", "r") as fp:
+        diamond = Web3().eth.contract(abi=json.load(fp))
+    wallets = [_address(rng) for _ in range(n_wallets)]
+    fixture = Fixture()
+
+    for chain in chains:
+        diamond_address = DiamondContract.get_contract_address(chain).lower()
+        lp_tokens = [_address(rng), _address(rng)]
+        asset = _address(rng)
+        fixture.lp_tokens[chain] = lp_tokens
+        fixture.txlist[chain] = []
+        fixture.tokentx[chain] = []
+        fixture.receipts[chain] = {}
+
+        block = 1_000_000
+        for i in range(n_txs):
+            block += rng.randint(1, 20)
+            wallet = rng.choice(wallets)
+            tx_hash = _hex32(rng)
+            block_hash = _hex32(rng)
+            amount = rng.randint(10**6, 10**21)
+            draw = rng.random()
+            log = {
+                "blockNumber": hex(block),
+                "blockHash": block_hash,
+                "transactionHash": tx_hash,
+                "transactionIndex": "0x0",
+                "logIndex": "0x0",
+                "removed": False,
+                "data": "0x" + hex(amount)[2:].rjust(64, "0"),
+            }
+            if draw < 0.7:
+                fn = "xcall(uint32 _destination, address _to, address _asset, address _delegate, uint256 _amount, uint256 _slippage, bytes _callData)"
+                data = diamond.encodeABI(fn_name="xcall", args=[
+                    6648936, Web3.toChecksumAddress(wallet), Web3.toChecksumAddress(asset),
+                    Web3.toChecksumAddress(wallet), amount, 30, b""])
+                log.update(address=asset, topics=[TRANSFER_TOPIC, _topic(wallet), _topic(diamond_address)])
+                fixture.origin_transfers[tx_hash] = {
+                    "transactionHash": tx_hash, "originDomain": "6648936", "destinationDomain": "6648936",
+                    "bridgedAmt": str(amount), "status": "XCalled", "timestamp": str(1670000000 + block)}
+            elif draw < 0.85:
+                fn = "addSwapLiquidity(bytes32 key, uint256[] amounts, uint256 minToMint, uint256 deadline)"
+                data = diamond.encodeABI(fn_name="addSwapLiquidity", args=[b"\x01" * 32, [amount, 0], 0, 2**32])
+                log.update(address=rng.choice(lp_tokens), topics=[TRANSFER_TOPIC, _topic(NULL_ADDRESS), _topic(wallet)])
+            else:
+                fn = "removeSwapLiquidity(bytes32 key, uint256 amount, uint256[] minAmounts, uint256 deadline)"
+                data = diamond.encodeABI(fn_name="removeSwapLiquidity", args=[b"\x01" * 32, amount, [0, 0], 2**32])
+                log.update(address=rng.choice(lp_tokens), topics=[TRANSFER_TOPIC, _topic(wallet), _topic(NULL_ADDRESS)])
+
+            row = {
+                "blockNumber": str(block), "timeStamp": str(1670000000 + block), "hash": tx_hash,
+                "nonce": str(i), "blockHash": block_hash, "transactionIndex": "0",
+                "from": wallet, "to": diamond_address, "value": str(rng.randint(0, 10**16)),
+                "gas": "300000", "gasPrice": "1000000000", "isError": "0", "txreceipt_status": "1",
+                "input": data, "contractAddress": "", "cumulativeGasUsed": "200000", "gasUsed": "150000",
+                "confirmations": "100", "methodId": data[:10], "functionName": fn,
+            }
+            fixture.txlist[chain].append(row)
+            fixture.receipts[chain][tx_hash] = {
+                "transactionHash": tx_hash, "blockHash": block_hash, "blockNumber": hex(block),
+                "status": "0x1", "logs": [log]}
+
+            if i % 4 == 0:
+                # LP token moving between wallets
+                sender, receiver = rng.sample(wallets, 2)
+                lp_token = rng.choice(lp_tokens)
+                transfer_hash = _hex32(rng)
+                fixture.tokentx[chain].append({
+                    "blockNumber": str(block), "timeStamp": str(1670000000 + block), "hash": transfer_hash,
+                    "nonce": str(i), "blockHash": block_hash, "transactionIndex": "1",
+                    "from": sender, "to": receiver, "value": str(amount), "contractAddress": lp_token,
+                    "tokenName": "Connext LP", "tokenSymbol": "CLP", "tokenDecimal": "18",
+                    "gas": "100000", "gasPrice": "1000000000", "input": "deprecated",
+                    "cumulativeGasUsed": "100000", "gasUsed": "60000", "confirmations": "100",
+                    "methodId": "0xa9059cbb", "functionName": "transfer(address _to, uint256 _value)",
+                })
+                fixture.receipts[chain][transfer_hash] = {
+                    "transactionHash": transfer_hash, "blockHash": block_hash, "blockNumber": hex(block),
+                    "status": "0x1", "logs": [dict(
+                        log, transactionHash=transfer_hash, transactionIndex="0x1", address=lp_token,
+                        topics=[TRANSFER_TOPIC, _topic(sender), _topic(receiver)])]}
+
+    price = 1500.
+    fixture.pools[WETH_USDC_POOL] = {}
+    for i in range(n_price_blocks):
+        block = 16233067 + i
+        price *= 1 + rng.gauss(0, 0.001)
+        fixture.blocks[str(block)] = str(1671000000 + 12 * i)
+        fixture.pools[WETH_USDC_POOL][str(block)] = {
+            "id": WETH_USDC_POOL,
+            "token0": {"id": "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48", "symbol": "USDC", "name": "USD Coin"},
+            "token1": {"id": "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2", "symbol": "WETH", "name": "Wrapped Ether"},
+            "token0Price": str(price), "token1Price": str(1 / price), "totalValueLockedUSD": "300000000",
+        }
+
+    btc_price = 17000.
+    fixture.pools[WBTC_USDC_POOL] = {}
+    for i in range(n_price_blocks):
+        block = 16233067 + i
+        btc_price *= 1 + rng.gauss(0, 0.001)
+        fixture.pools[WBTC_USDC_POOL][str(block)] = {
+            "id": WBTC_USDC_POOL,
+            "token0": {"id": "0x2260fac5e5542a773aa44fbcfedf7c193bc2c599", "symbol": "WBTC", "name": "Wrapped BTC"},
+            "token1": {"id": "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48", "symbol": "USDC", "name": "USD Coin"},
+            "token0Price": str(1 / btc_price), "token1Price": str(btc_price), "totalValueLockedUSD": "100000000",
+        }
+
+    logging.info(f"Generated fixture with {sum(len(v) for v in fixture.txlist.values())} txs")
+    return fixture
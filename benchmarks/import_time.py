@@ -0,0 +1,76 @@
+"""Import-time budget of the api package.
+
+Each module is imported in a fresh interpreter, the best of `--repeat` runs is
+compared against `--budget`, and heavy dependencies that should load lazily
+must not be imported. Exits non-zero on any violation.
+
+Usage (from the repository root):
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --modules api api.connext --budget 0.2 --forbid web3 pandas
+"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+from typing import Dict, List
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed_sec": elapsed, "modules": sorted(sys.modules.keys())}}))
+"""
+
+
+def measure_import(module: str, repeat: int) -> Dict:
+    """Best import time of `module` over `repeat` fresh interpreters, and the modules it loaded"""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module)], capture_output=True, text=True, check=True)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run["elapsed_sec"])
+    return {"module": module, "elapsed_sec": round(best["elapsed_sec"], 4), "modules": best["modules"]}
+
+
+def find_violations(results: List[Dict], budget: float, forbid: List[str]) -> List[str]:
+    violations = []
+    for result in results:
+        if result["elapsed_sec"] > budget:
+            violations.append(f"{result['module']}: {result['elapsed_sec']}s > {budget}s budget")
+        loaded = [name for name in forbid if name in result["modules"]]
+        if loaded:
+            violations.append(f"{result['module']}: imports {', '.join(loaded)} eagerly")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=["api", "api.connext", "api.price", "api.token"])
+    parser.add_argument("--budget", type=float, default=0.3, help="max seconds per import")
+    parser.add_argument("--forbid", nargs="*", default=["web3", "pandas"], help="modules that must load lazily")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="write results as JSON to this path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    results = [measure_import(module, args.repeat) for module in args.modules]
+    print(f"{'module':<18}{'elapsed':>10}{'modules':>10}")
+    for result in results:
+        print(f"{result['module']:<18}{result['elapsed_sec']:>10}{len(result['modules']):>10}")
+
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump([{k: v for k, v in result.items() if k != "modules"} for result in results], fp, indent=4)
+
+    violations = find_violations(results, args.budget, args.forbid)
+    for violation in violations:
+        print(f"BUDGET {violation}")
+    if violations:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
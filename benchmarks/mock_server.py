@@ -0,0 +1,335 @@
+import json
+import logging
+import multiprocessing as mp
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from benchmarks.fixtures import Fixture
+
+
+class RateLimiter(object):
+    """Token bucket per key, `rate` requests per second (0 disables limiting)"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return False
+            self.buckets[key] = (tokens - 1, now)
+            return True
+
+
+class MockState(object):
+
+    def __init__(
+        self,
+        fixture: Fixture,
+        latency: float,
+        jitter: float,
+        rate_limit: float,
+        max_logs: int,
+        error_rate: float = 0.,
+        down: Optional[List[str]] = None) -> None:
+        self.fixture = fixture
+        self.latency = latency
+        self.jitter = jitter
+        self.limiter = RateLimiter(rate_limit)
+        self.max_logs = max_logs
+        self.error_rate = error_rate
+        self.down = down or []
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stats = {"requests": 0, "rejected": 0, "bytes": 0, "by_route": {}}
+
+    def record(self, route: str, n_bytes: int, rejected: bool) -> None:
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += n_bytes
+            self.stats["rejected"] += int(rejected)
+            self.stats["by_route"][route] = self.stats["by_route"].get(route, 0) + 1
+
+    def sleep(self) -> None:
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def is_failing(self, route: str) -> bool:
+        """Whether to answer with a 503, the route is down or a random transient error"""
+        return route in self.down or (self.error_rate > 0 and random.random() < self.error_rate)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Routes:
+    - GET  /explorer/{chain}/api   etherscan-compatible `txlist`, `tokentx` and `eth_getTransactionReceipt`
+    - POST /subgraph/{name}        uniswap-v3, ethereum-blocks and connext subgraphs
+    - POST /rpc/{chain}            JSON-RPC (single or batch)
+    - GET  /explorer-alt/..., POST /rpc-alt/...  alternate endpoints serving the same data
+    - GET  /_stats, POST /_reset   server counters
+    """
+
+    state: MockState = None
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, route: str, status: int, body: Dict, rejected: bool = False, headers: Optional[Dict] = None) -> None:
+        payload = json.dumps(body).encode()
+        if not route.startswith("_"):
+            self.state.record(route, len(payload), rejected)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["_stats"]:
+            payload = json.dumps(self.state.stats).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if len(parts) != 3 or parts[0] not in ["explorer", "explorer-alt"]:
+            self._send("unknown", 404, {"error": "not found"})
+            return
+
+        route, chain = parts[0], parts[1]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.state.sleep()
+        if self.state.is_failing(route):
+            self._send(route, 503, {"error": "Service Unavailable"}, rejected=True)
+            return
+        if not self.state.limiter.allow(f"{route}:{params.get('apikey')}"):
+            # etherscan reports rate limiting with a 200 and status 0
+            self._send(route, 200, {"status": "0", "message": "NOTOK", "result": "Max rate limit reached"}, rejected=True)
+            return
+        self._send(route, 200, self._explorer(chain, params))
+
+    def _explorer(self, chain: str, params: Dict[str, str]) -> Dict:
+        fixture = self.state.fixture
+        action = params.get("action")
+        if action == "eth_getTransactionReceipt":
+            receipt = fixture.receipts.get(chain, {}).get(params["txhash"])
+            return {"jsonrpc": "2.0", "id": 1, "result": receipt}
+        if action not in ["txlist", "tokentx"]:
+            return {"status": "0", "message": "NOTOK", "result": f"Unknown action {action}"}
+
+        rows = getattr(fixture, action).get(chain, [])
+        if action == "tokentx":
+            rows = [row for row in rows if row["contractAddress"].lower() == params.get("contractaddress", "").lower()]
+        start, end = int(params.get("startblock", 0)), int(params.get("endblock", 999999999))
+        page, offset = int(params.get("page", 1)), int(params.get("offset", 1000))
+        rows = [row for row in rows if start <= int(row["blockNumber"]) <= end]
+        rows = rows[(page - 1) * offset: page * offset]
+        if not rows:
+            return {"status": "0", "message": "No transactions found", "result": []}
+        return {"status": "1", "message": "OK", "result": rows}
+
+    def do_POST(self) -> None:
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts == ["_reset"]:
+            self.state.reset()
+            self._send("_reset", 200, {})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if len(parts) != 2 or parts[0] not in ["subgraph", "rpc", "rpc-alt"]:
+            self._send("unknown", 404, {"error": "not found"})
+            return
+
+        route = parts[0]
+        self.state.sleep()
+        if self.state.is_failing(route):
+            self._send(route, 503, {"error": "Service Unavailable"}, rejected=True)
+            return
+        if not self.state.limiter.allow(route):
+            self._send(route, 429, {"error": "Too Many Requests"}, rejected=True, headers={"Retry-After": "1"})
+            return
+        if route == "subgraph":
+            self._send(route, 200, self._subgraph(body["query"]))
+        elif isinstance(body, list):
+            self._send(route, 200, [self._rpc(parts[1], item) for item in body])
+        else:
+            self._send(route, 200, self._rpc(parts[1], body))
+
+    def _subgraph(self, query: str) -> Dict:
+        fixture = self.state.fixture
+        query = query.replace("\\n", "").replace("\n", "").replace(" ", "")
+        data = {}
+        for alias, block in re.findall(r"(?:(\w+):)?pools\((?:block:\{number:(\d+)\},?)?", query):
+            pool_ids = re.findall(r'0x[0-9a-fA-F]{40}', query)
+            pools = []
+            for pool_id in dict.fromkeys(pool_ids):
+                history = fixture.pools.get(pool_id.lower(), {})
+                if history:
+                    pools.append(history.get(block) or history[max(history.keys(), key=int)])
+            data[alias or "pools"] = pools
+        for numbers in re.findall(r"number_in:\[([\d,]+)\]", query):
+            data["blocks"] = [
+                {"id": number, "number": number, "timestamp": fixture.blocks[number]}
+                for number in numbers.split(",") if number in fixture.blocks]
+        for tx_hash in re.findall(r'originTransfers\(where:\{transactionHash:"(0x[0-9a-fA-F]+)"', query):
+            transfer = fixture.origin_transfers.get(tx_hash)
+            data["originTransfers"] = [] if transfer is None else [transfer]
+        return {"data": data}
+
+    def _rpc(self, chain: str, request: Dict) -> Dict:
+        fixture = self.state.fixture
+        method, params = request.get("method"), request.get("params", [])
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        txs = fixture.txlist.get(chain, [])
+        head = int(txs[-1]["blockNumber"]) if txs else 0
+
+        if method == "eth_chainId":
+            response["result"] = "0x1"
+        elif method == "eth_blockNumber":
+            response["result"] = hex(head)
+        elif method == "eth_getBlockByNumber":
+            number = head if params[0] == "latest" else int(params[0], 16)
+            response["result"] = {"number": hex(number), "hash": "0x" + "0" * 64, "timestamp": hex(1670000000 + number), "transactions": []}
+        elif method == "eth_getTransactionReceipt":
+            response["result"] = fixture.receipts.get(chain, {}).get(params[0])
+        elif method == "eth_getLogs":
+            query = params[0]
+            start, end = int(query.get("fromBlock", "0x0"), 16), int(query.get("toBlock", hex(head)), 16)
+            addresses = query.get("address") or []
+            addresses = {a.lower() for a in ([addresses] if isinstance(addresses, str) else addresses)}
+            topics = query.get("topics") or []
+            logs = [
+                log for log in fixture.logs(chain)
+                if start <= int(log["blockNumber"], 16) <= end
+                and (not addresses or log["address"].lower() in addresses)
+                and (not topics or topics[0] is None or log["topics"][0] == topics[0])]
+            if self.state.max_logs and len(logs) > self.state.max_logs:
+                response["error"] = {"code": -32005, "message": f"query returned more than {self.state.max_logs} results"}
+            else:
+                response["result"] = logs
+        else:
+            response["error"] = {"code": -32601, "message": f"Method {method} not supported"}
+        return response
+
+
+def _serve(
+    fixture_path: str,
+    port: int,
+    latency: float,
+    jitter: float,
+    rate_limit: float,
+    max_logs: int,
+    error_rate: float,
+    down: List[str],
+    ready) -> None:
+    MockHandler.state = MockState(Fixture.load(fixture_path), latency, jitter, rate_limit, max_logs, error_rate, down)
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockServer(object):
+    """
+    Local stand-in for block explorers, subgraphs and JSON-RPC endpoints,
+    replaying a `Fixture` in a separate process.
+    """
+
+    def __init__(
+        self,
+        fixture_path: str,
+        latency: float = 0.,
+        jitter: float = 0.,
+        rate_limit: float = 0.,
+        max_logs: int = 10000,
+        error_rate: float = 0.,
+        down: Optional[List[str]] = None,
+        port: int = 0) -> None:
+        """
+        :param fixture_path: path to fixture JSON
+        :param latency: seconds added to every response
+        :param jitter: uniformly random extra latency up to this many seconds
+        :param rate_limit: requests per second per explorer API key / per route, 0 for unlimited
+        :param max_logs: `eth_getLogs` result limit before returning an error
+        :param error_rate: fraction of requests answered with a 503
+        :param down: routes always answering with a 503, e.g. `["explorer", "rpc"]`
+        :param port: port to listen on, 0 for a random free port
+        """
+        self.fixture_path = fixture_path
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.max_logs = max_logs
+        self.error_rate = error_rate
+        self.down = down or []
+        self.port = port
+        self.process = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def explorer_url(self, chain: str, alternate: bool = False) -> str:
+        return f"{self.url}/explorer{'-alt' if alternate else ''}/{chain}/api"
+
+    def subgraph_url(self, name: str) -> str:
+        return f"{self.url}/subgraph/{name}"
+
+    def rpc_url(self, chain: str, alternate: bool = False) -> str:
+        return f"{self.url}/rpc{'-alt' if alternate else ''}/{chain}"
+
+    def start(self) -> "MockServer":
+        ready = mp.Queue()
+        self.process = mp.Process(
+            target=_serve,
+            args=(
+                self.fixture_path, self.port, self.latency, self.jitter, self.rate_limit, self.max_logs,
+                self.error_rate, self.down, ready),
+            daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+        logging.info(f"Mock server listening on {self.url}")
+        return self
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def stats(self) -> Dict:
+        return requests.get(f"{self.url}/_stats").json()
+
+    def reset_stats(self) -> None:
+        requests.post(f"{self.url}/_reset")
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
@@ -0,0 +1,92 @@
+"""Record a benchmark fixture from the live explorers and subgraphs.
+
+Usage (from the repository root, with API keys in `.env`):
+    python -m benchmarks.record --chains gnosis polygon --n-blocks 20000 --output recorded.json
+"""
+import argparse
+import logging
+from typing import List
+
+from dotenv import load_dotenv
+
+from api.constant import Chain, DiamondContract
+from api.scan import ScanAPI
+from api.subgraph import ConnextSubgraph, EthereumBlocksSubGraph, UniswapV3SubGraph
+from benchmarks.fixtures import WETH_USDC_POOL, Fixture
+
+
+def fetch_pages(scan_api: ScanAPI, params: dict, offset: int = 1000) -> List[dict]:
+    """Fetch raw explorer rows, keeping the explorer's string format"""
+    rows = []
+    page = 1
+    while True:
+        response = scan_api.request_with_retry(
+            url=scan_api.api_url, params=dict(params, page=page, offset=offset, sort="asc"))
+        if not response["result"]:
+            return rows
+        rows.extend(response["result"])
+        page += 1
+
+
+def record(chains: List[Chain], n_blocks: int, n_price_blocks: int) -> Fixture:
+    from api.connext import ConnextAPI
+    from api.token import Token
+
+    fixture = Fixture()
+    for chain in chains:
+        scan_api = ScanAPI(chain)
+        start_block = ConnextAPI.get_init_block(chain)
+        end_block = start_block + n_blocks
+        logging.info(f"Recording {chain} blocks {start_block} to {end_block}")
+
+        fixture.txlist[chain] = fetch_pages(scan_api, {
+            "module": "account", "action": "txlist", "address": DiamondContract.get_contract_address(chain),
+            "startblock": start_block, "endblock": end_block})
+        fixture.tokentx[chain] = []
+        fixture.lp_tokens[chain] = []
+        if chain != Chain.ETHEREUM:
+            for token in [Token.USDC, Token.WETH]:
+                token_address = Token.get_lp(chain, token).address
+                fixture.lp_tokens[chain].append(token_address)
+                fixture.tokentx[chain].extend(fetch_pages(scan_api, {
+                    "module": "account", "action": "tokentx", "contractaddress": token_address,
+                    "startblock": start_block, "endblock": end_block}))
+
+        fixture.receipts[chain] = {}
+        for row in fixture.txlist[chain] + fixture.tokentx[chain]:
+            fixture.receipts[chain][row["hash"]] = scan_api.get_transaction_receipt(row["hash"])
+
+        graph = ConnextSubgraph(chain)
+        for row in fixture.txlist[chain]:
+            if row["functionName"].startswith("xcall"):
+                transfers = graph.get_ori_transfer(row["hash"])["data"]["originTransfers"]
+                if transfers:
+                    fixture.origin_transfers[row["hash"]] = transfers[0]
+
+    univ3_sg, blocks_sg = UniswapV3SubGraph(), EthereumBlocksSubGraph()
+    start_block = ConnextAPI.get_init_block(Chain.ETHEREUM)
+    fixture.pools[WETH_USDC_POOL] = {}
+    for block in range(start_block, start_block + n_price_blocks):
+        timestamps = blocks_sg.get_unix_from_blocktime(block)
+        pools = univ3_sg.get_pools(WETH_USDC_POOL, block)
+        if timestamps and pools:
+            fixture.blocks[str(block)] = timestamps[0]
+            fixture.pools[WETH_USDC_POOL][str(block)] = pools[0]
+    return fixture
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chains", nargs="+", default=[Chain.GNOSIS])
+    parser.add_argument("--n-blocks", type=int, default=20000, help="blocks per chain from the Connext init block")
+    parser.add_argument("--n-price-blocks", type=int, default=200)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv(".env")
+
+    record(args.chains, args.n_blocks, args.n_price_blocks).save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""Offline throughput benchmark of the fetch and cache paths.
+
+Usage (from the repository root):
+    python -m benchmarks.run --latency 0.05 --rate-limit 5 --output bench.json
+    python -m benchmarks.run --fixture recorded.json --paths scan_txlist receipts
+    python -m benchmarks.run --baseline bench.json --tolerance 0.2
+    python -m benchmarks.run --paths scan_tokentx rpc_logs --max-logs 100
+    python -m benchmarks.run --error-rate 0.1 --down explorer rpc --failover
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from api.constant import Chain, DiamondContract, EventTopic
+from api.executor import Executor
+from api.log_scanner import LogScanner
+from api.metrics import metrics
+from api.price import PriceFetcher
+from api.profiling import profile
+from api.providers import pools
+from api.retry import health
+from api.scan import ScanAPI
+from api.store import TxnStore
+from api.subgraph import ConnextSubgraph, EthereumBlocksSubGraph, UniswapV3SubGraph
+from benchmarks.fixtures import WBTC_USDC_POOL, WETH_USDC_POOL, Fixture, generate_fixture
+from benchmarks.mock_server import MockServer
+
+APIKEY_ENVS = [
+    "ETHERSCAN_APIKEYS", "BSCSCAN_APIKEYS", "POLYGONSCAN_APIKEYS",
+    "OPTIMISTICSCAN_APIKEYS", "ARBITRUMSCAN_APIKEYS", "GNOSISSCAN_APIKEYS",
+]
+
+
+@contextmanager
+def mock_endpoints(
+    server: MockServer,
+    n_apikeys: int,
+    failover: bool = False,
+    rpc_pool: bool = False) -> Iterator[None]:
+    """Point explorer URLs and API keys at the mock server
+
+    :param failover: fail over to the alternate explorer and RPC routes of the mock server
+    :param rpc_pool: balance RPC requests over the primary and alternate RPC routes
+    """
+    base_url = dict(ScanAPI._base_url)
+    environ = {key: os.environ.get(key) for key in APIKEY_ENVS}
+    fallbacks = dict(health.fallbacks)
+    pool_urls, pool_items = dict(pools.urls), dict(pools.pools)
+    try:
+        for chain in base_url.keys():
+            ScanAPI._base_url[chain] = server.explorer_url(chain)
+            if failover:
+                health.set_fallbacks(server.explorer_url(chain), [server.explorer_url(chain, alternate=True)])
+                health.set_fallbacks(server.rpc_url(chain), [server.rpc_url(chain, alternate=True)])
+            if rpc_pool:
+                pools.set_urls(chain, [server.rpc_url(chain), server.rpc_url(chain, alternate=True)])
+        for key in APIKEY_ENVS:
+            os.environ[key] = ",".join(f"bench{i}" for i in range(n_apikeys))
+        yield
+    finally:
+        ScanAPI._base_url.update(base_url)
+        health.fallbacks = fallbacks
+        pools.urls, pools.pools = pool_urls, pool_items
+        for key, value in environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def run_tasks(executor: Executor, fn: Callable, tasks: List) -> Tuple[int, int]:
+    """Run tasks concurrently, returns number of succeeded and failed tasks"""
+    def run(task) -> bool:
+        try:
+            fn(task)
+            return True
+        except Exception as e:
+            logging.debug(f"Task {task} failed: {e}")
+            return False
+
+    n_succeeded = sum(executor.map(run, tasks))
+    return n_succeeded, len(tasks) - n_succeeded
+
+
+# client-side counters reported per path, by result key
+CLIENT_COUNTERS = {
+    "retries_total": "retries",
+    "retry_backoff_seconds_total": "backoff_sec",
+    "circuit_opened_total": "circuits_opened",
+    "failovers_total": "failovers",
+    "hedged_requests_total": "hedges",
+}
+
+
+def client_counter(name: str) -> float:
+    return sum(metrics.counters.get(name, {}).values())
+
+
+def measure(name: str, server: MockServer, fn: Callable[[], Union[int, Tuple[int, int]]], unit: str) -> Dict:
+    """Run `fn` once and report wall time, throughput and peak Python heap
+
+    `fn` returns the number of items processed, or a tuple of (succeeded, failed).
+    Circuits are closed and RPC latencies forgotten before the run, retries,
+    backoff time, opened circuits, failovers and hedges are counted client-side.
+    """
+    server.reset_stats()
+    health.reset()
+    pools.reset()
+    counters = {name: client_counter(name) for name in CLIENT_COUNTERS}
+    tracemalloc.start()
+    start = time.perf_counter()
+    n_items = fn()
+    n_failed = 0
+    if isinstance(n_items, tuple):
+        n_items, n_failed = n_items
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = server.stats()
+
+    result = {
+        "path": name,
+        "elapsed_sec": round(elapsed, 4),
+        "requests": stats["requests"],
+        "rejected": stats["rejected"],
+        "requests_per_sec": round(stats["requests"] / elapsed, 2) if elapsed > 0 else None,
+        unit: n_items,
+        f"{unit}_per_sec": round(n_items / elapsed, 2) if elapsed > 0 else None,
+        "failed": n_failed,
+        "peak_memory_mb": round(peak / 2**20, 2),
+    }
+    for counter, value in counters.items():
+        result[CLIENT_COUNTERS[counter]] = round(client_counter(counter) - value, 3)
+    logging.info(json.dumps(result))
+    return result
+
+
+def run_benchmarks(
+    fixture: Fixture,
+    server: MockServer,
+    paths: List[str],
+    executor: str,
+    num_workers: int,
+    n_apikeys: int,
+    failover: bool = False,
+    rpc_pool: bool = False) -> List[Dict]:
+    chains = list(fixture.txlist.keys())
+    results = []
+    fetched = {}
+
+    with mock_endpoints(server, n_apikeys, failover, rpc_pool), tempfile.TemporaryDirectory() as tmp_dir:
+        if "scan_txlist" in paths:
+            def fetch_txlist() -> int:
+                for chain in chains:
+                    fetched[chain] = ScanAPI(chain).get_transaction_by_address(
+                        DiamondContract.get_contract_address(chain), startblock=0)
+                return sum(len(txs) for txs in fetched.values())
+            results.append(measure("scan_txlist", server, fetch_txlist, "txs"))
+
+        if "scan_tokentx" in paths:
+            def fetch_tokentx() -> int:
+                n_txs = 0
+                for chain in chains:
+                    scan_api = ScanAPI(chain)
+                    for token_address in fixture.lp_tokens.get(chain, []):
+                        n_txs += len(scan_api.get_transfer_events(token_address=token_address, startblock=0))
+                return n_txs
+            results.append(measure("scan_tokentx", server, fetch_tokentx, "txs"))
+
+        if "rpc_logs" in paths:
+            def fetch_logs() -> int:
+                n_logs = 0
+                for chain in chains:
+                    scanner = LogScanner(chain, rpc_url=server.rpc_url(chain), executor=executor, num_workers=num_workers)
+                    n_logs += len(scanner.scan(fixture.lp_tokens.get(chain, []), [EventTopic.TRANSFER], 0))
+                return n_logs
+            results.append(measure("rpc_logs", server, fetch_logs, "logs"))
+
+        if "receipts" in paths:
+            def fetch_receipts() -> int:
+                scan_api = {chain: ScanAPI(chain, apikey_schedule="random") for chain in chains}
+                tasks = [(chain, tx_hash) for chain in chains for tx_hash in fixture.receipts.get(chain, {})]
+                return run_tasks(
+                    Executor(executor, num_workers),
+                    lambda task: scan_api[task[0]].get_transaction_receipt(task[1], timeout=10),
+                    tasks)
+            results.append(measure("receipts", server, fetch_receipts, "receipts"))
+
+        if "subgraph_univ3" in paths:
+            def fetch_prices() -> int:
+                univ3_sg, blocks_sg = UniswapV3SubGraph(), EthereumBlocksSubGraph()
+                univ3_sg.url = server.subgraph_url("uniswap-v3")
+                blocks_sg.url = server.subgraph_url("ethereum-blocks")
+                blocks = [int(block) for block in fixture.pools.get(WETH_USDC_POOL, {})]
+
+                def fetch(block: int) -> None:
+                    blocks_sg.get_unix_from_blocktime(block)
+                    univ3_sg.get_weth_price(block)
+
+                return run_tasks(Executor(executor, num_workers), fetch, blocks)
+            results.append(measure("subgraph_univ3", server, fetch_prices, "prices"))
+
+        if "subgraph_prices" in paths:
+            def fetch_price_batches() -> int:
+                fetcher = PriceFetcher(
+                    f"{tmp_dir}/prices", {"WETH": (WETH_USDC_POOL, "token0Price"), "WBTC": (WBTC_USDC_POOL, "token1Price")})
+                fetcher.univ3_sg.url = server.subgraph_url("uniswap-v3")
+                fetcher.eth_block_sg.url = server.subgraph_url("ethereum-blocks")
+                blocks = sorted(int(block) for block in fixture.pools.get(WETH_USDC_POOL, {}))
+                if not blocks:
+                    return 0
+                return fetcher.multiprocess_fetch(num_workers, executor, blocks[0], blocks[-1] + 1)
+            results.append(measure("subgraph_prices", server, fetch_price_batches, "prices"))
+
+        if "subgraph_connext" in paths:
+            def fetch_transfers() -> int:
+                graphs = {chain: ConnextSubgraph(chain) for chain in chains}
+                for chain, graph in graphs.items():
+                    graph.url = server.subgraph_url(f"connext-{chain}")
+                tasks = [(chain, tx["hash"]) for chain in chains for tx in fixture.txlist[chain]
+                         if tx["hash"] in fixture.origin_transfers]
+                return run_tasks(
+                    Executor(executor, num_workers), lambda task: graphs[task[0]].get_ori_transfer(task[1]), tasks)
+            results.append(measure("subgraph_connext", server, fetch_transfers, "transfers"))
+
+        if "cache_load" in paths:
+            store = TxnStore(f"{tmp_dir}/amarok_txs")
+            if not fetched:
+                for chain in chains:
+                    fetched[chain] = ScanAPI(chain).get_transaction_by_address(
+                        DiamondContract.get_contract_address(chain), startblock=0)
+            for chain, txs in fetched.items():
+                store.save(chain, txs)
+            results.append(measure(
+                "cache_load", server,
+                lambda: sum(len(list(store.iter_txs(chain))) for chain in chains), "txs"))
+            results.append(measure(
+                "cache_to_frame", server, lambda: len(store.to_frame(chains)), "txs"))
+
+    return results
+
+
+def find_regressions(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Compare throughput against a previous run, returns a message per regressed path"""
+    baseline = {result["path"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["path"])
+        if previous is None:
+            continue
+        for key, value in result.items():
+            if not key.endswith("_per_sec") or key == "requests_per_sec" or not previous.get(key):
+                continue
+            if value < previous[key] * (1 - tolerance):
+                regressions.append(f"{result['path']}: {key} {value} < {previous[key]} (-{tolerance:.0%} tolerance)")
+    return regressions
+
+
+PATHS = [
+    "scan_txlist", "scan_tokentx", "rpc_logs", "receipts", "subgraph_univ3", "subgraph_prices", "subgraph_connext",
+    "cache_load",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", default=None, help="recorded fixture JSON, a synthetic one is generated if omitted")
+    parser.add_argument("--chains", nargs="+", default=[Chain.GNOSIS, Chain.POLYGON])
+    parser.add_argument("--n-txs", type=int, default=2000, help="txs per chain of the synthetic fixture")
+    parser.add_argument("--paths", nargs="+", default=PATHS, choices=PATHS)
+    parser.add_argument("--latency", type=float, default=0.)
+    parser.add_argument("--jitter", type=float, default=0.)
+    parser.add_argument("--rate-limit", type=float, default=0., help="requests/sec per API key, 0 for unlimited")
+    parser.add_argument("--max-logs", type=int, default=10000, help="eth_getLogs result limit of the mock RPC")
+    parser.add_argument("--error-rate", type=float, default=0., help="fraction of mock responses that are 503s")
+    parser.add_argument("--down", nargs="*", default=[], choices=["explorer", "rpc"], help="mock routes always answering 503")
+    parser.add_argument("--failover", action="store_true", help="fail over to the alternate mock explorer and RPC routes")
+    parser.add_argument("--rpc-pool", action="store_true", help="balance RPC requests over two mock endpoints")
+    parser.add_argument("--n-apikeys", type=int, default=3)
+    parser.add_argument("--executor", default=Executor.DEFAULT_MODE, choices=[Executor.THREAD, Executor.ASYNC, Executor.PROCESS])
+    parser.add_argument("--num-workers", type=int, default=Executor.DEFAULT_NUM_WORKERS)
+    parser.add_argument("--output", default=None, help="write results as JSON to this path")
+    parser.add_argument("--metrics-out", default=None, help="dump client-side request metrics, `.prom` for Prometheus text")
+    parser.add_argument("--profile-stages", action="store_true", help="log fetch/decode/receipt/save/load timings")
+    parser.add_argument("--cprofile", default=None, help="write cProfile stats of the client to this path")
+    parser.add_argument("--baseline", default=None, help="results JSON of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative throughput drop vs baseline")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fixture_path = args.fixture
+        if fixture_path is None:
+            fixture_path = f"{tmp_dir}/fixture.json"
+            generate_fixture(args.chains, n_txs=args.n_txs).save(fixture_path)
+        fixture = Fixture.load(fixture_path)
+
+        with MockServer(fixture_path, latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                        max_logs=args.max_logs, error_rate=args.error_rate, down=args.down) as server, \
+                profile(cprofile_path=args.cprofile, stages=args.profile_stages):
+            results = run_benchmarks(
+                fixture, server, args.paths, args.executor, args.num_workers, args.n_apikeys, args.failover, args.rpc_pool)
+
+    print(f"{'path':<18}{'elapsed':>10}{'req/s':>10}{'items/s':>12}{'rejected':>10}{'failed':>8}{'retries':>9}"
+          f"{'backoff s':>11}{'failovers':>11}{'hedges':>8}{'peak MB':>10}")
+    for result in results:
+        items_per_sec = [v for k, v in result.items() if k.endswith("_per_sec") and k != "requests_per_sec"][0]
+        print(f"{result['path']:<18}{result['elapsed_sec']:>10}{result['requests_per_sec']:>10}"
+              f"{items_per_sec:>12}{result['rejected']:>10}{result['failed']:>8}{result['retries']:>9}"
+              f"{result['backoff_sec']:>11}{result['failovers']:>11}{result['hedges']:>8}{result['peak_memory_mb']:>10}")
+
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=4)
+
+    if args.metrics_out is not None:
+        metrics.dump(args.metrics_out)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fp:
+            regressions = find_regressions(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
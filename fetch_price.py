@@ -1,12 +1,48 @@
+import argparse
 import logging
 
-from api.price import WETHPriceFetcher
-logging.basicConfig(level=logging.DEBUG)
+from api.executor import Executor
+from api.metrics import metrics
+from api.price import PriceFetcher
+from api.profiling import profile
 
 
 def main():
-    fetcher = WETHPriceFetcher()
-    fetcher.multiprocess_fetch(num_workers=40)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--executor", default=Executor.DEFAULT_MODE, choices=[Executor.THREAD, Executor.ASYNC, Executor.PROCESS])
+    parser.add_argument("--num-workers", type=int, default=40)
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--pool", action="append", default=[], metavar="ASSET=POOL_ID:FIELD",
+                        help="extra asset priced by a Uniswap V3 pool, e.g. WBTC=0x99ac8ca7087fa4a2a1fb6357269965a2014abc35:token1Price")
+    parser.add_argument("--batch-size", type=int, default=50, help="blocks per subgraph query")
+    parser.add_argument("--follow", action="store_true", help="keep appending prices of new blocks instead of backfilling up to the head")
+    parser.add_argument("--poll-interval", type=float, default=PriceFetcher.BLOCK_TIME, help="seconds between polls of the head with --follow")
+    parser.add_argument("--confirmations", type=int, default=None, help="blocks behind the head not fetched yet with --follow")
+    parser.add_argument("--metrics-out", default=None, help="dump request metrics at the end, `.prom` for Prometheus text, JSON otherwise")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--profile-stages", action="store_true", help="log blocktime/price timings")
+    parser.add_argument("--cprofile", default=None, help="write cProfile stats to this path")
+    parser.add_argument("--tracemalloc", default=None, help="write top allocation sites to this path")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    pools = dict(PriceFetcher.DEFAULT_POOLS)
+    for pool in args.pool:
+        asset, pool_id = pool.split("=", 1)
+        pool_id, field = pool_id.split(":", 1) if ":" in pool_id else (pool_id, "token0Price")
+        pools[asset] = (pool_id, field)
+    fetcher = PriceFetcher(args.data_dir, pools, args.batch_size)
+    try:
+        with profile(cprofile_path=args.cprofile, tracemalloc_path=args.tracemalloc, stages=args.profile_stages):
+            if args.follow:
+                fetcher.follow(
+                    poll_interval=args.poll_interval, confirmations=args.confirmations,
+                    num_workers=args.num_workers, executor=args.executor)
+            else:
+                fetcher.multiprocess_fetch(num_workers=args.num_workers, executor=args.executor)
+    finally:
+        if args.metrics_out is not None:
+            metrics.dump(args.metrics_out)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,59 @@
+import argparse
 import logging
 
 from dotenv import load_dotenv
 
+from api.archive import archive
 from api.connext import ConnextAPI, ConnextLPTransferAPI
-logging.basicConfig(level=logging.DEBUG)
+from api.constant import Chain
+from api.executor import Executor
+from api.metrics import metrics
+from api.profiling import profile
+from api.watchlist import Watchlist
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--archive", default=None, help="archive raw explorer/subgraph/RPC responses to this directory (requires zstandard)")
+    parser.add_argument("--replay", default=None, help="rebuild the cache from an archive directory instead of fetching")
+    parser.add_argument("--executor", default=Executor.DEFAULT_MODE, choices=[Executor.THREAD, Executor.ASYNC, Executor.PROCESS])
+    parser.add_argument("--num-workers", type=int, default=Executor.DEFAULT_NUM_WORKERS)
+    parser.add_argument("--watchlist", default=None, help="YAML watchlist of addresses to fetch, Connext Diamond and LP tokens if omitted")
+    parser.add_argument("--transfer-source", default=None, choices=["explorer", "rpc"], help="fetch LP transfers from explorer tokentx (one scan per token) or RPC eth_getLogs (one scan per chain), RPC on chains with several tokens if omitted")
+    parser.add_argument("--confirmations", type=int, default=None, help="blocks re-fetched on every chain, per-chain defaults if omitted")
+    parser.add_argument("--metrics-out", default=None, help="dump request metrics at the end, `.prom` for Prometheus text, JSON otherwise")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--profile-stages", action="store_true", help="log fetch/decode/receipt/save/load timings")
+    parser.add_argument("--cprofile", default=None, help="write cProfile stats to this path")
+    parser.add_argument("--tracemalloc", default=None, help="write top allocation sites to this path")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
     load_dotenv(".env")
-    _ = ConnextAPI(data_dir="data").load_txs()
-    _ = ConnextLPTransferAPI(data_dir="data").load_transfers()
+    confirmations = None
+    if args.confirmations is not None:
+        confirmations = {
+            chain: args.confirmations for chain in [
+                Chain.ETHEREUM, Chain.OPTIMISM, Chain.ARBITRUM_ONE, Chain.BNB_CHAIN, Chain.GNOSIS, Chain.POLYGON]}
+    watchlist = Watchlist.load(args.watchlist) if args.watchlist is not None else None
+    try:
+        with profile(cprofile_path=args.cprofile, tracemalloc_path=args.tracemalloc, stages=args.profile_stages):
+            api = ConnextAPI(data_dir=args.data_dir, confirmations=confirmations, watchlist=watchlist)
+            transfer_api = ConnextLPTransferAPI(data_dir=args.data_dir, confirmations=confirmations, watchlist=watchlist)
+            if args.replay is not None:
+                archive.enable(args.replay)
+                _ = api.replay(archive)
+                _ = transfer_api.replay(archive)
+            else:
+                if args.archive is not None:
+                    archive.enable(args.archive)
+                _ = api.load_txs(executor=args.executor, num_workers=args.num_workers)
+                _ = transfer_api.load_transfers(
+                    executor=args.executor, num_workers=args.num_workers, source=args.transfer_source)
+    finally:
+        if args.metrics_out is not None:
+            metrics.dump(args.metrics_out)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+from api.constant import Chain
+from api.dedup import DedupIndex
+from api.scan import ScanTxn
+from api.store import TxnStore
+
+TX_HASH = "0x" + "aa" * 32
+BLOCK_HASH = "0x" + "bb" * 32
+
+
+def transfer(log_index: int, token: str) -> ScanTxn:
+    return ScanTxn(
+        Chain.GNOSIS, 100, 1_700_000_000, TX_HASH, 0, BLOCK_HASH, 0, "0x" + "11" * 20, "0x" + "22" * 20,
+        1, 21000, 1, "0x", token, 0, 21000, 1, functionName="", logIndex=log_index)
+
+
+def test_transfers_of_one_tx(tmp_path):
+    store = TxnStore(str(tmp_path / "lp_transfer_txs"))
+    usdc, weth = transfer(1, "0x" + "01" * 20), transfer(3, "0x" + "02" * 20)
+
+    new, changed, removed = store.diff_tail(Chain.GNOSIS, [usdc, weth], 0)
+    assert [tx.logIndex for tx in new] == [1, 3]
+    assert changed == [] and removed == []
+
+    store.save(Chain.GNOSIS, new)
+    assert sorted(tx.logIndex for tx in store.iter_txs(Chain.GNOSIS)) == [1, 3]
+    assert store.diff_tail(Chain.GNOSIS, [usdc, weth], 0) == ([], [], [])
+    assert store.diff_tail(Chain.GNOSIS, [usdc], 0)[2] == [TxnStore.tx_key(weth)]
+
+    dedup = DedupIndex(str(tmp_path / "dedup" / "lp_transfer_txs"))
+    dedup.rebuild(store, [Chain.GNOSIS])
+    assert dedup.filter_new(Chain.GNOSIS, [usdc, weth]) == []
+    assert dedup.filter_new(Chain.GNOSIS, [transfer(5, usdc.contractAddress)])[0].logIndex == 5
+
+    store.delete(Chain.GNOSIS, [TxnStore.tx_key(weth)])
+    store.rebuild_index(Chain.GNOSIS)
+    assert [tx.logIndex for tx in store.iter_txs(Chain.GNOSIS)] == [1]